@@ -0,0 +1,387 @@
+#
+# benchmark.py - Benchmarks of the fingerprinters, the chunking backends and
+#	encode and decode end to end, on synthetic or given corpora, with
+#	optional JSON output for tracking results over time
+#
+# Copyright (C) 2019 Paul Lu, Owen Randall, <paullu@cs.ualberta.ca>
+#
+# Originally implemented by Owen Randall.
+#	Credits:  Owen Randall, Paul Lu
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Usage: python3 benchmark.py [--json results.json] [files...]
+# Without files the benchmark runs on synthetic corpora, each made from
+# --seed so runs are comparable:
+#   versioned    a random base file followed by versions of it with a few
+#                insertions, deletions and overwrites each, which is where
+#                content-defined chunking should find most chunks again
+#   random       independent random files, with nothing to deduplicate
+#   low-entropy  text drawn from a small vocabulary
+# For each corpus it measures
+#   fingerprinters  every fingerprinter class of rabin_fingerprint and
+#                   gear_fingerprint, on the first --sample-size bytes
+#   backends        chunk() with each backend: speed, chunk size histogram
+#                   and dedup ratio
+#   end-to-end      encode every file into a new store, then decode them
+# Each measurement runs in a child process where fork is available, so the
+# peak RSS reported is that measurement's own.
+import os
+import io
+import sys
+import json
+import time
+import random
+import tempfile
+import argparse
+import datetime
+import platform
+import contextlib
+import multiprocessing
+try:
+    import resource
+except ImportError:
+    resource = None
+import rabin_fingerprint
+from chunk_file import chunk, FINGERPRINTERS, numpy
+from chunk_store import COMPRESSORS, COMPRESSION_METHODS, ENTRY_SIZE64, CRC_SIZE
+from gear_fingerprint import gearFingerprinter, vectorGearFingerprinter, gear_table
+from encode import encode
+from decode import decode_to_file
+
+BENCHMARK_VERSION = 1 # Bumped when the JSON layout changes
+CORPORA = ('versioned', 'random', 'low-entropy')
+STAGES = ('fingerprinters', 'backends', 'end-to-end')
+
+def synthetic_corpus(size, versions, edits, seed = 0):
+    rng = random.Random(seed)
+    data = bytearray(rng.getrandbits(8) for i in range(size))
+    corpus = [bytes(data)]
+    for v in range(versions):
+        for e in range(edits):
+            pos = rng.randrange(len(data))
+            length = rng.randint(1, 64)
+            kind = rng.randrange(3)
+            if kind == 0:
+                data[pos:pos] = bytes(rng.getrandbits(8) for i in range(length))
+            elif kind == 1:
+                del data[pos : pos + length]
+            else:
+                data[pos : pos + length] = bytes(rng.getrandbits(8) for i in range(length))
+        corpus.append(bytes(data))
+    return corpus
+
+def random_corpus(size, files, seed = 0):
+    rng = random.Random(seed)
+    return [rng.getrandbits(8 * size).to_bytes(size, 'little') for f in range(files)]
+
+def low_entropy_corpus(size, files, seed = 0):
+    rng = random.Random(seed)
+    words = [bytes(rng.choice(b'etaoinshrdlu') for i in range(rng.randint(2, 8))) for w in range(256)]
+    corpus = []
+    for f in range(files):
+        data = bytearray()
+        while len(data) < size:
+            data += b' '.join(rng.choices(words, k = 4096)) + b'\n'
+        corpus.append(bytes(data[:size]))
+    return corpus
+
+def make_corpus(name, size, versions, edits, seed = 0):
+    if name == 'versioned':
+        return synthetic_corpus(size, versions, edits, seed)
+    if name == 'random':
+        return random_corpus(size, versions + 1, seed)
+    return low_entropy_corpus(size, versions + 1, seed)
+
+def read_corpus(fileNames):
+    corpus = []
+    for fileName in fileNames:
+        try:
+            with open(fileName, 'rb') as f:
+                corpus.append(f.read())
+        except:
+            print( "File open/read failed: %s" % (fileName) )
+            sys.exit(-1)
+    return corpus
+
+def peak_rss():
+    # Peak resident set size of this process in MB, or None
+    if resource == None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1 << 20) if sys.platform == 'darwin' else rss / (1 << 10)
+
+def measured_child(connection, function, args):
+    try:
+        connection.send((function(*args), peak_rss(), None))
+    except Exception as e:
+        connection.send((None, None, repr(e)))
+    connection.close()
+
+def measure(function, *args):
+    # Returns (function(*args), peak RSS in MB of the process that ran it)
+    if resource == None or 'fork' not in multiprocessing.get_all_start_methods():
+        return function(*args), peak_rss()
+    context = multiprocessing.get_context('fork')
+    receiver, sender = context.Pipe(duplex = False)
+    process = context.Process(target = measured_child, args = (sender, function, args))
+    process.start()
+    sender.close()
+    result, rss, error = receiver.recv()
+    process.join()
+    if error != None:
+        raise RuntimeError(error)
+    return result, rss
+
+def feed_bits(fingerprinter, data):
+    update = fingerprinter.update
+    for byte in data:
+        for i in range(7, -1, -1):
+            update((byte >> i) & 1)
+
+def feed_bytes(fingerprinter, data):
+    update = fingerprinter.update
+    for byte in data:
+        update(byte)
+
+def feed_steps(fingerprinter, data):
+    update = fingerprinter.update
+    step = fingerprinter.step_size
+    for i in range(0, len(data) - step + 1, step):
+        update(data[i : i + step])
+
+def fingerprinter_variants(windowSize, fingerprintSize, maskSize):
+    # name -> (function making the fingerprinter, function feeding it data).
+    # Tables are built by the first function, outside the timing.
+    rf = rabin_fingerprint
+    irreducible, incoming_table, window_tables = rf.fingerprint_tables(fingerprintSize, windowSize)
+    mask = (1 << maskSize) - 1
+    variants = {
+        'fingerprinter': (lambda: rf.fingerprinter(fingerprintSize), feed_bits),
+        'windowFingerprinter': (lambda: rf.windowFingerprinter(fingerprintSize, irreducible), feed_bits),
+        'byteWindowFingerprinter': (lambda: rf.byteWindowFingerprinter(fingerprintSize, irreducible), feed_bytes),
+        'byteWindowFingerprinter2': (lambda: rf.byteWindowFingerprinter2(fingerprintSize, irreducible, 8), feed_bytes),
+        'byteWindowFingerprinter3': (lambda: rf.byteWindowFingerprinter3(irreducible, windowSize, incoming_table,
+                                                                         window_tables[windowSize]), feed_bytes),
+        'byteWindowFingerprinter3_1': (lambda: rf.byteWindowFingerprinter3_1(irreducible, windowSize), feed_bytes),
+        'byteWindowFingerprinter3_2': (lambda: rf.byteWindowFingerprinter3_2(windowSize), feed_bytes),
+        'byteWindowFingerprinter3_3': (lambda: rf.byteWindowFingerprinter3_3(irreducible, windowSize, 8), feed_steps),
+        'byteWindowFingerprinter3_4': (lambda: rf.byteWindowFingerprinter3_4(irreducible, windowSize, 8, 1, maskSize),
+                                       lambda f, data: f.cut_points(data)),
+        'gearFingerprinter': (lambda: gearFingerprinter(gear_table()), feed_bytes),
+    }
+    if numpy is not None:
+        variants['vectorWindowFingerprinter'] = (
+            lambda: rf.vectorWindowFingerprinter(irreducible, windowSize, window_tables = window_tables),
+            lambda f, data: f.cut_points(data, mask, 1))
+        variants['vectorGearFingerprinter'] = (lambda: vectorGearFingerprinter(gear_table()),
+                                               lambda f, data: f.cut_points(data, mask, 1))
+    return variants
+
+def run_fingerprinter(name, sample, chunkOptions):
+    # Returns the seconds the fingerprinter takes over sample
+    make, feed = fingerprinter_variants(chunkOptions['windowSize'], chunkOptions['fingerprintSize'],
+                                        chunkOptions['maskSize'])[name]
+    fingerprinter = make()
+    start = time.perf_counter()
+    feed(fingerprinter, sample)
+    return time.perf_counter() - start
+
+def size_histogram(lengths):
+    # Chunk counts by power-of-two size class: {lowest size of the class: count}
+    histogram = {}
+    for length in lengths:
+        low = 1 << (length.bit_length() - 1) if length > 0 else 0
+        histogram[low] = histogram.get(low, 0) + 1
+    return {str(low): histogram[low] for low in sorted(histogram)}
+
+def run_backend(name, corpus, chunkOptions):
+    # Chunks every file of the corpus; returns (seconds, chunks, unique bytes,
+    # chunk size histogram)
+    unique = set()
+    lengths = []
+    chunk(data = corpus[0][:1], fingerprinterName = name, **chunkOptions) # build tables outside the timing
+    start = time.perf_counter()
+    for data in corpus:
+        chunk_dict, chunk_lst = chunk(data = data, fingerprinterName = name, **chunkOptions)
+        lengths.extend(length for hVal, length in chunk_lst)
+        unique.update(chunk_dict)
+    seconds = time.perf_counter() - start
+    return seconds, len(lengths), sum(length for hVal, length in unique), size_histogram(lengths)
+
+def run_end_to_end(name, corpus, chunkOptions, storeOptions):
+    # Encodes every file of the corpus into one new store, then decodes and
+    # checks them; returns (encode seconds, decode seconds, store bytes)
+    with tempfile.TemporaryDirectory() as tmpDir:
+        commonFile = os.path.join(tmpDir, 'chunks.data')
+        fileNames = []
+        for i, data in enumerate(corpus):
+            fileNames.append(os.path.join(tmpDir, 'file%d' % i))
+            with open(fileNames[-1], 'wb') as f:
+                f.write(data)
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            for fileName in fileNames:
+                encode(fileName, fileName + '.encoded', commonFile, fingerprinterName = name,
+                       **chunkOptions, **storeOptions)
+            encodeSeconds = time.perf_counter() - start
+            start = time.perf_counter()
+            for fileName in fileNames:
+                decode_to_file(fileName + '.encoded', fileName + '.decoded', commonFile)
+            decodeSeconds = time.perf_counter() - start
+        for fileName, data in zip(fileNames, corpus):
+            with open(fileName + '.decoded', 'rb') as f:
+                if f.read() != data:
+                    raise ValueError("ERROR %s DECODED DIFFERENTLY" % fileName)
+        storeBytes = os.path.getsize(commonFile) + os.path.getsize(commonFile + '.idx')
+    return encodeSeconds, decodeSeconds, storeBytes
+
+def mb_per_second(size, seconds):
+    return size / seconds / (1 << 20) if seconds > 0 else float('inf')
+
+def format_rss(rss):
+    return "%10.1f" % rss if rss != None else "%10s" % "-"
+
+def compression_report(corpus, chunkOptions):
+    # Compresses the distinct chunks of the corpus one at a time, as the
+    # chunk store does, with each method
+    unique = {}
+    for data in corpus:
+        unique.update(chunk(data = data, **chunkOptions)[0])
+    chunks = list(unique.values())
+    raw = sum(len(c) for c in chunks)
+    print("%d distinct chunks, %d bytes" % (len(chunks), raw))
+    print("%-8s %10s %14s %14s" % ("method", "ratio", "compress MB/s", "decompress MB/s"))
+    for method in sorted(COMPRESSORS):
+        name, compress, decompress = COMPRESSORS[method]
+        if compress == None:
+            continue
+        start = time.perf_counter()
+        stored = [compress(c) for c in chunks]
+        compressSeconds = time.perf_counter() - start
+        start = time.perf_counter()
+        for s in stored:
+            decompress(s)
+        decompressSeconds = time.perf_counter() - start
+        size = sum(min(len(s), len(c)) + ENTRY_SIZE64 + CRC_SIZE for s, c in zip(stored, chunks))
+        print("%-8s %10.3f %14.2f %14.2f" % (name, raw / size, raw / compressSeconds / (1 << 20),
+                                             raw / decompressSeconds / (1 << 20)))
+
+def benchmark_corpus(name, corpus, args, chunkOptions, storeOptions):
+    # Runs the selected stages on one corpus, printing a table per stage;
+    # returns the results for the JSON output
+    total = sum(len(data) for data in corpus)
+    results = {'corpus': name, 'files': len(corpus), 'bytes': total}
+    print("Corpus %s: %d files, %d bytes" % (name, len(corpus), total))
+    if 'fingerprinters' in args.stages:
+        sample = corpus[0][: args.sample_size]
+        results['fingerprinters'] = []
+        print("%-28s %10s %10s" % ("fingerprinter", "MB/s", "peak MB"))
+        variants = fingerprinter_variants(chunkOptions['windowSize'], chunkOptions['fingerprintSize'],
+                                          chunkOptions['maskSize'])
+        for variant in sorted(variants):
+            try:
+                seconds, rss = measure(run_fingerprinter, variant, sample, chunkOptions)
+            except Exception as e:
+                # Some of the experimental classes do not run on all input
+                print("%-28s failed: %s" % (variant, e))
+                results['fingerprinters'].append({'name': variant, 'error': str(e)})
+                continue
+            print("%-28s %10.3f %s" % (variant, mb_per_second(len(sample), seconds), format_rss(rss)))
+            results['fingerprinters'].append({'name': variant, 'bytes': len(sample), 'seconds': seconds,
+                                              'MBps': mb_per_second(len(sample), seconds), 'peakRSSMB': rss})
+    if 'backends' in args.stages:
+        results['backends'] = []
+        print("%-8s %10s %10s %10s %12s %10s" % ("backend", "MB/s", "chunks", "avg size", "dedup ratio", "peak MB"))
+        for backend in args.backends:
+            (seconds, chunks, uniqueBytes, histogram), rss = measure(run_backend, backend, corpus, chunkOptions)
+            print("%-8s %10.2f %10d %10d %12.3f %s" % (backend, mb_per_second(total, seconds), chunks,
+                                                        total // chunks, total / uniqueBytes, format_rss(rss)))
+            if args.histogram:
+                print("    sizes: " + ", ".join("%s+: %d" % (low, count) for low, count in histogram.items()))
+            results['backends'].append({'name': backend, 'seconds': seconds, 'MBps': mb_per_second(total, seconds),
+                                        'chunks': chunks, 'averageSize': total / chunks, 'uniqueBytes': uniqueBytes,
+                                        'dedupRatio': total / uniqueBytes, 'sizeHistogram': histogram,
+                                        'peakRSSMB': rss})
+    if 'end-to-end' in args.stages:
+        results['endToEnd'] = []
+        print("%-8s %12s %12s %12s %12s %10s" % ("backend", "encode MB/s", "decode MB/s", "store bytes",
+                                                 "store ratio", "peak MB"))
+        for backend in args.backends:
+            (encodeSeconds, decodeSeconds, storeBytes), rss = measure(run_end_to_end, backend, corpus,
+                                                                      chunkOptions, storeOptions)
+            print("%-8s %12.2f %12.2f %12d %12.3f %s" % (backend, mb_per_second(total, encodeSeconds),
+                                                         mb_per_second(total, decodeSeconds), storeBytes,
+                                                         total / storeBytes, format_rss(rss)))
+            results['endToEnd'].append({'name': backend, 'encodeSeconds': encodeSeconds,
+                                        'decodeSeconds': decodeSeconds,
+                                        'encodeMBps': mb_per_second(total, encodeSeconds),
+                                        'decodeMBps': mb_per_second(total, decodeSeconds),
+                                        'storeBytes': storeBytes, 'storeRatio': total / storeBytes,
+                                        'peakRSSMB': rss})
+    if args.compression:
+        compression_report(corpus, chunkOptions)
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Benchmark the fingerprinters, chunking and encode and decode")
+    parser.add_argument("files", nargs = '*', help = "corpus files (default: synthetic corpora)")
+    parser.add_argument("--backends", nargs = '+', choices = sorted(FINGERPRINTERS), default = sorted(FINGERPRINTERS))
+    parser.add_argument("--corpora", nargs = '+', choices = CORPORA, default = list(CORPORA),
+                        help = "synthetic corpora to run")
+    parser.add_argument("--stages", nargs = '+', choices = STAGES, default = list(STAGES))
+    parser.add_argument("--window-size", type = int, default = 48, help = "bytes in the Rabin window")
+    parser.add_argument("--fingerprint-size", type = int, default = 64, help = "degree of the Rabin polynomial")
+    parser.add_argument("--mask-size", type = int, default = 13)
+    parser.add_argument("--min-size", type = int, default = 0)
+    parser.add_argument("--max-size", type = int, default = None)
+    parser.add_argument("--normalization", type = int, default = 0)
+    parser.add_argument("--size", type = int, default = 4 << 20, help = "bytes in each synthetic file")
+    parser.add_argument("--versions", type = int, default = 4, help = "synthetic files after the first")
+    parser.add_argument("--edits", type = int, default = 20, help = "edits per synthetic version")
+    parser.add_argument("--seed", type = int, default = 0)
+    parser.add_argument("--sample-size", type = int, default = 64 << 10,
+                        help = "bytes each fingerprinter class is timed on")
+    parser.add_argument("--store-compression", choices = sorted(COMPRESSION_METHODS), default = None,
+                        help = "compression of the end-to-end store")
+    parser.add_argument("--container-size", type = int, default = None,
+                        help = "make the end-to-end store a container store")
+    parser.add_argument("--histogram", action = 'store_true', help = "print the chunk size histograms")
+    parser.add_argument("--compression", action = 'store_true', help = "also report per-chunk compression ratio and speed")
+    parser.add_argument("--json", default = None, help = "write the results as JSON to this file")
+    args = parser.parse_args()
+    chunkOptions = {'windowSize': args.window_size, 'fingerprintSize': args.fingerprint_size,
+                    'maskSize': args.mask_size, 'minSize': args.min_size, 'maxSize': args.max_size,
+                    'normalization': args.normalization}
+    storeOptions = {'compression': args.store_compression, 'containerSize': args.container_size}
+    results = []
+    for name in ['files'] if args.files else args.corpora:
+        # One corpus in memory at a time, as the measurements' processes inherit it
+        if args.files:
+            corpus = read_corpus(args.files)
+        else:
+            corpus = make_corpus(name, args.size, args.versions, args.edits, args.seed)
+        results.append(benchmark_corpus(name, corpus, args, chunkOptions, storeOptions))
+        del corpus
+        print()
+    if args.json != None:
+        report = {'version': BENCHMARK_VERSION, 'date': datetime.datetime.now().isoformat(timespec = 'seconds'),
+                  'python': platform.python_version(), 'platform': platform.platform(),
+                  'numpy': numpy is not None, 'options': vars(args), 'corpora': results}
+        try:
+            with open(args.json, 'w') as f:
+                json.dump(report, f, indent = 1)
+        except:
+            print( "File open/write failed: %s" % (args.json) )
+            sys.exit(-1)
@@ -0,0 +1,180 @@
+#
+# chunk_cache.py - Size-bounded caches of hot chunks in front of a chunkStore
+#
+# Copyright (C) 2019 Paul Lu, Owen Randall, <paullu@cs.ualberta.ca>
+#
+# Originally implemented by Owen Randall.
+#	Credits:  Owen Randall, Paul Lu
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from collections import OrderedDict
+import threading
+
+class lruCache:
+    def __init__(self, maxBytes):
+        self.maxBytes = maxBytes
+        self.size = 0
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        value = self.entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        if len(value) > self.maxBytes or key in self.entries:
+            return
+        self.entries[key] = value
+        self.size += len(value)
+        while self.size > self.maxBytes:
+            oldKey, oldValue = self.entries.popitem(last = False)
+            self.size -= len(oldValue)
+            self.evictions += 1
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'entries': len(self.entries), 'bytes': self.size}
+
+class twoQueueCache:
+    # 2Q (Johnson and Shasha): first-time chunks go to a small FIFO (a1in)
+    # and only chunks seen again after falling out of it, remembered by key
+    # in a1out, are promoted to the LRU main queue (am).  A stream of
+    # one-off chunks therefore cannot flush the popular ones.
+    def __init__(self, maxBytes, inFraction = 0.25, outFraction = 0.5):
+        self.maxBytes = maxBytes
+        self.inBytes = int(maxBytes * inFraction)
+        self.outBytes = int(maxBytes * outFraction)
+        self.a1in = OrderedDict()
+        self.a1out = OrderedDict() # key -> size, no data
+        self.am = OrderedDict()
+        self.a1inSize = 0
+        self.a1outSize = 0
+        self.amSize = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        value = self.am.get(key)
+        if value is not None:
+            self.am.move_to_end(key)
+            self.hits += 1
+            return value
+        value = self.a1in.get(key)
+        if value is not None:
+            self.hits += 1
+            return value
+        self.misses += 1
+        return None
+
+    def put(self, key, value):
+        if len(value) > self.maxBytes or key in self.am or key in self.a1in:
+            return
+        if key in self.a1out:
+            self.a1outSize -= self.a1out.pop(key)
+            self.am[key] = value
+            self.amSize += len(value)
+        else:
+            self.a1in[key] = value
+            self.a1inSize += len(value)
+        while self.a1inSize + self.amSize > self.maxBytes:
+            if self.a1inSize > self.inBytes or not self.am:
+                oldKey, oldValue = self.a1in.popitem(last = False)
+                self.a1inSize -= len(oldValue)
+                self.a1out[oldKey] = len(oldValue)
+                self.a1outSize += len(oldValue)
+                while self.a1outSize > self.outBytes:
+                    self.a1outSize -= self.a1out.popitem(last = False)[1]
+            else:
+                oldKey, oldValue = self.am.popitem(last = False)
+                self.amSize -= len(oldValue)
+            self.evictions += 1
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'entries': len(self.a1in) + len(self.am), 'bytes': self.a1inSize + self.amSize}
+
+CACHE_POLICIES = {'lru': lruCache, '2q': twoQueueCache}
+
+def make_cache(policy, maxBytes):
+    return CACHE_POLICIES[policy](maxBytes)
+
+def add_cache_arguments(parser):
+    parser.add_argument("--cache-policy", choices = sorted(CACHE_POLICIES), default = 'lru', help = "replacement policy of the chunk cache; 2q keeps one-off chunks from flushing repeated ones")
+    parser.add_argument("--cache-bytes", type = int, default = 0, help = "serve repeated chunks from a cache of this many bytes (default: no cache)")
+
+def cache_option(args):
+    # The cache the command line asks for, or None
+    if args.cache_bytes <= 0:
+        return None
+    return make_cache(args.cache_policy, args.cache_bytes)
+
+class cachedStore:
+    # Wraps a chunkStore so repeated chunks are served from the cache.  The
+    # lock lets decode's fetch threads share the cache.
+    def __init__(self, store, cache):
+        self.store = store
+        self.key_size = store.key_size
+        self.cache = cache
+        self.lock = threading.Lock()
+
+    def __getitem__(self, key):
+        if not isinstance(key, int):
+            key = bytes(key)
+        with self.lock:
+            value = self.cache.get(key)
+        if value is None:
+            value = bytes(self.store[key])
+            with self.lock:
+                self.cache.put(key, value)
+        return value
+
+    def __contains__(self, key):
+        key = bytes(key)
+        if self.cache.get(key) is not None:
+            return True
+        return key in self.store
+
+    def add(self, key, chunk):
+        key = bytes(key)
+        if self.cache.get(key) is not None:
+            return False
+        added = self.store.add(key, chunk)
+        if not added:
+            self.cache.put(key, bytes(chunk))
+        return added
+
+    def add_many(self, items):
+        # Cached chunks are already stored, so only the rest reach the store
+        return self.store.add_many((key, chunk) for key, chunk in items if self.cache.get(bytes(key)) is None)
+
+    def id_of(self, key):
+        return self.store.id_of(key)
+
+    def __len__(self):
+        return len(self.store)
+
+    def flush(self):
+        self.store.flush()
+
+    def close(self):
+        self.store.close()
@@ -0,0 +1,270 @@
+#
+# chunk_delta.py - Near-duplicate chunks stored as deltas against a similar
+#	stored chunk, found through super-features
+#
+# Copyright (C) 2019 Paul Lu, Owen Randall, <paullu@cs.ualberta.ca>
+#
+# Originally implemented by Owen Randall.
+#	Credits:  Owen Randall, Paul Lu
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# A chunk that differs from a stored one by a few bytes has a different ID
+# and would be stored in full.  deltaStore instead
+#  - fingerprints each new chunk with byteWindowFingerprinter3 (or its numpy
+#    equivalent), keeps the fingerprints matching SAMPLE_MASK, and takes
+#    FEATURES min-hashes of them, the maximum of each of FEATURES random
+#    linear maps.  Each group of FEATURES / SUPER_FEATURES features is
+#    hashed into a super-feature; chunks sharing a super-feature very likely
+#    share most of their content.
+#  - looks the super-features up in the feature index (chunks.data.sim),
+#    and if one names a stored chunk, stores the new chunk as copy and
+#    insert instructions against that base when they are small enough.
+# A delta record is a chunk_store record with method DELTA_METHOD whose
+# stored bytes are DELTA_HEADER64 (chain depth, base chunk ID), or
+# DELTA_HEADER in stores older than version 5, followed by the
+# instructions.  The base may itself be a delta, but never one whose depth
+# is already maxDepth, so a read resolves at most maxDepth deltas.
+import os
+import struct
+import random
+import hashlib
+from rabin_fingerprint import byteWindowFingerprinter3, fingerprint_tables
+from recipe import put_varint, get_varint
+try:
+    import numpy
+    from rabin_fingerprint import vectorWindowFingerprinter
+except ImportError:
+    numpy = None
+
+DELTA_METHOD = 4
+DELTA_HEADER = struct.Struct('<BI') # chain depth, base chunk ID
+DELTA_HEADER64 = struct.Struct('<BQ')
+MAX_DELTA_DEPTH = 4
+DELTA_BLOCK = 16 # shortest copy; the base is indexed every DELTA_BLOCK bytes
+FEATURE_WINDOW = 16
+FEATURE_DEGREE = 64
+SAMPLE_MASK = 0x1f
+FEATURES = 12
+SUPER_FEATURES = 3
+SIM_MAGIC = b'RFSM'
+SIM_VERSION = 2
+SIM_HEADER = struct.Struct('<4sI') # magic, version
+SIM_RECORD = struct.Struct('<QB3Q') # chunk ID, chain depth, super-features
+MASK64 = (1 << 64) - 1
+
+feature_rng = random.Random(FEATURES)
+FEATURE_MAPS = [(feature_rng.getrandbits(64) | 1, feature_rng.getrandbits(64)) for i in range(FEATURES)]
+
+def sampled_fingerprints(chunk):
+    # The Rabin fingerprints after the bytes of chunk that match SAMPLE_MASK
+    irreducible, incoming_table, window_tables = fingerprint_tables(FEATURE_DEGREE, FEATURE_WINDOW)
+    if numpy is not None:
+        fingerprinter = vectorWindowFingerprinter(irreducible, FEATURE_WINDOW, window_tables = window_tables)
+        fingerprints = fingerprinter.update(bytes(chunk))
+        return fingerprints[fingerprints & numpy.uint64(SAMPLE_MASK) == 0]
+    fingerprinter = byteWindowFingerprinter3(irreducible, FEATURE_WINDOW, incoming_table, window_tables[FEATURE_WINDOW])
+    update = fingerprinter.update
+    return [f for f in map(update, bytes(chunk)) if f & SAMPLE_MASK == 0]
+
+def super_features(chunk):
+    # The SUPER_FEATURES super-features of chunk, or None if it is too short
+    # to have any sampled fingerprints
+    samples = sampled_fingerprints(chunk)
+    if len(samples) == 0:
+        return None
+    if numpy is not None:
+        features = [int((samples * numpy.uint64(a) + numpy.uint64(b)).max()) for a, b in FEATURE_MAPS]
+    else:
+        features = [max((a * s + b) & MASK64 for s in samples) for a, b in FEATURE_MAPS]
+    group = FEATURES // SUPER_FEATURES
+    superFeatures = []
+    for i in range(0, FEATURES, group):
+        packed = struct.pack('<%dQ' % group, *features[i : i + group])
+        superFeatures.append(int.from_bytes(hashlib.blake2b(packed, digest_size = 8).digest(), 'little'))
+    return superFeatures
+
+def match_length(a, i, b, j):
+    # Length of the common prefix of a[i:] and b[j:]
+    n = min(len(a) - i, len(b) - j)
+    length = 0
+    while length + 64 <= n and a[i + length : i + length + 64] == b[j + length : j + length + 64]:
+        length += 64
+    while length < n and a[i + length] == b[j + length]:
+        length += 1
+    return length
+
+def make_delta(base, target):
+    # Instructions rebuilding target from base.  Each starts with a varint v:
+    # odd v copies v >> 1 bytes from the base offset in the varint after it,
+    # even v inserts the v >> 1 bytes after it.
+    base = bytes(base)
+    target = bytes(target)
+    index = {}
+    for j in range(0, len(base) - DELTA_BLOCK + 1, DELTA_BLOCK):
+        index.setdefault(base[j : j + DELTA_BLOCK], j)
+    out = bytearray()
+    literal = 0
+    i = 0
+    while i + DELTA_BLOCK <= len(target):
+        j = index.get(target[i : i + DELTA_BLOCK])
+        if j == None:
+            i += 1
+            continue
+        while i > literal and j > 0 and target[i - 1] == base[j - 1]:
+            i -= 1
+            j -= 1
+        length = match_length(base, j, target, i)
+        if i > literal:
+            put_varint(out, (i - literal) << 1)
+            out += target[literal : i]
+        put_varint(out, length << 1 | 1)
+        put_varint(out, j)
+        i += length
+        literal = i
+    if literal < len(target):
+        put_varint(out, (len(target) - literal) << 1)
+        out += target[literal:]
+    return bytes(out)
+
+def apply_delta(base, delta):
+    out = bytearray()
+    pos = 0
+    while pos < len(delta):
+        v, pos = get_varint(delta, pos)
+        if v & 1:
+            offset, pos = get_varint(delta, pos)
+            out += base[offset : offset + (v >> 1)]
+        else:
+            out += delta[pos : pos + (v >> 1)]
+            pos += v >> 1
+    return bytes(out)
+
+class deltaStore:
+    # Wraps a chunkStore or containerStore whose records have a method byte
+    # (a compressing or container store), or a fingerprintIndex over one,
+    # keeping the feature index in fileName.  New chunks are stored as
+    # deltas when the instructions take at most maxRatio of the chunk.
+    def __init__(self, store, fileName, maxDepth = MAX_DELTA_DEPTH, maxRatio = 0.5):
+        if not store.compressed():
+            raise ValueError("ERROR DELTA CHUNKS NEED A COMPRESSING OR CONTAINER STORE")
+        self.store = store
+        self.key_size = store.key_size
+        self.fileName = fileName
+        self.maxDepth = min(maxDepth, 255)
+        self.maxRatio = maxRatio
+        self.bases = {} # super-feature -> ID of the latest chunk with it
+        self.depths = {} # chunk ID -> chain depth, for the chunks in bases
+        self.new_records = bytearray()
+        self.deltas = 0
+        self.savedBytes = 0
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.fileName, 'rb') as f:
+                data = f.read()
+        except OSError:
+            return
+        if data[:SIM_HEADER.size] != SIM_HEADER.pack(SIM_MAGIC, SIM_VERSION):
+            # An older feature index, started again
+            if data:
+                os.truncate(self.fileName, 0)
+            return
+        count = len(self.store)
+        for pos in range(SIM_HEADER.size, len(data) - SIM_RECORD.size + 1, SIM_RECORD.size):
+            chunkId, depth, *superFeatures = SIM_RECORD.unpack_from(data, pos)
+            if chunkId < count:
+                self.remember(chunkId, depth, superFeatures)
+
+    def remember(self, chunkId, depth, superFeatures):
+        # A chunk at maxDepth cannot be a base
+        if depth >= self.maxDepth:
+            return
+        self.depths[chunkId] = depth
+        for superFeature in superFeatures:
+            self.bases[superFeature] = chunkId
+
+    def find_base(self, superFeatures):
+        for superFeature in superFeatures:
+            chunkId = self.bases.get(superFeature)
+            if chunkId != None:
+                return chunkId
+        return None
+
+    def add(self, key, chunk):
+        key = bytes(key)
+        if key in self.store:
+            return False
+        superFeatures = super_features(chunk)
+        if superFeatures == None:
+            return self.store.add(key, chunk)
+        depth = 0
+        baseId = self.find_base(superFeatures)
+        added = False
+        if baseId != None:
+            delta = make_delta(self.store[baseId], chunk)
+            if DELTA_HEADER64.size + len(delta) <= len(chunk) * self.maxRatio:
+                depth = self.depths[baseId] + 1
+                added = self.store.add_delta(key, baseId, depth, delta)
+                if added:
+                    self.deltas += 1
+                    self.savedBytes += len(chunk) - DELTA_HEADER64.size - len(delta)
+        if baseId == None or depth == 0:
+            added = self.store.add(key, chunk)
+        if added:
+            # Looked up rather than taken to be the last ID, which only
+            # holds while no other writer appends
+            chunkId = self.store.id_of(key)
+            self.remember(chunkId, depth, superFeatures)
+            self.new_records += SIM_RECORD.pack(chunkId, depth, *superFeatures)
+        return added
+
+    def add_many(self, items):
+        added = 0
+        for key, chunk in items:
+            if self.add(key, chunk):
+                added += 1
+        return added
+
+    def save(self):
+        if self.new_records:
+            with open(self.fileName, 'ab') as f:
+                if f.tell() == 0:
+                    f.write(SIM_HEADER.pack(SIM_MAGIC, SIM_VERSION))
+                f.write(self.new_records)
+            self.new_records = bytearray()
+
+    def stats(self):
+        return {'deltas': self.deltas, 'savedBytes': self.savedBytes, 'bases': len(self.depths)}
+
+    def __contains__(self, key):
+        return key in self.store
+
+    def __getitem__(self, key):
+        return self.store[key]
+
+    def id_of(self, key):
+        return self.store.id_of(key)
+
+    def __len__(self):
+        return len(self.store)
+
+    def flush(self):
+        self.store.flush()
+        self.save()
+
+    def close(self):
+        self.store.close()
+        self.save()
@@ -0,0 +1,74 @@
+#
+# chunk_digest.py - Digests that name chunks in chunk IDs
+#
+# Copyright (C) 2019 Paul Lu, Owen Randall, <paullu@cs.ualberta.ca>
+#
+# Originally implemented by Owen Randall.
+#	Credits:  Owen Randall, Paul Lu
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# A chunk ID, the key chunk_store.chunk_key() makes, is a 20-byte digest
+# field followed by the chunk length: 8 bytes, a 28-byte key, in a version
+# 5 store, and 3 bytes, a 23-byte key, in older stores and version 1
+# recipes.  SHA-1 IDs keep the original layout, the whole field is the
+# SHA-1.  Other digests start the field with a tag byte naming the digest,
+# followed by the digest zero-padded to 19 bytes, so IDs of different
+# digests never mean the same chunk by accident.  Hashes of a key skip the
+# tag byte: chunk_store.slot_hash() takes key[1:9] and key[9:12], and
+# fingerprint_index key[1:17], digest bytes for every digest here.
+# Non-cryptographic digests are marked verify: a chunk whose ID is already
+# stored is compared byte for byte.
+import hashlib
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+DIGEST_FIELD_SIZE = 20
+
+class chunkDigest:
+    def __init__(self, name, tag, new, verify = False):
+        self.name = name
+        self.tag = tag
+        self.new = new # returns a hasher with update() and digest()
+        self.verify = verify
+
+    def field(self, hasher):
+        # The 20-byte digest field of a chunk ID
+        if self.tag == None:
+            return hasher.digest()
+        return bytes([self.tag]) + hasher.digest()[: DIGEST_FIELD_SIZE - 1].ljust(DIGEST_FIELD_SIZE - 1, b'\0')
+
+    def __call__(self, chunk):
+        hasher = self.new()
+        hasher.update(chunk)
+        return self.field(hasher)
+
+def new_xxh128():
+    if xxhash is None:
+        raise ImportError("the xxh128 digest requires the xxhash package")
+    return xxhash.xxh3_128()
+
+DIGESTS = {
+    'sha1': chunkDigest('sha1', None, hashlib.sha1),
+    'blake2b': chunkDigest('blake2b', 1, lambda: hashlib.blake2b(digest_size = DIGEST_FIELD_SIZE - 1)),
+    'xxh128': chunkDigest('xxh128', 2, new_xxh128, verify = True),
+}
+
+def chunk_digest(name):
+    if name not in DIGESTS:
+        raise ValueError("Unknown digest %r, expected one of %s" % (name, ", ".join(sorted(DIGESTS))))
+    DIGESTS[name].new() # fails here rather than mid-file if an optional module is missing
+    return DIGESTS[name]
@@ -21,65 +21,435 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 # Based on chunk_fileV3_1.py
-from rabin_fingerprint import byteWindowFingerprinter3, irreducible_polynomial, print_bits
+from rabin_fingerprint import byteWindowFingerprinter3, fingerprint_tables, print_bits
+from gear_fingerprint import gearFingerprinter, vectorGearFingerprinter, gear_table, GEAR_WINDOW
+from chunk_digest import chunk_digest, DIGESTS, DIGEST_FIELD_SIZE
+from chunk_stats import stage
 import sys
-import hashlib
 import time
 import datetime
+import multiprocessing
+import inspect
+from bisect import bisect_left
+try:
+    import numpy
+    from rabin_fingerprint import vectorWindowFingerprinter
+except ImportError:
+    numpy = None
 
-def chunk(fileName = None, windowSize = 3, fingerprintSize = 8, maskSize = 8, data = None,verbose=False):
+class rabinBackend:
+    # byteWindowFingerprinter3 and its batch and multi-byte equivalents
+    def __init__(self, windowSize, fingerprintSize):
+        self.windowSize = windowSize
+        self.irreducible, self.incoming_table, self.window_tables = fingerprint_tables(fingerprintSize, windowSize)
+
+    def vector(self):
+        # Batch fingerprinter with cut_points(data, mask, cutValue, smallMask), or None without numpy
+        if numpy is None:
+            return None
+        return vectorWindowFingerprinter(self.irreducible, self.windowSize, window_tables = self.window_tables)
+
+    def bytewise(self):
+        # Fingerprinter with update(byte), cut_points(data, mask, cutValue) and flush()
+        return byteWindowFingerprinter3(self.irreducible, self.windowSize, self.incoming_table, self.window_tables[self.windowSize])
+
+    def block_cuts(self, mask, cutValue):
+        # Function from successive blocks to the offsets of their cuts, by
+        # the bytewise fingerprinter's cut_points(), for use without numpy
+        fingerprinter = self.bytewise()
+        def find_cuts(block):
+            return fingerprinter.cut_points(block, mask, cutValue)
+        return find_cuts
+
+class gearBackend:
+    # Gear hash.  windowSize and fingerprintSize do not apply: the window is
+    # always GEAR_WINDOW bytes and the fingerprint 32 bits.
+    def __init__(self, windowSize, fingerprintSize):
+        self.windowSize = GEAR_WINDOW
+        self.table = gear_table()
+
+    def vector(self):
+        if numpy is None:
+            return None
+        return vectorGearFingerprinter(self.table)
+
+    def bytewise(self):
+        return gearFingerprinter(self.table)
+
+    def block_cuts(self, mask, cutValue):
+        fingerprinter = gearFingerprinter(self.table)
+        def find_cuts(block):
+            return fingerprinter.cut_points(block, mask, cutValue)
+        return find_cuts
+
+FINGERPRINTERS = {'rabin': rabinBackend, 'gear': gearBackend}
+
+def fingerprinter_backend(name, windowSize, fingerprintSize):
+    if name not in FINGERPRINTERS:
+        raise ValueError("Unknown fingerprinter %r, expected one of %s" % (name, ", ".join(sorted(FINGERPRINTERS))))
+    return FINGERPRINTERS[name](windowSize, fingerprintSize)
+
+def chunk(fileName = None, windowSize = 3, fingerprintSize = 8, maskSize = 8, data = None,verbose=False,
+          processes = 1, segmentSize = 16 << 20, minSize = 0, maxSize = None, normalization = 0, normalSize = None,
+          fingerprinterName = 'rabin', digestName = 'sha1', stats = None):
+    # stats is an optional chunk_stats.chunkStats
     cutValue = 1
     mask = (2 ** maskSize) - 1
-    fingerprinter = byteWindowFingerprinter3(irreducible_polynomial(fingerprintSize), windowSize)
+    limits = chunkLimits(maskSize, minSize, maxSize, normalization, normalSize)
+    backend = fingerprinter_backend(fingerprinterName, windowSize, fingerprintSize)
+    digest = chunk_digest(digestName)
     if fileName != None:
-        try:
-            data = open(fileName, 'rb').read()
-        except:
-            print( "File open/read failed: %s" % (fileName) )
-            sys.exit(-1)
-    chunk_dict = {}
-    chunk_lst = []
-    length = 0
-    hasher = hashlib.sha1()
-    chunk = bytearray(b'')
+        with stage(stats, 'read'):
+            try:
+                data = open(fileName, 'rb').read()
+            except:
+                print( "File open/read failed: %s" % (fileName) )
+                sys.exit(-1)
+    if processes > 1 and isinstance(data, (bytes, bytearray, memoryview)):
+        with stage(stats, 'chunk'):
+            result = chunk_parallel(data, fileName, windowSize, fingerprintSize, limits, processes, segmentSize,
+                                    verbose, fingerprinterName, digestName)
+    elif numpy is not None and isinstance(data, (bytes, bytearray, memoryview)):
+        result = chunk_vector(backend.vector(), data, limits, cutValue, verbose, digest, stats)
+    else:
+        fingerprinter = backend.bytewise()
+        data = bytes(data)
+        with stage(stats, 'fingerprint'):
+            if limits.unconstrained:
+                ends = scan_ends(data, fingerprinter, mask, cutValue, verbose)
+            else:
+                ends = scan_cuts(data, fingerprinter, backend.windowSize, limits, cutValue)
+        with stage(stats, 'hash'):
+            result = collect_chunks(data, ends, digest)
+    if stats != None:
+        stats.add_chunks(length for hVal, length in result[1])
+    return result
+
+def scan_ends(data, fingerprinter, mask, cutValue, verbose=False):
+    # Per-byte cut search without limits, 10 MB at a time through the
+    # fingerprinter's cut_points().  Only the fingerprint runs per byte; each
+    # chunk is hashed once, from a slice of data, by collect_chunks.
+    ends = []
+    oneMB = 1024 * 1024
+    tenMB = 10 * oneMB
+    view = memoryview(data)
+    for blockStart in range(0, len(view), tenMB):
+        if verbose:
+            print( "%5d MB: %s" % (blockStart/oneMB, datetime.datetime.now()), flush=True )
+        ends.extend(blockStart + end for end in fingerprinter.cut_points(view[blockStart : blockStart + tenMB], mask, cutValue))
+    return ends
+
+CHUNK_PARAMETERS = ('windowSize', 'fingerprintSize', 'maskSize', 'minSize', 'maxSize', 'normalization',
+                    'normalSize', 'fingerprinterName', 'digestName')
+
+def chunk_parameters(chunkOptions):
+    # The chunking parameters chunk() uses for chunkOptions, defaults included
+    defaults = inspect.signature(chunk).parameters
+    return {name: chunkOptions.get(name, defaults[name].default) for name in CHUNK_PARAMETERS}
+
+class chunkLimits:
+    # Chunk size constraints.  No cut is made before minSize bytes and one is
+    # forced at maxSize.  With normalization n (FastCDC style), a chunk
+    # shorter than normalSize is cut only where fingerprint & smallMask
+    # (maskSize + n bits) matches and a longer one where fingerprint &
+    # largeMask (maskSize - n bits) does, which narrows the size spread.
+    def __init__(self, maskSize, minSize = 0, maxSize = None, normalization = 0, normalSize = None):
+        self.minSize = max(minSize, 1)
+        self.maxSize = maxSize
+        if maxSize != None:
+            self.minSize = min(self.minSize, maxSize)
+        self.largeMask = (2 ** (maskSize - normalization)) - 1
+        if normalization:
+            self.smallMask = (2 ** (maskSize + normalization)) - 1
+            self.normalSize = normalSize if normalSize != None else max(minSize, 2 ** maskSize)
+        else:
+            self.smallMask = None
+            self.normalSize = None
+        self.unconstrained = self.minSize == 1 and maxSize == None and not normalization
+
+class cutSelector:
+    # Picks the actual cuts, in order, from the candidate offsets (ends of
+    # bytes whose fingerprint matches the small or large mask), applying the
+    # chunkLimits.  Candidates may be fed a block at a time; a cut is
+    # returned as soon as the candidates seen so far decide it.
+    def __init__(self, limits, start = 0):
+        self.limits = limits
+        self.start = start
+        self.small = []
+        self.large = []
+        self.smallIndex = 0
+        self.largeIndex = 0
 
-    lenInBytes = 0
+    def feed(self, small, large, seenEnd):
+        # small and large hold the candidates up to offset seenEnd not fed yet
+        self.small.extend(small)
+        self.large.extend(large)
+        cuts = []
+        cut = self.next_cut(seenEnd)
+        while cut != None:
+            cuts.append(cut)
+            self.start = cut
+            cut = self.next_cut(seenEnd)
+        if self.smallIndex > 4096:
+            del self.small[:self.smallIndex]
+            self.smallIndex = 0
+        if self.largeIndex > 4096:
+            del self.large[:self.largeIndex]
+            self.largeIndex = 0
+        return cuts
+
+    def next_cut(self, seenEnd):
+        limits = self.limits
+        first = self.start + limits.minSize
+        limit = None if limits.maxSize == None else self.start + limits.maxSize
+        if limits.normalSize != None:
+            normal = self.start + limits.normalSize
+            self.smallIndex = bisect_left(self.small, first, self.smallIndex)
+            if self.smallIndex < len(self.small):
+                cut = self.small[self.smallIndex]
+                if cut < normal and (limit == None or cut <= limit):
+                    return cut
+            if seenEnd < (normal - 1 if limit == None else min(normal - 1, limit)):
+                return None
+            first = max(first, normal)
+        self.largeIndex = bisect_left(self.large, first, self.largeIndex)
+        if self.largeIndex < len(self.large):
+            cut = self.large[self.largeIndex]
+            if limit == None or cut <= limit:
+                return cut
+        if limit != None and seenEnd >= limit:
+            return limit
+        return None
+
+def scan_cuts(data, fingerprinter, windowSize, limits, cutValue):
+    # Per-byte cut search honoring chunkLimits, for when numpy is missing.
+    # A cut depends only on the last windowSize bytes, so after each cut the
+    # fingerprinter restarts windowSize bytes before the first offset that
+    # may be cut, and the rest of the minimum chunk is never fingerprinted.
+    cuts = []
+    start = 0
+    i = 0
+    while True:
+        first = start + limits.minSize
+        if first - windowSize > i:
+            fingerprinter.flush()
+            i = first - windowSize
+        cut = None
+        while i < len(data):
+            fingerprint = fingerprinter.update(data[i])
+            i += 1
+            if i < first:
+                continue
+            length = i - start
+            if limits.normalSize != None and length < limits.normalSize:
+                mask = limits.smallMask
+            else:
+                mask = limits.largeMask
+            if fingerprint & mask == cutValue or (limits.maxSize != None and length >= limits.maxSize):
+                cut = i
+                break
+        if cut == None:
+            return cuts
+        cuts.append(cut)
+        start = cut
+
+def chunk_vector(fingerprinter, data, limits, cutValue, verbose=False, digest = DIGESTS['sha1'], stats = None):
+    # Same result as the per-byte loop in chunk(), but the cut points are
+    # found a block at a time and each chunk is hashed once
     oneMB = 1024 * 1024
     tenMB = 10 * oneMB
-    for byte in data:
-        if verbose and ( ( lenInBytes % tenMB ) == 0 ):
-            print( "%5d MB: %s" % (lenInBytes/oneMB, datetime.datetime.now()), flush=True )
-        lenInBytes += 1
-
-        length += 1
-        fingerprint = fingerprinter.update(byte)
-        hasher.update(byte.to_bytes(1, 'big'))
-        chunk.append(byte)
-        if fingerprint & mask == cutValue:
-            hVal = hasher.digest()
-            pair = (hVal, length)
-            chunk_lst.append(pair)
-            # print(len(chunk_lst))
-            if pair not in chunk_dict:
-                chunk_dict[pair] = chunk
-            elif chunk_dict[pair] != chunk:
-                raise("ERROR NON MATCHING CHUNK")
-                print(pair)
-                print(chunk_dict[pair])
-                print(chunk)
-            hasher = hashlib.sha1()
-            length = 0
-            chunk = bytearray(b'')
-
-    hVal = hasher.digest()
-    pair = (hVal, length)
+    view = memoryview(data).cast('B')
+    selector = cutSelector(limits)
+    ends = []
+    with stage(stats, 'fingerprint'):
+        for start in range(0, len(view), tenMB):
+            if verbose:
+                print( "%5d MB: %s" % (start/oneMB, datetime.datetime.now()), flush=True )
+            block = view[start : start + tenMB]
+            if limits.smallMask == None:
+                large = fingerprinter.cut_points(block, limits.largeMask, cutValue) + start
+                small = large[:0]
+            else:
+                large, small = fingerprinter.cut_points(block, limits.largeMask, cutValue, limits.smallMask)
+                large += start
+                small += start
+            if limits.unconstrained:
+                ends.extend(large.tolist())
+            else:
+                ends.extend(selector.feed(small.tolist(), large.tolist(), start + len(block)))
+
+    with stage(stats, 'hash'):
+        return collect_chunks(view, ends, digest)
+
+def collect_chunks(data, ends, digest = DIGESTS['sha1']):
+    # Builds chunk_dict and chunk_lst from the cut offsets, with the rest of
+    # the data as the last chunk
+    view = memoryview(data).cast('B')
+    chunk_dict = {}
+    chunk_lst = []
+    start = 0
+    for end in ends + [len(view)]:
+        chunk = view[start : end]
+        add_chunk(chunk_dict, chunk_lst, digest(chunk), chunk)
+        start = end
+
+    return chunk_dict, chunk_lst
+
+def add_chunk(chunk_dict, chunk_lst, hVal, chunk):
+    pair = (hVal, len(chunk))
     chunk_lst.append(pair)
     if pair not in chunk_dict:
-        chunk_dict[pair] = chunk
+        chunk_dict[pair] = chunk.tobytes()
     elif chunk_dict[pair] != chunk:
-        raise("ERROR NON MATCHING CHUNK")
-        print(pair)
-        print(chunk_dict[pair])
-        print(chunk)
+        raise ValueError("ERROR NON MATCHING CHUNK")
+
+def chunk_segment(task):
+    # Pool worker for chunk_parallel().  Candidate cuts depend only on the
+    # last windowSize bytes, so priming the window with the windowSize - 1
+    # bytes before the segment finds exactly the serial candidates there.
+    # Which candidates become cuts depends on the previous cut, so the worker
+    # also selects cuts speculatively as if one fell at the segment start and
+    # hashes those chunks.  Once the serial cuts meet a speculative cut they
+    # coincide from there on (chunking resynchronizes), and the parent reuses
+    # the worker's hashes.
+    source, start, end, windowSize, fingerprintSize, limits, fingerprinterName, digestName = task
+    backend = fingerprinter_backend(fingerprinterName, windowSize, fingerprintSize)
+    readStart = max(0, start - backend.windowSize + 1)
+    if isinstance(source, str):
+        with open(source, 'rb') as f:
+            f.seek(readStart)
+            data = f.read(end - readStart)
+    else:
+        data = source
+    view = memoryview(data)
+    find_cuts = cut_finder(backend, limits, 1)
+    find_cuts(view[: start - readStart])
+    small, large = find_cuts(view[start - readStart :], start)
+    if limits.unconstrained:
+        cuts = [start] + large
+    else:
+        cuts = [start] + cutSelector(limits, start).feed(small, large, end)
+    digest = chunk_digest(digestName)
+    digests = b''.join(digest(view[a - readStart : b - readStart]) for a, b in zip(cuts, cuts[1:]))
+    return small, large, cuts, digests
+
+def chunk_parallel(data, fileName, windowSize, fingerprintSize, limits, processes, segmentSize, verbose=False,
+                   fingerprinterName = 'rabin', digestName = 'sha1'):
+    # Process-pool version of chunk().  Workers find the candidate cuts of
+    # one segment each and hash their speculative chunks; only the chunks
+    # before resynchronization (those straddling a seam) are hashed here.
+    view = memoryview(data).cast('B')
+    window = fingerprinter_backend(fingerprinterName, windowSize, fingerprintSize).windowSize
+    def tasks():
+        for start in range(0, len(view), segmentSize):
+            end = min(start + segmentSize, len(view))
+            if fileName != None:
+                source = fileName
+            else:
+                source = view[max(0, start - window + 1) : end].tobytes()
+            yield source, start, end, windowSize, fingerprintSize, limits, fingerprinterName, digestName
+
+    digest = chunk_digest(digestName)
+    chunk_dict = {}
+    chunk_lst = []
+    selector = cutSelector(limits)
+    start = 0
+    with multiprocessing.Pool(processes) as pool:
+        for segment, (small, large, cuts, digests) in enumerate(pool.imap(chunk_segment, tasks())):
+            if verbose:
+                print( "%5d MB: %s" % ((segment + 1) * segmentSize / (1024 * 1024), datetime.datetime.now()), flush=True )
+            speculative = {}
+            for i in range(len(cuts) - 1):
+                speculative[cuts[i]] = (cuts[i + 1], digests[DIGEST_FIELD_SIZE * i : DIGEST_FIELD_SIZE * (i + 1)])
+            if limits.unconstrained:
+                ends = large
+            else:
+                ends = selector.feed(small, large, min((segment + 1) * segmentSize, len(view)))
+            for end in ends:
+                chunk = view[start : end]
+                guess = speculative.get(start)
+                if guess != None and guess[0] == end:
+                    add_chunk(chunk_dict, chunk_lst, guess[1], chunk)
+                else:
+                    add_chunk(chunk_dict, chunk_lst, digest(chunk), chunk)
+                start = end
+    chunk = view[start:]
+    add_chunk(chunk_dict, chunk_lst, digest(chunk), chunk)
 
     return chunk_dict, chunk_lst
+
+def read_blocks(fileObject, blockSize):
+    # Yields successive blocks of fileObject, reusing one buffer when the
+    # file object supports readinto
+    if hasattr(fileObject, 'readinto'):
+        buf = bytearray(blockSize)
+        view = memoryview(buf)
+        while True:
+            n = fileObject.readinto(buf)
+            if not n:
+                break
+            yield view[:n]
+    else:
+        while True:
+            block = fileObject.read(blockSize)
+            if not block:
+                break
+            yield memoryview(block)
+
+def cut_finder(backend, limits, cutValue):
+    # Returns a function mapping successive blocks of a stream, the first
+    # at offset base, to the (small, large) candidate cut offsets in them;
+    # small is empty unless limits normalize chunk sizes
+    largeMask = limits.largeMask
+    smallMask = limits.smallMask
+    fingerprinter = backend.vector()
+    if fingerprinter is not None:
+        def find_cuts(block, base = 0):
+            if smallMask == None:
+                return [], (fingerprinter.cut_points(block, largeMask, cutValue) + base).tolist()
+            large, small = fingerprinter.cut_points(block, largeMask, cutValue, smallMask)
+            return (small + base).tolist(), (large + base).tolist()
+    else:
+        find_large = backend.block_cuts(largeMask, cutValue)
+        if smallMask != None:
+            find_small = backend.block_cuts(smallMask, cutValue)
+        def find_cuts(block, base = 0):
+            large = [c + base for c in find_large(block)]
+            if smallMask == None:
+                return [], large
+            return [c + base for c in find_small(block)], large
+    return find_cuts
+
+def chunk_stream(fileObject, windowSize = 3, fingerprintSize = 8, maskSize = 8, blockSize = 1 << 20,
+                 minSize = 0, maxSize = None, normalization = 0, normalSize = None, fingerprinterName = 'rabin',
+                 digestName = 'sha1'):
+    # Generator version of chunk(): reads fileObject in blocks of blockSize
+    # bytes and yields (offset, length, digest field) for each chunk as it is
+    # found.
+    # The rolling window and the hash of a partial chunk carry across blocks,
+    # so the records match chunk_lst from chunk() on the same bytes.
+    limits = chunkLimits(maskSize, minSize, maxSize, normalization, normalSize)
+    find_cuts = cut_finder(fingerprinter_backend(fingerprinterName, windowSize, fingerprintSize), limits, 1)
+    selector = cutSelector(limits)
+    digest = chunk_digest(digestName)
+
+    offset = 0
+    blockStart = 0
+    hasher = digest.new()
+    for block in read_blocks(fileObject, blockSize):
+        blockEnd = blockStart + len(block)
+        small, large = find_cuts(block, blockStart)
+        if limits.unconstrained:
+            ends = large
+        else:
+            ends = selector.feed(small, large, blockEnd)
+        start = max(offset, blockStart)
+        for end in ends:
+            hasher.update(block[start - blockStart : end - blockStart])
+            yield offset, end - offset, digest.field(hasher)
+            offset = end
+            hasher = digest.new()
+            start = end
+        hasher.update(block[start - blockStart :])
+        blockStart = blockEnd
+    yield offset, blockStart - offset, digest.field(hasher)
@@ -0,0 +1,388 @@
+#
+# chunk_server.py - Long-running encode/decode service over a Unix socket or
+#	localhost TCP, with the chunk store kept open between requests
+#
+# Copyright (C) 2019 Paul Lu, Owen Randall, <paullu@cs.ualberta.ca>
+#
+# Originally implemented by Owen Randall.
+#	Credits:  Owen Randall, Paul Lu
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Each connection carries one request: a JSON line, {"op": "encode"},
+# {"op": "decode"} or {"op": "stats"}, then for encode the file and for
+# decode its recipe, as frames of
+#   4-byte little-endian length | bytes
+# ended by an empty frame.  The reply is a JSON line, {"error": message} if
+# the request failed, then for encode the recipe and for decode the file,
+# framed the same way.
+# The server opens the store once, as encode.py would, and
+#  - chunks uploads in a process pool, several at a time,
+#  - adds their chunks and writes their recipes in one writer task, in the
+#    order the uploads finish chunking, flushing the store after each,
+#  - runs every store call on one store thread, so reads for restores
+#    interleave with the writer's appends but never run alongside them.
+# An upload is chunked as a whole, so it is held in memory like a file
+# given to encode().  With --read-only the server opens the store as
+# decode.py does, without writing it, and refuses uploads.
+import os
+import io
+import sys
+import stat
+import json
+import struct
+import signal
+import asyncio
+import argparse
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from container_store import open_store
+from encode import get_chunk_info, chunk_data, add_verified, write_encoded, add_chunk_arguments, chunk_options
+from fingerprint_index import fingerprintIndex
+from chunk_delta import deltaStore
+from chunk_cache import cachedStore, cache_option
+from chunk_digest import chunk_digest
+from chunk_file import chunk_parameters
+from recipe import read_recipe, is_recipe, RECIPE_VERSION, RECIPE_HEADER
+from decode import check_size
+
+FRAME = struct.Struct('<I')
+FRAME_SIZE = 1 << 20
+FETCH_RECORDS = 4096 # chunks read per store thread call for a restore
+
+async def read_frames(reader):
+    parts = []
+    while True:
+        length = FRAME.unpack(await reader.readexactly(FRAME.size))[0]
+        if length == 0:
+            return b''.join(parts)
+        parts.append(await reader.readexactly(length))
+
+def write_frames(writer, data):
+    # Frames data, without the empty frame that ends it
+    data = memoryview(data)
+    for start in range(0, len(data), FRAME_SIZE):
+        block = data[start : start + FRAME_SIZE]
+        writer.write(FRAME.pack(len(block)))
+        writer.write(block)
+
+def write_end(writer):
+    writer.write(FRAME.pack(0))
+
+def write_message(writer, message):
+    writer.write(json.dumps(message).encode() + b'\n')
+
+async def read_message(reader):
+    line = await reader.readline()
+    if not line:
+        raise ConnectionError("connection closed")
+    return json.loads(line)
+
+def recipe_records(recipe):
+    # Chunk IDs of a version 2 or 3 recipe, else the 23-byte keys of version 1
+    if is_recipe(recipe):
+        return read_recipe(recipe)[2]
+    return [recipe[i : i + 23] for i in range(0, len(recipe), 23)]
+
+class chunkServer:
+    # The keyword arguments are those of encode.encode(), less stats.  A
+    # readOnly server opens the store read-only and only serves decodes,
+    # picking up the chunks other writers add before each.
+    def __init__(self, commonFile, processes = 1, cache = None, recipeVersion = RECIPE_VERSION, compression = None,
+                 containerSize = None, useFingerprintIndex = False, delta = False, readOnly = False, **chunkOptions):
+        self.pool = ProcessPoolExecutor(max(processes, 1))
+        self.storeThread = ThreadPoolExecutor(1)
+        self.readOnly = readOnly
+        if readOnly:
+            try:
+                store = open_store(commonFile, readOnly = True)
+            except OSError:
+                print( "File open/read failed: %s" % (commonFile) )
+                sys.exit(-1)
+        else:
+            store = get_chunk_info(commonFile, compression, containerSize)
+        self.baseStore = store
+        if useFingerprintIndex and not readOnly:
+            store = fingerprintIndex(store)
+        if delta and not readOnly:
+            store = deltaStore(store, commonFile + '.sim')
+        if cache != None:
+            store = cachedStore(store, cache)
+        self.store = store
+        self.cache = cache
+        self.recipeVersion = recipeVersion
+        self.chunkOptions = chunkOptions
+        self.parameters = chunk_parameters(chunkOptions)
+        self.verify = chunk_digest(chunkOptions.get('digestName', 'sha1')).verify
+        self.queue = None
+        self.encoded = 0
+        self.decoded = 0
+        self.uploadBytes = 0
+        self.restoreBytes = 0
+
+    def commit(self, keys, chunks, fileSize):
+        # On the store thread: stores the new chunks of an upload and returns
+        # its recipe
+        counter = len(self.store)
+        for key, chunk in chunks:
+            add_verified(self.store, key, chunk, self.verify)
+        recipe = io.BytesIO()
+        write_encoded(recipe, keys, fileSize, self.store, self.recipeVersion, self.parameters)
+        self.store.flush()
+        return recipe.getvalue(), len(self.store) - counter
+
+    def fetch(self, records):
+        # On the store thread
+        return [bytes(self.store[record]) for record in records]
+
+    def check(self, records):
+        # On the store thread: raises KeyError unless every chunk is stored,
+        # so a restore fails before its reply starts
+        if self.readOnly:
+            self.baseStore.update()
+        count = len(self.store)
+        for record in records:
+            if isinstance(record, int):
+                if record >= count:
+                    raise KeyError(record)
+            elif record not in self.store:
+                raise KeyError(bytes(record).hex())
+
+    async def writer(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            keys, chunks, fileSize, future = await self.queue.get()
+            try:
+                result = await loop.run_in_executor(self.storeThread, self.commit, keys, chunks, fileSize)
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                if not future.done():
+                    future.set_result(result)
+            self.queue.task_done()
+
+    async def handle(self, reader, writer):
+        try:
+            try:
+                request = await read_message(reader)
+            except ValueError:
+                request = None
+            op = request.get('op') if isinstance(request, dict) else None
+            if op == 'encode':
+                await self.handle_encode(reader, writer)
+            elif op == 'decode':
+                await self.handle_decode(reader, writer)
+            elif op == 'stats':
+                write_message(writer, self.stats())
+            else:
+                write_message(writer, {'error': "unknown request %r" % (op,)})
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def handle_encode(self, reader, writer):
+        loop = asyncio.get_running_loop()
+        data = await read_frames(reader)
+        if self.readOnly:
+            write_message(writer, {'error': "ERROR THE STORE IS OPEN READ-ONLY"})
+            return
+        keys, chunks = await loop.run_in_executor(self.pool, chunk_data, data, self.chunkOptions, self.store.key_size)
+        future = loop.create_future()
+        await self.queue.put((keys, chunks, len(data), future))
+        try:
+            recipe, added = await future
+        except (ValueError, KeyError) as e:
+            write_message(writer, {'error': str(e)})
+            return
+        self.encoded += 1
+        self.uploadBytes += len(data)
+        write_message(writer, {'bytes': len(data), 'chunks': len(keys), 'newChunks': added})
+        write_frames(writer, recipe)
+        write_end(writer)
+
+    async def handle_decode(self, reader, writer):
+        loop = asyncio.get_running_loop()
+        recipe = await read_frames(reader)
+        try:
+            records = recipe_records(recipe)
+            await loop.run_in_executor(self.storeThread, self.check, records)
+        except (ValueError, KeyError) as e:
+            write_message(writer, {'error': "ERROR BAD RECIPE %s" % e})
+            return
+        write_message(writer, {'chunks': len(records)})
+        start = 0
+        size = 0
+        while start < len(records):
+            # Each batch is sent before the next is read
+            end = min(start + FETCH_RECORDS, len(records))
+            chunks = await loop.run_in_executor(self.storeThread, self.fetch, records[start : end])
+            for chunk in chunks:
+                write_frames(writer, chunk)
+                size += len(chunk)
+            await writer.drain()
+            start = end
+        write_end(writer)
+        self.decoded += 1
+        self.restoreBytes += size
+
+    def stats(self):
+        stats = {'chunks': len(self.store), 'encoded': self.encoded, 'decoded': self.decoded,
+                 'uploadBytes': self.uploadBytes, 'restoreBytes': self.restoreBytes,
+                 'pendingUploads': self.queue.qsize() if self.queue != None else 0}
+        if self.cache != None:
+            stats['cache'] = self.cache.stats()
+        return stats
+
+    async def serve(self, address):
+        # address is a Unix socket path or a localhost TCP port.  Serves
+        # until SIGTERM or SIGINT, then closes the store.
+        loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue()
+        writerTask = asyncio.create_task(self.writer())
+        if isinstance(address, int):
+            server = await asyncio.start_server(self.handle, '127.0.0.1', address)
+        else:
+            if os.path.exists(address) and stat.S_ISSOCK(os.stat(address).st_mode):
+                os.remove(address)
+            server = await asyncio.start_unix_server(self.handle, address)
+        stop = loop.create_future()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, stop.cancel)
+        try:
+            async with server:
+                await stop
+        except asyncio.CancelledError:
+            pass
+        finally:
+            # Uploads already queued are committed before the store closes
+            await self.queue.join()
+            writerTask.cancel()
+            await loop.run_in_executor(self.storeThread, self.store.close)
+            self.storeThread.shutdown()
+            self.pool.shutdown()
+            if not isinstance(address, int):
+                os.remove(address)
+
+async def open_connection(address):
+    if isinstance(address, int):
+        return await asyncio.open_connection('127.0.0.1', address)
+    return await asyncio.open_unix_connection(address)
+
+async def send_file(writer, fileObject):
+    while True:
+        block = fileObject.read(FRAME_SIZE)
+        if not block:
+            break
+        write_frames(writer, block)
+        await writer.drain()
+    write_end(writer)
+    await writer.drain()
+
+async def read_reply(reader):
+    reply = await read_message(reader)
+    if 'error' in reply:
+        raise ValueError(reply['error'])
+    return reply
+
+async def encode_remote(address, inputFile, outputFile):
+    # Uploads inputFile and writes its recipe to outputFile.  Returns the
+    # server's reply.
+    reader, writer = await open_connection(address)
+    try:
+        write_message(writer, {'op': 'encode'})
+        with open(inputFile, 'rb') as f:
+            await send_file(writer, f)
+        reply = await read_reply(reader)
+        recipe = await read_frames(reader)
+    finally:
+        writer.close()
+    with open(outputFile, 'wb') as f:
+        f.write(recipe)
+    return reply
+
+async def decode_remote(address, inputFile, outputFile):
+    # Sends the recipe in inputFile and writes the restored file to outputFile
+    reader, writer = await open_connection(address)
+    size = 0
+    try:
+        write_message(writer, {'op': 'decode'})
+        with open(inputFile, 'rb') as f:
+            head = f.read(RECIPE_HEADER.size)
+            f.seek(0)
+            await send_file(writer, f)
+        reply = await read_reply(reader)
+        with open(outputFile, 'wb') as f:
+            while True:
+                length = FRAME.unpack(await reader.readexactly(FRAME.size))[0]
+                if length == 0:
+                    break
+                f.write(await reader.readexactly(length))
+                size += length
+    finally:
+        writer.close()
+    if is_recipe(head):
+        check_size(inputFile, size, RECIPE_HEADER.unpack(head)[3])
+    return reply
+
+async def stats_remote(address):
+    reader, writer = await open_connection(address)
+    try:
+        write_message(writer, {'op': 'stats'})
+        await writer.drain()
+        return await read_reply(reader)
+    finally:
+        writer.close()
+
+def server_address(args):
+    if args.socket != None:
+        return args.socket
+    return args.port
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Serve encode and decode requests against one chunk store, or send them")
+    commands = parser.add_subparsers(dest = 'command', required = True)
+    serve = commands.add_parser('serve', help = "keep the store open and serve requests")
+    serve.add_argument("commonFile", nargs = '?', default = 'chunks.data')
+    add_chunk_arguments(serve)
+    serve.add_argument("--read-only", action = 'store_true', help = "open the store read-only and serve decodes only")
+    encodeCommand = commands.add_parser('encode', help = "upload INPUT and write INPUT.encoded")
+    encodeCommand.add_argument("input")
+    decodeCommand = commands.add_parser('decode', help = "restore INPUT.decoded from INPUT.encoded")
+    decodeCommand.add_argument("input")
+    statsCommand = commands.add_parser('stats', help = "print the server's counters")
+    for command in (serve, encodeCommand, decodeCommand, statsCommand):
+        command.add_argument("--socket", default = None, help = "Unix socket path")
+        command.add_argument("--port", type = int, default = 7823, help = "localhost TCP port, without --socket")
+    args = parser.parse_args()
+    address = server_address(args)
+    if args.command == 'serve':
+        server = chunkServer(args.commonFile, processes = args.processes, recipeVersion = args.recipe_version,
+                             compression = args.compression, containerSize = args.container_size,
+                             useFingerprintIndex = args.fingerprint_index, delta = args.delta, readOnly = args.read_only,
+                             cache = cache_option(args), **chunk_options(args))
+        asyncio.run(server.serve(address))
+    else:
+        try:
+            if args.command == 'encode':
+                reply = asyncio.run(encode_remote(address, args.input, args.input + ".encoded"))
+            elif args.command == 'decode':
+                reply = asyncio.run(decode_remote(address, args.input + ".encoded", args.input + ".decoded"))
+            else:
+                reply = asyncio.run(stats_remote(address))
+        except (OSError, ValueError) as e:
+            print( "Request failed: %s" % (e) )
+            sys.exit(-1)
+        print(reply)
@@ -0,0 +1,165 @@
+#
+# chunk_stats.py - Counters, stage timings and optional profiles collected
+#	by chunk(), encode() and decode_to_file()
+#
+# Copyright (C) 2019 Paul Lu, Owen Randall, <paullu@cs.ualberta.ca>
+#
+# Originally implemented by Owen Randall.
+#	Credits:  Owen Randall, Paul Lu
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Pass a chunkStats as stats= to chunk(), encode() or decode_to_file() and
+# it collects
+#   bytes and chunks, with a power-of-two chunk size histogram
+#   new and duplicate chunks (encode), for the dedup hit rate
+#   seconds per stage: read, fingerprint, hash, chunk (parallel chunking,
+#   where fingerprint and hash are in the workers), store and recipe for
+#   encode; recipe, fetch and write for decode
+# callback(stats, stage, seconds) is called as each stage ends.  With
+# profile, each stage also gets its own cProfile profile, and with
+# traceMemory its tracemalloc peak and a snapshot at its end.  Without
+# stats the pipeline only tests stats for None, once per stage.
+import os
+import time
+import cProfile
+import tracemalloc
+from contextlib import nullcontext
+
+NO_STAGE = nullcontext()
+
+class stageTimer:
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+
+    def __enter__(self):
+        stats = self.stats
+        # Profilers do not nest, so only the outermost stage is profiled
+        self.outermost = stats.depth == 0
+        stats.depth += 1
+        if self.outermost and stats.profile:
+            if self.name not in stats.profiles:
+                stats.profiles[self.name] = cProfile.Profile()
+            stats.profiles[self.name].enable()
+        if self.outermost and stats.traceMemory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self.start
+        stats = self.stats
+        stats.depth -= 1
+        if self.outermost and stats.profile:
+            stats.profiles[self.name].disable()
+        if self.outermost and stats.traceMemory:
+            peak = tracemalloc.get_traced_memory()[1]
+            stats.memoryPeaks[self.name] = max(peak, stats.memoryPeaks.get(self.name, 0))
+            stats.snapshots[self.name] = tracemalloc.take_snapshot()
+        stats.seconds[self.name] = stats.seconds.get(self.name, 0) + seconds
+        if stats.callback != None:
+            stats.callback(stats, self.name, seconds)
+        return False
+
+class chunkStats:
+    def __init__(self, callback = None, profile = False, traceMemory = False):
+        self.callback = callback
+        self.profile = profile
+        self.traceMemory = traceMemory
+        self.bytes = 0
+        self.chunks = 0
+        self.newChunks = 0
+        self.duplicateChunks = 0
+        self.sizes = {} # lowest size of a power-of-two class -> chunks in it
+        self.seconds = {} # stage -> seconds
+        self.profiles = {} # stage -> cProfile.Profile
+        self.memoryPeaks = {} # stage -> peak traced bytes
+        self.snapshots = {} # stage -> tracemalloc snapshot at its last end
+        self.depth = 0
+
+    def stage(self, name):
+        return stageTimer(self, name)
+
+    def add_chunks(self, lengths):
+        sizes = self.sizes
+        for length in lengths:
+            self.bytes += length
+            self.chunks += 1
+            low = 1 << (length.bit_length() - 1) if length > 0 else 0
+            sizes[low] = sizes.get(low, 0) + 1
+
+    def add_dedup(self, new, total):
+        # new of total chunks were not in the store yet
+        self.newChunks += new
+        self.duplicateChunks += total - new
+
+    def timed(self, iterable, name):
+        # Yields the items of iterable, timing the production of each as stage name
+        iterator = iter(iterable)
+        end = object()
+        while True:
+            with self.stage(name):
+                item = next(iterator, end)
+            if item is end:
+                return
+            yield item
+
+    def dedup_hit_rate(self):
+        total = self.newChunks + self.duplicateChunks
+        return self.duplicateChunks / total if total else 0.0
+
+    def as_dict(self):
+        totalSeconds = sum(self.seconds.values())
+        return {'bytes': self.bytes, 'chunks': self.chunks, 'newChunks': self.newChunks,
+                'duplicateChunks': self.duplicateChunks, 'dedupHitRate': self.dedup_hit_rate(),
+                'sizeHistogram': {str(low): self.sizes[low] for low in sorted(self.sizes)},
+                'seconds': dict(self.seconds),
+                'MBps': self.bytes / totalSeconds / (1 << 20) if totalSeconds > 0 else None,
+                'memoryPeaks': dict(self.memoryPeaks)}
+
+    def report(self):
+        lines = ["%d bytes, %d chunks" % (self.bytes, self.chunks)]
+        if self.newChunks + self.duplicateChunks:
+            lines.append("%d new, %d duplicate chunks (dedup hit rate %.3f)" %
+                         (self.newChunks, self.duplicateChunks, self.dedup_hit_rate()))
+        for name, seconds in self.seconds.items():
+            line = "%-12s %10.3f s" % (name, seconds)
+            if name in self.memoryPeaks:
+                line += " %10.1f MB peak traced" % (self.memoryPeaks[name] / (1 << 20))
+            lines.append(line)
+        if self.sizes:
+            lines.append("sizes: " + ", ".join("%d+: %d" % (low, self.sizes[low]) for low in sorted(self.sizes)))
+        return "\n".join(lines)
+
+    def dump_profiles(self, directory):
+        # Writes STAGE.prof for each profiled stage, for pstats or snakeviz
+        os.makedirs(directory, exist_ok = True)
+        for name, profile in self.profiles.items():
+            profile.dump_stats(os.path.join(directory, name + ".prof"))
+
+    def dump_snapshots(self, directory):
+        # Writes STAGE.tracemalloc for each stage, for tracemalloc.Snapshot.load
+        os.makedirs(directory, exist_ok = True)
+        for name, snapshot in self.snapshots.items():
+            snapshot.dump(os.path.join(directory, name + ".tracemalloc"))
+
+def stage(stats, name):
+    # stats.stage(name), or a context that does nothing without stats
+    if stats == None:
+        return NO_STAGE
+    return stats.stage(name)
@@ -0,0 +1,726 @@
+#
+# chunk_store.py - chunks.data with a persistent hash index, read through mmap
+#
+# Copyright (C) 2019 Paul Lu, Owen Randall, <paullu@cs.ualberta.ca>
+#
+# Originally implemented by Owen Randall.
+#	Credits:  Owen Randall, Paul Lu
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# New stores are written in format version 5, whose records are
+#   20-byte digest field | 8-byte length | CRC | method | 8-byte stored length | stored bytes
+# after a DATA_HEADER.  The CRC-32 covers the rest of the record, and
+# method (one of COMPRESSORS) is chosen per chunk: a chunk that does not
+# shrink is stored raw, as method 0, and chunk_delta stores near duplicates
+# as method DELTA_METHOD.  Older stores are still read and appended to in
+# their own format: the original headerless layout, a stream of
+#   20-byte SHA-1 | 3-byte big-endian length | chunk bytes
+# records, and the compressing versions 2 and 4, whose records are
+#   20-byte SHA-1 | 3-byte length | CRC | method | 3-byte stored length | stored bytes
+# (version 2 has no CRC).  Their 3-byte lengths limit chunks to 16 MB;
+# migrate_store.py rewrites them as version 5, keeping their chunk IDs.
+# A chunk's key is its digest field and length, in the store's widths.
+# The store adds chunks.data.idx, an open-addressing hash table of 8-byte
+# slots, each holding a 24-bit tag of a key and the chunk's integer ID, its
+# position among the distinct chunks of chunks.data.  After the table comes
+# an array of 64-bit chunk offsets indexed by ID, for recipes that name
+# chunks by ID and for the key stored before each record, which confirms a
+# tag match.  The table doubles when 70% full, so a chunk costs 8 bytes
+# over a load of 35 to 70% plus its 8-byte offset: 19 to 31 bytes for up to
+# 2^40 chunks, not the few bytes of a minimal index.  That is the price of
+# 64-bit offsets, which chunks.data needs past 4 GB, and of the tag: a
+# slot of just the ID would read a key from chunks.data for every occupied
+# slot a lookup probes, where the tag leaves one read in 16 million for a
+# chunk that is not stored.  Memory is a smaller concern, as only the pages
+# probed are read; fingerprint_index keeps about 1.5 bytes per chunk in
+# memory in front of the index.
+# Both files are memory-mapped, so opening the store only reads the index
+# header, lookups probe a few slots and chunk reads are memoryview slices.
+# Writers append under an exclusive flock on chunks.data, so several
+# processes can share a store: each takes the lock per add (a
+# containerStore for as long as it has a container open), first picking up
+# the records others appended, and chunk IDs are handed out under it.  The
+# data is fsynced every syncBytes appended and on flush, a group commit
+# rather than one fsync per chunk, and the index header records how many
+# bytes have been fsynced.  Encoders flush the store before writing a
+# recipe, so those bytes bound the chunk IDs any recipe can name.  A writer
+# that dies mid-append leaves a torn record at the end of chunks.data; the
+# next store to take the lock finds it past the indexed bytes, as a short
+# record or a CRC mismatch, and truncates from it if it is past the synced
+# bytes, so no ID a recipe names is handed out again.  A bad record below
+# them is corruption and raises ValueError, as does one found rebuilding an
+# index that did not record them, unless it runs past the end of the file.
+import os
+import mmap
+import struct
+import zlib
+import lzma
+import bz2
+from collections import OrderedDict
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+from chunk_delta import apply_delta, DELTA_METHOD, DELTA_HEADER, DELTA_HEADER64
+from chunk_digest import DIGEST_FIELD_SIZE
+
+KEY_SIZE = 23 # digest field and 3-byte length
+KEY_SIZE64 = 28 # digest field and 8-byte length, in version 5 stores
+INDEX_MAGIC = b'RFIX'
+INDEX_VERSION = 4
+INDEX_HEADER = struct.Struct('<4sIQQQQ') # magic, version, slots, count, bytes of chunks.data indexed, fsynced
+INDEX_SLOT = struct.Struct('<Q') # key tag << ID_BITS | chunk ID + 1, or 0 if empty
+INDEX_ID = struct.Struct('<Q') # offset of the chunk bytes, one per chunk ID
+ID_BITS = 40
+MAX_CHUNKS = (1 << ID_BITS) - 1
+MIN_SLOTS = 1 << 12
+DATA_MAGIC = b'RFCD'
+DATA_VERSION = 5 # 2 has no CRCs, 4 has 3-byte lengths; 3 and 6 are container_stores
+DATA_HEADER = struct.Struct('<4sII') # magic, version, default compression method
+ENTRY_SIZE = 4 # method and 3-byte stored length, after the key
+ENTRY_SIZE64 = 9 # method and 8-byte stored length, in version 5 stores
+CRC_SIZE = 4 # CRC-32 of a record, between its key and its method
+SYNC_BYTES = 16 << 20
+
+# method number -> (name, compress, decompress)
+COMPRESSORS = {
+    0: ('none', None, None),
+    1: ('zlib', zlib.compress, zlib.decompress),
+    2: ('lzma', lzma.compress, lzma.decompress),
+    3: ('bz2', bz2.compress, bz2.decompress),
+}
+COMPRESSION_METHODS = dict((name, method) for method, (name, compress, decompress) in COMPRESSORS.items())
+
+class chunkStore:
+    # compression names the COMPRESSORS method for chunks added from now on,
+    # by default the one the store was created with, none for a new or empty
+    # store unless given.  Appended data is fsynced every syncBytes bytes and
+    # on flush().  A readOnly store writes neither file: it takes the lock
+    # shared, and indexes in memory what chunks.data.idx does not cover.
+    def __init__(self, fileName, create = True, indexFileName = None, compression = None, syncBytes = SYNC_BYTES,
+                 readOnly = False):
+        self.fileName = fileName
+        self.indexFileName = indexFileName if indexFileName != None else fileName + '.idx'
+        self.readOnly = readOnly
+        if create and not readOnly and not os.path.exists(fileName):
+            open(fileName, 'ab').close()
+        self.data_file = open(fileName, 'rb')
+        self.data_map = None
+        self.data_view = memoryview(b'')
+        self.writer = None
+        self.index_map = None
+        self.locks = 0
+        self.appendLock = storeLock(self)
+        self.syncBytes = syncBytes
+        self.unsynced = 0
+        self.lookups = 0 # of keys in the index, by lookup() and id_of()
+        method = COMPRESSION_METHODS[compression or 'none']
+        with self.appendLock:
+            self.data_size = os.fstat(self.data_file.fileno()).st_size
+            if self.data_size == 0 and not readOnly:
+                with open(fileName, 'ab') as f:
+                    f.write(DATA_HEADER.pack(DATA_MAGIC, DATA_VERSION, method))
+                self.data_size = DATA_HEADER.size
+        self.read_data_header()
+        if compression != None:
+            self.method = method
+        if self.method != 0 and self.entry_size == 0:
+            raise ValueError("ERROR %s IS AN UNCOMPRESSED STORE" % fileName)
+        self.remap()
+        self.open_index()
+
+    def read_data_header(self):
+        # Sets data_start, the offset of the first record, the widths of a
+        # record's fields and method
+        header = self.data_file.read(DATA_HEADER.size)
+        self.data_file.seek(0)
+        if len(header) == DATA_HEADER.size and header[:4] == DATA_MAGIC:
+            magic, version, self.method = DATA_HEADER.unpack(header)
+            if version not in (2, 4, DATA_VERSION) or self.method not in COMPRESSORS:
+                raise ValueError("ERROR UNKNOWN CHUNK STORE FORMAT %d" % version)
+            self.data_start = DATA_HEADER.size
+            self.checksummed = version != 2
+            self.set_widths(version == DATA_VERSION, True)
+        else:
+            self.data_start = 0
+            self.checksummed = False
+            self.method = 0
+            self.set_widths(False, False)
+
+    def set_widths(self, wide, entries):
+        # key_size, the bytes of a key; length_size, of a stored length; and
+        # entry_size, the bytes between a record's key and its stored bytes
+        self.key_size = KEY_SIZE64 if wide else KEY_SIZE
+        self.length_size = 8 if wide else 3
+        self.delta_header = DELTA_HEADER64 if wide else DELTA_HEADER
+        self.entry_size = 0
+        if entries:
+            self.entry_size = ENTRY_SIZE64 if wide else ENTRY_SIZE
+        if self.checksummed:
+            self.entry_size += CRC_SIZE
+
+    def open_index(self):
+        with self.appendLock:
+            self.load_index()
+
+    def load_index(self):
+        # Under the lock: opens chunks.data.idx, rebuilding it if it is stale,
+        # and indexes the records appended since it was last written.  A
+        # read-only store does both in a private copy.
+        self.data_size = os.fstat(self.data_file.fileno()).st_size
+        self.seen_size = self.data_size
+        synced = None
+        if os.path.exists(self.indexFileName):
+            self.map_index()
+            magic, version, self.slots, self.count, indexed, self.synced = INDEX_HEADER.unpack_from(self.index_map, 0)
+            current = magic == INDEX_MAGIC and version == INDEX_VERSION
+            if not current or indexed > self.data_size:
+                # Stale or foreign index, rebuilt below.  The synced bytes of
+                # a current one still hold, as they were fsynced first.
+                if current:
+                    synced = min(self.synced, self.data_size)
+                self.close_index()
+                if not self.readOnly:
+                    os.remove(self.indexFileName)
+            elif self.readOnly and indexed < self.data_size:
+                file_map = self.index_map
+                self.index_map = mmap.mmap(-1, len(file_map))
+                self.index_map[:] = file_map[:]
+                file_map.close()
+                self.index_file.close()
+                self.index_file = None
+        if self.index_map == None:
+            # Until the rebuild ends, all of chunks.data counts as synced
+            if self.readOnly:
+                self.index_map = mmap.mmap(-1, index_size(MIN_SLOTS))
+                INDEX_HEADER.pack_into(self.index_map, 0, INDEX_MAGIC, INDEX_VERSION, MIN_SLOTS, 0, 0, self.data_size)
+                self.index_file = None
+            else:
+                create_index(self.indexFileName, MIN_SLOTS, self.data_size)
+                self.map_index()
+            magic, version, self.slots, self.count, indexed, self.synced = INDEX_HEADER.unpack_from(self.index_map, 0)
+            self.synced = synced
+        if indexed < self.data_size:
+            # Records appended by other writers or without going through the
+            # store, or a torn tail
+            self.scan(indexed)
+        if self.synced == None:
+            # Not knowing what was fsynced, every record found may be named
+            # by a recipe
+            self.synced = self.data_size
+            self.write_header()
+
+    def map_index(self):
+        if self.readOnly:
+            self.index_file = open(self.indexFileName, 'rb')
+            self.index_map = mmap.mmap(self.index_file.fileno(), 0, access = mmap.ACCESS_READ)
+        else:
+            self.index_file = open(self.indexFileName, 'r+b')
+            self.index_map = mmap.mmap(self.index_file.fileno(), 0)
+
+    def refresh(self):
+        # Under the lock: catches up with the records other writers appended
+        size = os.fstat(self.data_file.fileno()).st_size
+        if self.index_file == None:
+            # A read-only store's private index, rebuilt once chunks.data grows
+            if size != self.seen_size:
+                self.close_index()
+                self.load_index()
+            return
+        magic, version, slots, count, indexed, synced = INDEX_HEADER.unpack_from(self.index_map, 0)
+        if magic != INDEX_MAGIC or indexed > size or self.readOnly and indexed < size:
+            # Another writer resized the index into a new file, or it is
+            # stale, or records it does not cover need a private index
+            self.close_index()
+            self.load_index()
+            return
+        self.count = count
+        self.synced = synced
+        if indexed == size and size == self.data_size:
+            return
+        self.data_size = size
+        if indexed < size:
+            self.scan(indexed)
+
+    def update(self):
+        # Catches up with other writers, as taking the lock does
+        with self.appendLock:
+            pass
+
+    def close_index(self):
+        self.index_map.close()
+        if self.index_file != None:
+            self.index_file.close()
+        self.index_map = None
+
+    def lock(self):
+        # Takes the exclusive lock on chunks.data, shared if read-only,
+        # re-entrantly, and catches up with other writers when first taken
+        self.locks += 1
+        if self.locks > 1:
+            return
+        if fcntl != None:
+            fcntl.flock(self.data_file.fileno(), fcntl.LOCK_SH if self.readOnly else fcntl.LOCK_EX)
+        if self.index_map != None:
+            self.refresh()
+
+    def unlock(self):
+        self.locks -= 1
+        if self.locks > 0:
+            return
+        if self.writer != None:
+            self.writer.flush()
+        if fcntl != None:
+            fcntl.flock(self.data_file.fileno(), fcntl.LOCK_UN)
+
+    def scan(self, start):
+        self.remap()
+        byteIndex = max(start, self.data_start)
+        keySize = self.key_size
+        while byteIndex < self.data_size:
+            offset = byteIndex + keySize + self.entry_size
+            short = offset > self.data_size
+            if not short:
+                key = bytes(self.data_view[byteIndex : byteIndex + keySize])
+                length = self.stored_length(key, offset)
+                short = offset + length > self.data_size
+            if short or not self.record_ok(self.data_view, offset):
+                self.bad_record(byteIndex, short)
+                break
+            self.insert(key, offset)
+            byteIndex = offset + length
+        self.write_header()
+
+    def bad_record(self, pos, short):
+        # Under the lock: the record at byte pos is short or fails its CRC.
+        # Truncated if it is the torn tail of an append that was never
+        # fsynced, so no recipe names its chunk or any after it; left for a
+        # writer to truncate by a read-only store.
+        if self.synced == None and not short or self.synced != None and pos < self.synced:
+            raise ValueError("ERROR CORRUPT RECORD AT BYTE %d OF %s" % (pos, self.fileName))
+        if self.readOnly:
+            self.data_size = pos
+        else:
+            self.truncate(pos)
+
+    def truncate(self, size):
+        # Under the lock: drops a torn tail of chunks.data
+        print( "Torn record at byte %d of %s, truncated" % (size, self.fileName) )
+        try:
+            os.truncate(self.fileName, size)
+        except OSError:
+            print( "File truncate failed: %s" % (self.fileName) )
+        self.data_size = size
+
+    def record_ok(self, buf, offset):
+        # False if the CRC of the record whose stored bytes start at offset
+        # does not match
+        if not self.checksummed:
+            return True
+        start = offset - self.entry_size - self.key_size
+        end = offset + int.from_bytes(buf[offset - self.length_size : offset], 'big')
+        entry = offset - self.length_size - 1
+        crc = int.from_bytes(buf[entry - CRC_SIZE : entry], 'little')
+        return zlib.crc32(buf[entry : end], zlib.crc32(buf[start : start + self.key_size])) == crc
+
+    def compressed(self):
+        # True if records can hold compressed chunks
+        return self.entry_size != 0
+
+    def stored_length(self, key, offset):
+        if self.entry_size == 0:
+            return int.from_bytes(key[DIGEST_FIELD_SIZE:], 'big')
+        return int.from_bytes(self.data_view[offset - self.length_size : offset], 'big')
+
+    def remap(self):
+        if self.writer != None:
+            self.writer.flush()
+        size = os.fstat(self.data_file.fileno()).st_size
+        if size > 0:
+            # Views handed out earlier keep the old mapping alive
+            self.data_map = mmap.mmap(self.data_file.fileno(), size, access = mmap.ACCESS_READ)
+            self.data_view = memoryview(self.data_map)
+
+    def find_slot(self, key):
+        # Returns (position, chunk ID, offset) of the slot holding key, or
+        # (position of the empty slot where it would go, None, None).  A
+        # slot whose tag matches is confirmed against the key of its chunk.
+        start, tag = slot_hash(key)
+        mask = self.slots - 1
+        i = start & mask
+        index_map = self.index_map
+        idsStart = self.ids_start()
+        while True:
+            pos = INDEX_HEADER.size + i * INDEX_SLOT.size
+            slot = INDEX_SLOT.unpack_from(index_map, pos)[0]
+            if slot == 0:
+                return pos, None, None
+            # IDs from count on are left by an insert cut short
+            if slot >> ID_BITS == tag and slot & MAX_CHUNKS <= self.count:
+                chunkId = (slot & MAX_CHUNKS) - 1
+                offset = INDEX_ID.unpack_from(index_map, idsStart + chunkId * INDEX_ID.size)[0]
+                if self.key_at(offset) == key:
+                    return pos, chunkId, offset
+            i = (i + 1) & mask
+
+    def insert(self, key, offset):
+        if (self.count + 1) * 10 > self.slots * 7:
+            self.resize(self.slots * 2)
+        pos, chunkId, oldOffset = self.find_slot(key)
+        if chunkId != None:
+            return False
+        if self.count >= MAX_CHUNKS:
+            raise ValueError("ERROR TOO MANY CHUNKS IN %s" % self.fileName)
+        INDEX_ID.pack_into(self.index_map, self.ids_start() + self.count * INDEX_ID.size, offset)
+        INDEX_SLOT.pack_into(self.index_map, pos, slot_hash(key)[1] << ID_BITS | self.count + 1)
+        self.count += 1
+        return True
+
+    def ids_start(self):
+        return INDEX_HEADER.size + self.slots * INDEX_SLOT.size
+
+    def offset_of(self, chunkId):
+        return INDEX_ID.unpack_from(self.index_map, self.ids_start() + chunkId * INDEX_ID.size)[0]
+
+    def resize(self, slots):
+        # Slots do not hold whole keys, so each chunk's key is read back, in
+        # ID order, which is the order of chunks.data
+        tmpFileName = self.indexFileName + '.tmp'
+        if self.index_file == None:
+            new_map = mmap.mmap(-1, index_size(slots))
+        else:
+            create_index(tmpFileName, slots, self.synced_bytes())
+            with open(tmpFileName, 'r+b') as f:
+                new_map = mmap.mmap(f.fileno(), 0)
+        mask = slots - 1
+        for chunkId in range(self.count):
+            start, tag = slot_hash(self.key_of(chunkId))
+            j = start & mask
+            while INDEX_SLOT.unpack_from(new_map, INDEX_HEADER.size + j * INDEX_SLOT.size)[0]:
+                j = (j + 1) & mask
+            INDEX_SLOT.pack_into(new_map, INDEX_HEADER.size + j * INDEX_SLOT.size, tag << ID_BITS | chunkId + 1)
+        newIdsStart = INDEX_HEADER.size + slots * INDEX_SLOT.size
+        idsStart = self.ids_start()
+        new_map[newIdsStart : newIdsStart + self.count * INDEX_ID.size] = self.index_map[idsStart : idsStart + self.count * INDEX_ID.size]
+        INDEX_HEADER.pack_into(new_map, 0, INDEX_MAGIC, INDEX_VERSION, slots, self.count, 0, self.synced_bytes())
+        if self.index_file == None:
+            self.close_index()
+            self.index_map = new_map
+            self.slots = slots
+            return
+        new_map.flush()
+        new_map.close()
+        # Retires the old file, for the other writers that have it mapped
+        self.index_map[0:4] = b'\0\0\0\0'
+        self.close_index()
+        os.replace(tmpFileName, self.indexFileName)
+        self.map_index()
+        self.slots = slots
+
+    def write_header(self):
+        INDEX_HEADER.pack_into(self.index_map, 0, INDEX_MAGIC, INDEX_VERSION, self.slots, self.count, self.data_size,
+                               self.synced_bytes())
+
+    def synced_bytes(self):
+        # While an index is rebuilt without knowing what was fsynced, all of
+        # chunks.data, should the rebuild be cut short
+        return self.data_size if self.synced == None else self.synced
+
+    def store_key(self, key):
+        # key in this store's widths, for keys made for another store or
+        # read from a version 1 recipe
+        key = bytes(key)
+        if len(key) != self.key_size:
+            key = chunk_key(key[:DIGEST_FIELD_SIZE], int.from_bytes(key[DIGEST_FIELD_SIZE:], 'big'), self.key_size)
+        return key
+
+    def lookup(self, key):
+        # Offset of the chunk bytes in chunks.data, or None
+        self.lookups += 1
+        return self.find_slot(self.store_key(key))[2]
+
+    def id_of(self, key):
+        # Integer ID of the chunk, or None
+        self.lookups += 1
+        return self.find_slot(self.store_key(key))[1]
+
+    def read_id(self, chunkId):
+        if chunkId < 0 or chunkId >= self.count:
+            raise KeyError(chunkId)
+        offset = self.offset_of(chunkId)
+        if offset > len(self.data_view):
+            self.remap()
+        if self.entry_size != 0:
+            return self.read_chunk(offset, None)
+        return self.read(offset, int.from_bytes(self.data_view[offset - 3 : offset], 'big'))
+
+    def key_of(self, chunkId):
+        # The key of a chunk ID, which precedes the chunk's record
+        if chunkId < 0 or chunkId >= self.count:
+            raise KeyError(chunkId)
+        return self.key_at(self.offset_of(chunkId))
+
+    def key_at(self, offset):
+        # The key of the record whose stored bytes start at offset; short if
+        # another writer has not yet written it out
+        if offset > len(self.data_view):
+            self.remap()
+        keyEnd = offset - self.entry_size
+        return bytes(self.data_view[keyEnd - self.key_size : keyEnd])
+
+    def stored_of(self, chunkId):
+        # (method, stored bytes) of a chunk ID's record, as pack_stored()
+        # takes them, after checking its CRC
+        if self.entry_size == 0:
+            return 0, self.read_id(chunkId)
+        if chunkId < 0 or chunkId >= self.count:
+            raise KeyError(chunkId)
+        offset = self.offset_of(chunkId)
+        if offset > len(self.data_view):
+            self.remap()
+        buf = self.data_view
+        if self.checksummed and not self.record_ok(buf, offset):
+            raise ValueError("ERROR CRC MISMATCH AT BYTE %d OF %s" % (offset, self.fileName))
+        return buf[offset - self.length_size - 1], buf[offset : offset + int.from_bytes(buf[offset - self.length_size : offset], 'big')]
+
+    def read_chunk(self, offset, length):
+        # The chunk whose stored bytes start at offset: a memoryview slice,
+        # or bytes if it was compressed
+        if self.entry_size == 0:
+            return self.read(offset, length)
+        if offset > len(self.data_view):
+            self.remap()
+        return self.unpack(self.data_view, offset)
+
+    def unpack(self, buf, offset):
+        # unpack_entry(), checking the CRC and resolving a delta against its
+        # base chunk
+        if self.checksummed and not self.record_ok(buf, offset):
+            raise ValueError("ERROR CRC MISMATCH AT BYTE %d OF %s" % (offset, self.fileName))
+        lengthSize = self.length_size
+        if buf[offset - lengthSize - 1] != DELTA_METHOD:
+            return unpack_entry(buf, offset, lengthSize)
+        stored = buf[offset : offset + int.from_bytes(buf[offset - lengthSize : offset], 'big')]
+        depth, baseId = self.delta_header.unpack_from(stored, 0)
+        return apply_delta(self.read_id(baseId), stored[self.delta_header.size:])
+
+    def pack(self, chunk):
+        # The bytes that follow the key of a new record
+        if self.entry_size == 0:
+            return chunk
+        method = self.method
+        if method != 0:
+            stored = COMPRESSORS[method][1](chunk)
+            if len(stored) >= len(chunk):
+                method = 0
+        if method == 0:
+            stored = chunk
+        return self.pack_stored(method, stored)
+
+    def pack_stored(self, method, stored):
+        # The bytes that follow the key of a record holding stored, the
+        # output of method
+        return bytes([method]) + len(stored).to_bytes(self.length_size, 'big') + stored
+
+    def read(self, offset, length):
+        if offset + length > len(self.data_view):
+            self.remap()
+        return self.data_view[offset : offset + length]
+
+    def add(self, key, chunk, new = False):
+        # Appends the chunk unless it is already stored.  Returns True if
+        # added.  new says the caller knows key is not among the chunks
+        # counted so far, as a fingerprintIndex does from its Bloom filter,
+        # which saves looking it up before taking the lock.
+        self.check_writable()
+        key = self.store_key(key)
+        if not new and key in self:
+            return False
+        # Compressed before taking the lock, so writers compress in parallel
+        record = self.pack(chunk)
+        count = self.count
+        with self.appendLock:
+            # Only another writer's chunks could make it a duplicate now
+            if self.count != count and key in self:
+                return False
+            self.append(key, record)
+        return True
+
+    def add_delta(self, key, baseId, depth, delta):
+        # add() for a chunk given as chunk_delta instructions against the
+        # chunk baseId, itself at chain depth depth - 1
+        self.check_writable()
+        key = self.store_key(key)
+        if not self.compressed():
+            raise ValueError("ERROR %s IS AN UNCOMPRESSED STORE" % self.fileName)
+        with self.appendLock:
+            if key in self:
+                return False
+            self.append(key, self.pack_stored(DELTA_METHOD, self.delta_header.pack(depth, baseId) + delta))
+        return True
+
+    def check_writable(self):
+        if self.readOnly:
+            raise ValueError("ERROR %s IS OPEN READ-ONLY" % self.fileName)
+
+    def append(self, key, record):
+        # Under the lock
+        if self.writer == None:
+            self.writer = open(self.fileName, 'ab')
+        record = self.checksum(key, record)
+        self.writer.write(key)
+        self.writer.write(record)
+        self.insert(key, self.data_size + self.key_size + self.entry_size)
+        self.data_size += self.key_size + len(record)
+        self.write_header()
+        self.appended(self.key_size + len(record))
+
+    def checksum(self, key, record):
+        # record with its CRC in front, in a checksummed store
+        if not self.checksummed:
+            return record
+        return zlib.crc32(record, zlib.crc32(key)).to_bytes(CRC_SIZE, 'little') + record
+
+    def appended(self, size):
+        # Group commit: one fsync per syncBytes appended
+        self.unsynced += size
+        if self.unsynced >= self.syncBytes:
+            self.sync()
+
+    def sync(self):
+        # Under the lock, so the synced bytes only move up: the fsync also
+        # covers what other writers appended before data_size
+        if self.readOnly:
+            return
+        with self.appendLock:
+            if self.writer != None and self.unsynced > 0:
+                self.writer.flush()
+                os.fsync(self.writer.fileno())
+                self.synced = self.data_size
+                self.write_header()
+            self.unsynced = 0
+            self.index_map.flush()
+
+    def add_many(self, items, new = False):
+        # add() for an iterable of (key, chunk) pairs, committed with one
+        # append.  Returns the number of chunks added.
+        self.check_writable()
+        packed = OrderedDict()
+        for key, chunk in items:
+            key = self.store_key(key)
+            if key not in packed and (new or key not in self):
+                packed[key] = self.pack(chunk)
+        count = self.count
+        records = []
+        with self.appendLock:
+            for key, record in packed.items():
+                # Only another writer's chunks could make it a duplicate now
+                if self.count != count and key in self:
+                    continue
+                records.append((key, self.checksum(key, record)))
+            if records:
+                if self.writer == None:
+                    self.writer = open(self.fileName, 'ab')
+                self.writer.write(b''.join(key + record for key, record in records))
+            # Indexed once written, as lookups read keys back from chunks.data
+            offset = self.data_size
+            for key, record in records:
+                self.insert(key, offset + self.key_size + self.entry_size)
+                offset += self.key_size + len(record)
+            self.appended(offset - self.data_size)
+            self.data_size = offset
+            self.write_header()
+        return len(records)
+
+    def __contains__(self, key):
+        return self.lookup(key) != None
+
+    def __getitem__(self, key):
+        # key is a chunk key or an integer chunk ID
+        if isinstance(key, int):
+            return self.read_id(key)
+        offset = self.lookup(key)
+        if offset == None:
+            raise KeyError(key)
+        length = int.from_bytes(key[DIGEST_FIELD_SIZE:], 'big')
+        chunk = self.read_chunk(offset, length)
+        if len(chunk) != length:
+            raise ValueError("ERROR CHUNK AT BYTE %d OF %s IS %d BYTES, NOT %d" % (offset, self.fileName, len(chunk), length))
+        return chunk
+
+    def __len__(self):
+        return self.count
+
+    def flush(self):
+        # Every append already wrote the index header, under the lock
+        self.sync()
+
+    def close(self):
+        self.flush()
+        if self.writer != None:
+            self.writer.close()
+            self.writer = None
+        self.close_index()
+        self.data_view = memoryview(b'')
+        self.data_map = None
+        self.data_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class storeLock:
+    # with store.appendLock: holds the store's append lock
+    def __init__(self, store):
+        self.store = store
+
+    def __enter__(self):
+        self.store.lock()
+        return self
+
+    def __exit__(self, *exc):
+        self.store.unlock()
+        return False
+
+def unpack_entry(buf, offset, lengthSize = 3):
+    # The chunk whose stored bytes start at offset in buf, after their
+    # method and lengthSize-byte stored length
+    method = buf[offset - lengthSize - 1]
+    stored = buf[offset : offset + int.from_bytes(buf[offset - lengthSize : offset], 'big')]
+    if method == 0:
+        return stored
+    return COMPRESSORS[method][2](stored)
+
+def chunk_key(digest, length, keySize = KEY_SIZE64):
+    # The key of a chunk with a digest field and a length, KEY_SIZE64 bytes
+    # for a version 5 store and KEY_SIZE for older ones
+    if keySize == KEY_SIZE and length >= 1 << 24:
+        raise ValueError("ERROR A %d-BYTE CHUNK NEEDS A VERSION %d STORE, SEE migrate_store.py" % (length, DATA_VERSION))
+    return bytes(digest) + length.to_bytes(keySize - DIGEST_FIELD_SIZE, 'big')
+
+def slot_hash(key):
+    # (probe start, 24-bit tag) of a key, from digest bytes after the tag
+    # byte that digests other than SHA-1 start with
+    return int.from_bytes(key[1:9], 'little'), int.from_bytes(key[9:12], 'little')
+
+def index_size(slots):
+    return INDEX_HEADER.size + slots * (INDEX_SLOT.size + INDEX_ID.size)
+
+def create_index(indexFileName, slots, synced = 0):
+    with open(indexFileName, 'wb') as f:
+        f.write(INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, slots, 0, 0, synced))
+        f.truncate(index_size(slots))
@@ -0,0 +1,330 @@
+#
+# container_store.py - A chunk store that packs chunks into containers, for
+#	restores made of large sequential reads
+#
+# Copyright (C) 2019 Paul Lu, Owen Randall, <paullu@cs.ualberta.ca>
+#
+# Originally implemented by Owen Randall.
+#	Credits:  Owen Randall, Paul Lu
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# The data file is a CONTAINER_DATA_HEADER followed by containers of
+#   CONTAINER_HEADER | data | CONTAINER_ENTRY per chunk
+# where data holds the chunks in the order they were first added, each as
+#   key | method | 8-byte stored length | stored bytes
+# like a version 5 chunkStore record without its CRC, and the entries are
+# the container's own index: each chunk's key and the offset of its stored
+# bytes in data, in data order.  Scans read the entries, lookups confirm a
+# key against the copy before the record.  The header's CRC-32 covers its
+# counts, the data and the entries; scans and container loads check it, as
+# the chunkStore checks a record's.  Version 3 stores have 3-byte lengths,
+# 23-byte keys and 32-bit offsets (CONTAINER_HEADER3 and CONTAINER_ENTRY3),
+# no CRCs and no keys in data, so lookups search the entries; they are read
+# and appended to as they are, and migrate_store.py rewrites them as
+# version 6.  A container is filled in memory up to containerSize bytes
+# and written with one append, so chunks written together stay together.
+# The hash index (chunks.data.idx) is the chunkStore one and only covers
+# written containers.  Reads load whole containers with one pread each and
+# keep the last few, so a restore reads the store sequentially rather than
+# seeking to every chunk.  A writer holds the store's append lock from the
+# first chunk of a container until it is written, so the chunk IDs given out
+# for the open container are not taken by another process.
+import os
+import zlib
+import struct
+import threading
+from bisect import bisect_right
+from collections import OrderedDict
+from chunk_store import chunkStore, storeLock, DATA_MAGIC, DATA_HEADER, COMPRESSION_METHODS, SYNC_BYTES, CRC_SIZE
+
+CONTAINER_VERSION = 6
+CONTAINER_DATA_HEADER = struct.Struct('<4sIII') # magic, version, default compression method, container size
+CONTAINER_MAGIC = b'RFCN'
+CONTAINER_HEADER = struct.Struct('<4sIQI') # magic, chunks, data bytes, CRC-32 of the rest of the container
+CONTAINER_ENTRY = struct.Struct('<28sQ') # key, offset of the stored bytes in the container data
+CONTAINER_HEADER3 = struct.Struct('<4sII')
+CONTAINER_ENTRY3 = struct.Struct('<23sI')
+DEFAULT_CONTAINER_SIZE = 4 << 20
+PREFETCH_CONTAINERS = 8
+
+class containerStore(chunkStore):
+    def __init__(self, fileName, create = True, indexFileName = None, compression = None,
+                 containerSize = DEFAULT_CONTAINER_SIZE, prefetch = PREFETCH_CONTAINERS, syncBytes = SYNC_BYTES,
+                 readOnly = False):
+        self.fileName = fileName
+        self.indexFileName = indexFileName if indexFileName != None else fileName + '.idx'
+        self.readOnly = readOnly
+        if create and not readOnly and not os.path.exists(fileName):
+            open(fileName, 'ab').close()
+        self.data_file = open(fileName, 'rb')
+        self.writer = None
+        self.index_map = None
+        self.locks = 0
+        self.appendLock = storeLock(self)
+        self.syncBytes = syncBytes
+        self.unsynced = 0
+        self.lookups = 0
+        with self.appendLock:
+            self.data_size = os.fstat(self.data_file.fileno()).st_size
+            if self.data_size == 0 and not readOnly:
+                with open(fileName, 'ab') as f:
+                    f.write(CONTAINER_DATA_HEADER.pack(DATA_MAGIC, CONTAINER_VERSION,
+                                                       COMPRESSION_METHODS[compression or 'none'], containerSize))
+                self.data_size = CONTAINER_DATA_HEADER.size
+        header = self.data_file.read(CONTAINER_DATA_HEADER.size)
+        self.data_file.seek(0)
+        magic, version, self.method, self.containerSize = CONTAINER_DATA_HEADER.unpack(header)
+        if magic != DATA_MAGIC or version not in (3, CONTAINER_VERSION):
+            raise ValueError("ERROR %s IS NOT A CONTAINER STORE" % fileName)
+        if compression != None:
+            self.method = COMPRESSION_METHODS[compression]
+        self.data_start = CONTAINER_DATA_HEADER.size
+        self.checksummed = False # records have no CRCs, containers do
+        self.set_widths(version == CONTAINER_VERSION, True)
+        self.container_crc = version == CONTAINER_VERSION
+        self.container_header = CONTAINER_HEADER if version == CONTAINER_VERSION else CONTAINER_HEADER3
+        self.container_entry = CONTAINER_ENTRY if version == CONTAINER_VERSION else CONTAINER_ENTRY3
+        self.keyed = version == CONTAINER_VERSION # keys before records
+        self.data_map = None
+        self.data_view = memoryview(b'')
+        self.open_entries = [] # (key, offset in open_data) of the container being filled
+        self.open_keys = {} # key -> position in open_entries
+        self.open_data = bytearray()
+        self.starts = None # start of each written container, found on first use
+        self.prefetch = prefetch
+        self.loaded = OrderedDict() # container start -> its header and data
+        self.loaded_lock = threading.Lock()
+        self.remap()
+        self.open_index()
+
+    def scan(self, start):
+        self.remap()
+        self.starts = None
+        header = self.container_header
+        entry = self.container_entry
+        pos = max(start, self.data_start)
+        while pos < self.data_size:
+            short = pos + header.size > self.data_size
+            if not short:
+                magic, count, dataSize = header.unpack_from(self.data_view, pos)[:3]
+                entries = pos + header.size + dataSize
+                end = entries + count * entry.size
+                short = end > self.data_size
+            if short or magic != CONTAINER_MAGIC or not self.container_ok(self.data_view, pos, end):
+                self.bad_record(pos, short)
+                break
+            for i in range(count):
+                key, offset = entry.unpack_from(self.data_view, entries + i * entry.size)
+                self.insert(key, pos + header.size + offset)
+            pos = end
+        self.write_header()
+
+    def container_ok(self, buf, pos, end):
+        # False if the CRC of the container from pos to end does not match
+        if not self.container_crc:
+            return True
+        header = self.container_header
+        crc = header.unpack_from(buf, pos)[3]
+        return zlib.crc32(buf[pos + header.size : end], zlib.crc32(buf[pos + 4 : pos + header.size - CRC_SIZE])) == crc
+
+    def refresh(self):
+        size = self.data_size
+        chunkStore.refresh(self)
+        if self.data_size != size:
+            # Other writers appended containers
+            self.starts = None
+
+    def container_starts(self):
+        if self.starts == None:
+            if len(self.data_view) < self.data_size:
+                self.remap()
+            starts = []
+            pos = self.data_start
+            header = self.container_header
+            while pos + header.size <= self.data_size:
+                magic, count, dataSize = header.unpack_from(self.data_view, pos)[:3]
+                if magic != CONTAINER_MAGIC:
+                    break
+                starts.append(pos)
+                pos += header.size + dataSize + count * self.container_entry.size
+            self.starts = starts
+        return self.starts
+
+    def seal(self):
+        # Writes the container being filled, indexes its chunks and releases
+        # the lock taken for it
+        if not self.open_entries:
+            return
+        start = self.data_size
+        header = self.container_header
+        if self.writer == None:
+            self.writer = open(self.fileName, 'ab')
+        entries = self.open_entries
+        packed = b''.join(self.container_entry.pack(key, offset) for key, offset in entries)
+        if self.container_crc:
+            counts = header.pack(CONTAINER_MAGIC, len(entries), len(self.open_data), 0)[4 : header.size - CRC_SIZE]
+            crc = zlib.crc32(packed, zlib.crc32(self.open_data, zlib.crc32(counts)))
+            self.writer.write(header.pack(CONTAINER_MAGIC, len(entries), len(self.open_data), crc))
+        else:
+            self.writer.write(header.pack(CONTAINER_MAGIC, len(entries), len(self.open_data)))
+        self.writer.write(self.open_data)
+        self.writer.write(packed)
+        # Indexed once written, as lookups read keys back from the container
+        self.data_size += header.size + len(self.open_data) + len(packed)
+        if self.starts != None:
+            self.starts.append(start)
+        self.open_entries = []
+        self.open_keys = {}
+        self.open_data = bytearray()
+        for key, offset in entries:
+            self.insert(key, start + header.size + offset)
+        self.write_header()
+        self.appended(self.data_size - start)
+        self.unlock()
+
+    def append(self, key, record):
+        # Under the lock
+        if self.open_data and len(self.open_data) + len(record) > self.containerSize:
+            self.seal()
+        if not self.open_entries:
+            self.lock()
+        self.open_keys[key] = len(self.open_entries)
+        if self.keyed:
+            self.open_data += key
+        self.open_entries.append((key, len(self.open_data) + self.entry_size))
+        self.open_data += record
+
+    def add_many(self, items, new = False):
+        added = 0
+        for key, chunk in items:
+            if self.add(key, chunk, new):
+                added += 1
+        return added
+
+    def lookup(self, key):
+        key = self.store_key(key)
+        position = self.open_keys.get(key)
+        if position != None:
+            return self.open_offset(position)
+        self.lookups += 1
+        return self.find_slot(key)[2]
+
+    def open_offset(self, position):
+        # Where the chunk will be once the container being filled is written
+        return self.data_size + self.container_header.size + self.open_entries[position][1]
+
+    def id_of(self, key):
+        key = self.store_key(key)
+        position = self.open_keys.get(key)
+        if position != None:
+            return self.count + position
+        self.lookups += 1
+        return self.find_slot(key)[1]
+
+    def read_id(self, chunkId):
+        if self.count <= chunkId < self.count + len(self.open_entries):
+            return self.read_chunk(self.open_offset(chunkId - self.count), None)
+        return chunkStore.read_id(self, chunkId)
+
+    def key_of(self, chunkId):
+        if self.count <= chunkId < self.count + len(self.open_entries):
+            return self.open_entries[chunkId - self.count][0]
+        return chunkStore.key_of(self, chunkId)
+
+    def key_at(self, offset):
+        # b'' if another writer appended the container holding offset since
+        # the lock was last taken; in a version 3 store, a binary search of
+        # the container's entries
+        if offset >= self.data_size:
+            return b''
+        if self.keyed:
+            return chunkStore.key_at(self, offset)
+        if len(self.data_view) < self.data_size:
+            self.remap()
+        starts = self.container_starts()
+        start = starts[bisect_right(starts, offset) - 1]
+        header = self.container_header
+        entry = self.container_entry
+        magic, count, dataSize = header.unpack_from(self.data_view, start)[:3]
+        entries = start + header.size + dataSize
+        offset -= start + header.size
+        low = 0
+        high = count
+        while low < high:
+            middle = (low + high) // 2
+            key, entryOffset = entry.unpack_from(self.data_view, entries + middle * entry.size)
+            if entryOffset == offset:
+                return key
+            if entryOffset < offset:
+                low = middle + 1
+            else:
+                high = middle
+        return b''
+
+    def read_chunk(self, offset, length):
+        if offset >= self.data_size:
+            return bytes(self.unpack(self.open_data, offset - self.data_size - self.container_header.size))
+        if self.prefetch <= 0:
+            return chunkStore.read_chunk(self, offset, length)
+        start, container = self.load_container(offset)
+        return self.unpack(container, offset - start)
+
+    def load_container(self, offset):
+        # (start, header and data) of the written container holding offset
+        starts = self.container_starts()
+        start = starts[bisect_right(starts, offset) - 1]
+        with self.loaded_lock:
+            container = self.loaded.get(start)
+            if container != None:
+                self.loaded.move_to_end(start)
+                return start, container
+        fd = self.data_file.fileno()
+        header = self.container_header
+        magic, count, dataSize = header.unpack(os.pread(fd, header.size, start))[:3]
+        if self.container_crc:
+            # The entries too, for the CRC
+            size = header.size + dataSize + count * self.container_entry.size
+            container = memoryview(os.pread(fd, size, start))
+            if len(container) != size or not self.container_ok(container, 0, size):
+                raise ValueError("ERROR CRC MISMATCH IN THE CONTAINER AT BYTE %d OF %s" % (start, self.fileName))
+        else:
+            container = memoryview(os.pread(fd, header.size + dataSize, start))
+        with self.loaded_lock:
+            self.loaded[start] = container
+            while len(self.loaded) > self.prefetch:
+                self.loaded.popitem(last = False)
+        return start, container
+
+    def __len__(self):
+        return self.count + len(self.open_entries)
+
+    def flush(self):
+        self.seal()
+        chunkStore.flush(self)
+
+def open_store(fileName, create = True, compression = None, containerSize = None, readOnly = False):
+    # Opens the containerStore or chunkStore in fileName.  A new store is a
+    # containerStore if containerSize is given.
+    if readOnly:
+        create = False
+    header = b''
+    if os.path.exists(fileName):
+        with open(fileName, 'rb') as f:
+            header = f.read(DATA_HEADER.size)
+    if len(header) == DATA_HEADER.size and DATA_HEADER.unpack(header)[:2] in ((DATA_MAGIC, 3), (DATA_MAGIC, CONTAINER_VERSION)):
+        return containerStore(fileName, create, compression = compression, readOnly = readOnly)
+    if len(header) == 0 and containerSize != None and not readOnly and (create or os.path.exists(fileName)):
+        return containerStore(fileName, create, compression = compression, containerSize = containerSize)
+    return chunkStore(fileName, create, compression = compression, readOnly = readOnly)
@@ -21,59 +21,302 @@
 
 # hbdm_decodeV4.py
 import sys
+import os
+import argparse
+from array import array
+from bisect import bisect_left, bisect_right
+from itertools import accumulate, tee
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from container_store import open_store
+from chunk_cache import cachedStore, add_cache_arguments, cache_option
+from chunk_stats import stage
+from recipe import read_recipe, read_header, recipe_chunks, is_recipe, RECIPE_HEADER
+
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
 
 def read_encoded(inputFile):
+    return read_records(inputFile)[0]
+
+def read_records(inputFile):
+    # (records, file size, offsets) of an encoded file, as read_recipe()
+    # returns them; the size and offsets are None for a version 1 recipe
     try:
         data = open(inputFile, 'rb').read()
     except:
         print( "File open/read failed: %s" % (inputFile) )
         sys.exit(-1)
 
+    if is_recipe(data):
+        # Versions 2 and 3: an array of chunk IDs, which index the store like keys
+        parameters, fileSize, ids, offsets = read_recipe(data)
+        return ids, fileSize, offsets
     chunk_lst = []
     byteIndex = 0
     while byteIndex < len(data):
         chunk_lst.append(data[byteIndex : byteIndex + 23])
         byteIndex += 23
-    return chunk_lst
+    return chunk_lst, None, None
 
 def decode(inputFile, commonFile):
     chunk_lst = read_encoded(inputFile)
-    byteIndex = 0
     try:
-        fileBytes = open(commonFile, 'rb').read()
-    except:
+        store = open_store(commonFile, readOnly = True)
+    except OSError:
         print( "File open/read failed: %s" % (commonFile) )
         sys.exit(-1)
 
-    chunk_dict = {}
-    while byteIndex < len(fileBytes):
-        theHash = fileBytes[byteIndex : byteIndex + 20]
-        byteIndex += 20
-        length = fileBytes[byteIndex : byteIndex + 3]
-        byteIndex += 3
-        chunk = bytearray(b'')
-        while len(chunk) < int.from_bytes(length, 'big'):
-            chunk.append(fileBytes[byteIndex])
-            byteIndex += 1
-        chunk_dict[theHash + length] = chunk
-
-    return chunk_lst, chunk_dict
-
-def decode_to_file(inputFile, outputFile, commonFile):
-    chunk_lst, chunk_dict = decode(inputFile, commonFile)
+    return chunk_lst, store
+
+def read_encoded_stream(fileObject, blockRecords = 1 << 16):
+    # Yields the 23-byte records of a .encoded file, reading blockRecords
+    # records at a time
+    while True:
+        data = fileObject.read(23 * blockRecords)
+        if not data:
+            break
+        for byteIndex in range(0, len(data), 23):
+            yield data[byteIndex : byteIndex + 23]
+
+def write_all(fd, buffers):
+    # Writes the buffers in order with as few system calls as possible
+    if not hasattr(os, 'writev'):
+        data = memoryview(b''.join(buffers))
+        while data:
+            data = data[os.write(fd, data):]
+        return
+    first = 0
+    while first < len(buffers):
+        n = os.writev(fd, buffers[first : first + IOV_MAX])
+        while first < len(buffers) and n >= len(buffers[first]):
+            n -= len(buffers[first])
+            first += 1
+        if n > 0:
+            buffers[first] = buffers[first][n:]
+
+def write_buffers(fd, buffers, stats):
+    if stats == None:
+        write_all(fd, buffers)
+        return
+    stats.add_chunks(len(buffer) for buffer in buffers)
+    with stats.stage('write'):
+        write_all(fd, buffers)
+
+def fetch_chunks(store, records, threads, groupSize = 64):
+    # Yields store[record] for each record.  With threads > 1 groups of
+    # groupSize records are fetched by a thread pool, a few groups ahead;
+    # zlib, lzma and bz2 release the GIL, so decompression runs in parallel.
+    if threads <= 1:
+        for record in records:
+            yield store[record]
+        return
+    def fetch(group):
+        return [store[record] for record in group]
+    with ThreadPoolExecutor(threads) as executor:
+        pending = deque()
+        group = []
+        for record in records:
+            group.append(record)
+            if len(group) == groupSize:
+                pending.append(executor.submit(fetch, group))
+                group = []
+                if len(pending) > 2 * threads:
+                    yield from pending.popleft().result()
+        pending.append(executor.submit(fetch, group))
+        while pending:
+            yield from pending.popleft().result()
+
+def decode_to_file(inputFile, outputFile, commonFile, batchSize = 1 << 20, cache = None, threads = None,
+                   stats = None):
+    # Streams the recipe and writes slices of the memory-mapped store straight
+    # to the output, batchSize bytes per vectored write, so memory use does
+    # not depend on the size of the file or of the store.  cache is an
+    # optional chunk_cache cache that serves repeated chunks from memory.
+    # Compressed chunks are decompressed by threads threads (default: one
+    # per CPU, or one if the store was created uncompressed).  stats is an optional chunk_stats.chunkStats.
     try:
-        fileObject = open(outputFile, 'wb')
+        encodedFile = open(inputFile, 'rb')
+    except:
+        print( "File open/read failed: %s" % (inputFile) )
+        sys.exit(-1)
+    try:
+        store = open_store(commonFile, readOnly = True)
+    except OSError:
+        print( "File open/read failed: %s" % (commonFile) )
+        sys.exit(-1)
+    if threads == None:
+        threads = os.cpu_count() or 1
+    if not store.compressed() or store.method == 0:
+        threads = 1
+    if cache != None:
+        store = cachedStore(store, cache)
+    try:
+        fd = os.open(outputFile, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
     except:
         print( "File open/write failed: %s" % (outputFile) )
         sys.exit(-1)
 
+    with stage(stats, 'recipe'):
+        head = encodedFile.read(RECIPE_HEADER.size)
+        fileSize = None
+        lengths = None
+        if is_recipe(head):
+            # Versions 2 and 3 are decoded as they are read, like version 1
+            version, paramSize, fileSize, count = read_header(head)
+            encodedFile.seek(RECIPE_HEADER.size + paramSize)
+            records = recipe_chunks(encodedFile, count, version != 2)
+            if version != 2:
+                # tee() only holds the chunks fetch_chunks() reads ahead
+                records, lengths = tee(records)
+                lengths = (length for chunkId, length in lengths)
+            records = (chunkId for chunkId, length in records)
+        else:
+            encodedFile.seek(0)
+            records = read_encoded_stream(encodedFile)
+
+    chunks = fetch_chunks(store, records, threads)
+    if lengths != None:
+        chunks = checked_chunks(chunks, lengths, inputFile)
+    if stats != None:
+        chunks = stats.timed(chunks, 'fetch')
+    buffers = []
+    pending = 0
+    size = 0
+    for chunk in chunks:
+        buffers.append(chunk)
+        pending += len(chunk)
+        if pending >= batchSize or len(buffers) >= IOV_MAX:
+            write_buffers(fd, buffers, stats)
+            size += pending
+            buffers = []
+            pending = 0
+    write_buffers(fd, buffers, stats)
+    size += pending
+    os.close(fd)
+    encodedFile.close()
+    store.close()
+    check_size(inputFile, size, fileSize)
+
+def checked_chunks(chunks, lengths, inputFile):
+    # Yields the chunks, checking each against its length in the recipe
+    for i, (chunk, length) in enumerate(zip(chunks, lengths)):
+        if len(chunk) != length:
+            raise ValueError("ERROR CHUNK %d OF %s IS %d BYTES, NOT %d" % (i, inputFile, len(chunk), length))
+        yield chunk
+
+def check_size(inputFile, size, fileSize):
+    # A recipe whose chunks do not add up to the size in its header names
+    # chunks that are not the ones it was written with
+    if fileSize != None and size != fileSize:
+        raise ValueError("ERROR %s DECODES TO %d BYTES, NOT %d" % (inputFile, size, fileSize))
+
+def chunk_offsets(store, records):
+    # An array of the offset of each record's chunk in the decoded file,
+    # then the file size, for a recipe without them.  A chunk's length is
+    # the end of its key, so this reads one key per distinct chunk and no
+    # chunks.
+    lengths = {}
+    for record in set(records):
+        key = store.key_of(record) if isinstance(record, int) else record
+        lengths[record] = int.from_bytes(key[20:], 'big')
+    return array('Q', accumulate(map(lengths.__getitem__, records), initial = 0))
+
+class encodedReader:
+    # A read-only, seekable file object over the file encoded in inputFile.
+    # Each read bisects the chunk offsets, kept in a version 3 recipe and
+    # otherwise found from the store's keys, for the chunks covering it and
+    # fetches only those, so a byte range costs the chunks it spans whatever
+    # the size of the file.  cache and threads are as for decode_to_file(),
+    # with one thread by default, as reads are usually small.
+    def __init__(self, inputFile, commonFile = 'chunks.data', cache = None, threads = 1):
+        self.records, fileSize, offsets = read_records(inputFile)
+        try:
+            self.store = open_store(commonFile, readOnly = True)
+        except OSError:
+            print( "File open/read failed: %s" % (commonFile) )
+            sys.exit(-1)
+        self.offsets = offsets if offsets != None else chunk_offsets(self.store, self.records)
+        self.size = self.offsets[-1]
+        check_size(inputFile, self.size, fileSize)
+        if cache != None:
+            self.store = cachedStore(self.store, cache)
+        self.threads = threads
+        self.inputFile = inputFile
+        self.pos = 0
+        self.closed = False
+
+    def read(self, size = -1):
+        if size == None or size < 0 or self.pos + size > self.size:
+            size = max(self.size - self.pos, 0)
+        start = self.pos
+        end = start + size
+        if size == 0:
+            return b''
+        offsets = self.offsets
+        first = bisect_right(offsets, start) - 1
+        last = bisect_left(offsets, end)
+        pieces = []
+        i = first
+        for chunk in fetch_chunks(self.store, self.records[first : last], self.threads):
+            if len(chunk) != offsets[i + 1] - offsets[i]:
+                raise ValueError("ERROR CHUNK %d OF %s IS %d BYTES, NOT %d" % (i, self.inputFile, len(chunk), offsets[i + 1] - offsets[i]))
+            pieces.append(chunk[max(start - offsets[i], 0) : end - offsets[i]])
+            i += 1
+        self.pos = end
+        return b''.join(pieces)
+
+    def seek(self, offset, whence = os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.pos
+        elif whence == os.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError("ERROR NEGATIVE SEEK POSITION %d" % offset)
+        self.pos = offset
+        return offset
+
+    def tell(self):
+        return self.pos
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def close(self):
+        if not self.closed:
+            self.store.close()
+            self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
 
-    for pair in chunk_lst:
-        fileObject.write(chunk_dict[pair])
+def decode_range(inputFile, commonFile, start, length, cache = None):
+    # The length bytes of the file encoded in inputFile from byte start
+    with encodedReader(inputFile, commonFile, cache) as reader:
+        reader.seek(start)
+        return reader.read(length)
 
 if __name__ == "__main__":
-    if len(sys.argv) < 3:
-        filename = 'chunks.data'
+    parser = argparse.ArgumentParser(description = "Restore INPUT.decoded from INPUT.encoded, or write a byte range of it to stdout")
+    parser.add_argument("input")
+    parser.add_argument("commonFile", nargs = '?', default = 'chunks.data')
+    parser.add_argument("--offset", type = int, default = None, help = "first byte of a range to restore")
+    parser.add_argument("--length", type = int, default = None, help = "bytes in the range (default: to the end)")
+    add_cache_arguments(parser)
+    args = parser.parse_args()
+    cache = cache_option(args)
+    if args.offset == None and args.length == None:
+        decode_to_file(args.input + ".encoded", args.input + ".decoded", args.commonFile, cache = cache)
     else:
-        filename = sys.argv[2]
-    decode_to_file(sys.argv[1] + ".encoded", sys.argv[1] + ".decoded", filename)
+        length = args.length if args.length != None else -1
+        sys.stdout.buffer.write(decode_range(args.input + ".encoded", args.commonFile, args.offset or 0, length, cache))
+    if cache != None:
+        print("Chunk cache:", cache.stats(), file = sys.stderr)
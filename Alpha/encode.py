@@ -20,40 +20,54 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 # Based on hbdm_encodeV5.py
-from chunk_file import chunk
+from chunk_file import chunk, chunk_parameters, FINGERPRINTERS
+from chunk_digest import chunk_digest, DIGESTS
+from chunk_store import chunk_key, COMPRESSION_METHODS, KEY_SIZE, KEY_SIZE64
+from container_store import open_store
+from fingerprint_index import fingerprintIndex
+from chunk_delta import deltaStore
+from chunk_cache import cachedStore, add_cache_arguments, cache_option
+from chunk_stats import chunkStats, stage
+from recipe import write_recipe, RECIPE_VERSION
 import sys
 import os
 import time
+import argparse
+import multiprocessing
 
-def get_chunk_info(commonFile):
-    byteIndex = 0
-    try:
-        fileBytes = open(commonFile, 'rb').read()
-    except:
+def get_chunk_info(commonFile, compression = None, containerSize = None):
+    if not os.path.exists(commonFile):
         print( "File open/read failed: %s.  Starting de novo." % (commonFile) )
-        fileBytes = []
-
-    chunk_dict = {}
-    counter = 0
-    while byteIndex < len(fileBytes):
-        hashVal = fileBytes[byteIndex : byteIndex + 20]
-        byteIndex += 20
-        length = fileBytes[byteIndex : byteIndex + 3]
-        byteIndex += 3
-        theChunk = bytearray(b'')
-        while len(theChunk) < int.from_bytes(length, 'big'):
-            theChunk.append(fileBytes[byteIndex])
-            byteIndex += 1
-        pair = hashVal + length
-        chunk_dict[pair] = theChunk
-        counter += 1
-    if counter > 2 ** 24:
-        raise("TOO MANY CHUNKS CANNOT REPRESENT IN 3 BYTES")
-    return chunk_dict
-
-def encode(inputFile, outputFile, commonFile):
-    common_chunk_dict = get_chunk_info(commonFile)
-    org_chunk_dict, org_chunk_lst = chunk(inputFile)
+    try:
+        store = open_store(commonFile, compression = compression, containerSize = containerSize)
+    except OSError:
+        print( "File open/append failed: %s" % (commonFile) )
+        sys.exit(-1)
+    return store
+
+def encode(inputFile, outputFile, commonFile, processes = 1, cache = None, recipeVersion = RECIPE_VERSION,
+           compression = None, containerSize = None, useFingerprintIndex = False, delta = False, stats = None,
+           **chunkOptions):
+    # chunkOptions are passed to chunk(): windowSize, fingerprintSize,
+    # maskSize, minSize, maxSize, normalization, normalSize, fingerprinterName,
+    # digestName.  recipeVersion 1 writes the original 23-byte records, so
+    # needs chunks under 16 MB, and 2 leaves out the chunk offsets.
+    # compression is a chunk_store.COMPRESSORS name for new chunks, and
+    # containerSize makes a new store a container_store.containerStore.
+    # useFingerprintIndex puts a fingerprint_index.fingerprintIndex in front
+    # of the store's index, and delta stores near-duplicate chunks as
+    # chunk_delta deltas.  stats is an optional chunk_stats.chunkStats.
+    with stage(stats, 'store'):
+        store = get_chunk_info(commonFile, compression, containerSize)
+        index = None
+        deltas = None
+        if useFingerprintIndex:
+            store = index = fingerprintIndex(store)
+        if delta:
+            store = deltas = deltaStore(store, commonFile + '.sim')
+    if cache != None:
+        store = cachedStore(store, cache)
+    org_chunk_dict, org_chunk_lst = chunk(inputFile, processes = processes, stats = stats, **chunkOptions)
     print("Number of unique chunks:", len(org_chunk_dict))
     print("Total number of chunks:", len(org_chunk_lst))
     try:
@@ -62,56 +76,222 @@ def encode(inputFile, outputFile, commonFile):
         print( "File open/write failed: %s" % (outputFile) )
         sys.exit(-1)
 
-    try:
-        all_chunks_file = open(commonFile, 'ab+')
-    except:
-        print( "File open/append failed: %s" % (commonFile) )
-        sys.exit(-1)
-
-    counter = len(common_chunk_dict)
+    verify = chunk_digest(chunkOptions.get('digestName', 'sha1')).verify
+    keys = []
+    fileSize = 0
+    counter = len(store)
+    with stage(stats, 'store'):
+        for pair in org_chunk_lst:
+            bytePair = chunk_key(pair[0], pair[1], store.key_size)
+            keys.append(bytePair)
+            fileSize += pair[1]
+            add_verified(store, bytePair, org_chunk_dict[pair], verify)
+        # The chunks are on disk before the recipe naming them
+        store.flush()
+    if stats != None:
+        stats.add_dedup(len(store) - counter, len(org_chunk_lst))
+    with stage(stats, 'recipe'):
+        write_encoded(encodedFile, keys, fileSize, store, recipeVersion, chunk_parameters(chunkOptions))
+        encodedFile.close()
+    with stage(stats, 'store'):
+        store.close()
+    if cache != None:
+        print("Chunk cache:", cache.stats())
+    if index != None:
+        print("Fingerprint index:", index.stats())
+    if deltas != None:
+        print("Delta chunks:", deltas.stats())
 
-    for pair in org_chunk_lst:
-        bytePair = pair[0] + pair[1].to_bytes(3, 'big')
-        encodedFile.write(bytePair)
-        if bytePair not in common_chunk_dict:
-            all_chunks_file.write(bytePair + org_chunk_dict[pair])
-            common_chunk_dict[bytePair] = org_chunk_dict[pair]
-            counter += 1
-    if counter > 2 ** 24:
-        raise("TOO MANY CHUNKS CANNOT REPRESENT IN 3 BYTES")
+def write_encoded(encodedFile, keys, fileSize, store, recipeVersion, parameters):
+    # Writes the recipe of a file whose chunks, keys, are all in store
+    if recipeVersion == 1:
+        encodedFile.write(b''.join(chunk_key(key[:20], int.from_bytes(key[20:], 'big'), KEY_SIZE) for key in keys))
+    else:
+        lengths = None
+        if recipeVersion != 2:
+            lengths = [int.from_bytes(key[20:], 'big') for key in keys]
+        write_recipe(encodedFile, [store.id_of(key) for key in keys], fileSize, parameters, lengths)
 
-def update_db(commonFile, org_chunk_dict_lst, org_chunk_lst_lst):
-    common_chunk_dict = get_chunk_info(commonFile)
-    try:
-        all_chunks_file = open(commonFile, 'ab+')
-    except:
-        print( "File open/append failed: %s" % (commonFile) )
-        sys.exit(-1)
+def add_verified(store, key, chunk, verify):
+    # With a non-cryptographic digest an equal ID does not prove equal bytes
+    if not store.add(key, chunk) and verify and bytes(store[key]) != chunk:
+        raise ValueError("ERROR DIGEST COLLISION")
 
+def update_db(commonFile, org_chunk_dict_lst, org_chunk_lst_lst, verify = False):
+    store = get_chunk_info(commonFile)
 
     for i in range(len(org_chunk_lst_lst)):
         org_chunk_lst = org_chunk_lst_lst[i]
         org_chunk_dict = org_chunk_dict_lst[i]
         for pair in org_chunk_lst:
-            bytePair = pair[0] + pair[1].to_bytes(3, 'big')
-            if bytePair not in common_chunk_dict:
-                all_chunks_file.write(bytePair + org_chunk_dict[pair])
-                common_chunk_dict[bytePair] = org_chunk_dict[pair]
+            bytePair = chunk_key(pair[0], pair[1], store.key_size)
+            add_verified(store, bytePair, org_chunk_dict[pair], verify)
+    store.close()
 
-if __name__ == "__main__":
-    if len(sys.argv) > 4:
-        maskSize = int(sys.argv[4])
+def tree_files(rootDir, skip = ()):
+    # Regular files under rootDir, recursively, except encoder output and
+    # the paths in skip
+    skip = set(os.path.realpath(fileName) for fileName in skip)
+    for dirPath, dirNames, fileNames in os.walk(rootDir):
+        dirNames.sort()
+        for fileName in sorted(fileNames):
+            if fileName.endswith((".encoded", ".decoded")) or fileName == "desktop.ini":
+                continue
+            path = os.path.join(dirPath, fileName)
+            if os.path.islink(path) or not os.path.isfile(path) or os.path.realpath(path) in skip:
+                continue
+            yield path
+
+def encode_file(task):
+    # Pool worker for encode_tree(): chunks one file into keys of keySize
+    # bytes.  Returns (inputFile, bytes read, chunk keys, unique chunks as
+    # (key, chunk) pairs), with None for the last three if the file could
+    # not be read.
+    inputFile, chunkOptions, keySize = task
+    try:
+        with open(inputFile, 'rb') as f:
+            data = f.read()
+    except OSError:
+        return inputFile, None, None, None
+    keys, chunks = chunk_data(data, chunkOptions, keySize)
+    return inputFile, len(data), keys, chunks
+
+def chunk_data(data, chunkOptions, keySize = KEY_SIZE64):
+    # Returns (chunk keys, unique chunks as (key, chunk) pairs) of data
+    chunk_dict, chunk_lst = chunk(data = data, **chunkOptions)
+    keys = [chunk_key(pair[0], pair[1], keySize) for pair in chunk_lst]
+    return keys, [(chunk_key(pair[0], pair[1], keySize), chunk) for pair, chunk in chunk_dict.items()]
+
+def encode_tree(rootDir, commonFile, processes = 1, batchBytes = 16 << 20, verbose = False,
+                recipeVersion = RECIPE_VERSION, compression = None, containerSize = None, useFingerprintIndex = False,
+                delta = False, cache = None, **chunkOptions):
+    # Encodes every file under rootDir to a .encoded file beside it.  The
+    # store is opened once, files are chunked by a pool of processes, and new
+    # chunks are appended to the store batchBytes at a time.  Recipes wait
+    # for the batch holding their chunks, which gives them their IDs.
+    store = get_chunk_info(commonFile, compression, containerSize)
+    if useFingerprintIndex:
+        store = fingerprintIndex(store)
+    if delta:
+        store = deltaStore(store, commonFile + '.sim')
+    if cache != None:
+        store = cachedStore(store, cache)
+    verify = chunk_digest(chunkOptions.get('digestName', 'sha1')).verify
+    parameters = chunk_parameters(chunkOptions)
+    tasks = ((fileName, chunkOptions, store.key_size) for fileName in tree_files(rootDir, (commonFile, commonFile + '.idx', commonFile + '.fpi', commonFile + '.sim')))
+    if processes > 1:
+        pool = multiprocessing.Pool(processes)
+        results = pool.imap(encode_file, tasks, 16)
     else:
-        maskSize = 6
-    input = sys.argv[1]
-    if os.path.isdir(input):
-        for fileName in os.listdir(input):
+        pool = None
+        results = map(encode_file, tasks)
+
+    start = time.time()
+    files = 0
+    totalBytes = 0
+    added = 0
+    pending = {}
+    pendingBytes = 0
+    recipes = []
+    recipeKeys = 0
+    def commit():
+        count = store.add_many(pending.items())
+        store.flush()
+        for fileName, keys, size in recipes:
+            try:
+                with open(fileName + ".encoded", 'wb') as encodedFile:
+                    write_encoded(encodedFile, keys, size, store, recipeVersion, parameters)
+            except OSError:
+                print( "File open/write failed: %s" % (fileName + ".encoded") )
+        return count
+
+    for fileName, size, keys, chunks in results:
+        if size == None:
+            print( "File open/read failed: %s" % (fileName) )
+            continue
+        if verbose:
             print(fileName)
-            if "encoded" not in fileName and "decoded" not in fileName and "desktop.ini" not in fileName:
-                encode(os.getcwd() + "\\" + input + "\\" + fileName, os.getcwd() + "\\" + input + "\\" + fileName +  ".encoded", sys.argv[2], maskSize)
+        files += 1
+        totalBytes += size
+        for key, chunk in chunks:
+            if key in pending:
+                if verify and pending[key] != chunk:
+                    raise ValueError("ERROR DIGEST COLLISION")
+                continue
+            if key in store:
+                if verify and bytes(store[key]) != chunk:
+                    raise ValueError("ERROR DIGEST COLLISION")
+                continue
+            pending[key] = chunk
+            pendingBytes += len(chunk)
+        recipes.append((fileName, keys, size))
+        recipeKeys += len(keys)
+        if pendingBytes >= batchBytes or recipeKeys * 64 >= batchBytes:
+            added += commit()
+            pending = {}
+            pendingBytes = 0
+            recipes = []
+            recipeKeys = 0
+    added += commit()
+    if pool != None:
+        pool.close()
+        pool.join()
+    store.close()
+    seconds = time.time() - start
+    print("Encoded %d files, %d bytes, %d new chunks in %.2f s (%.2f MB/s)" %
+          (files, totalBytes, added, seconds, totalBytes / max(seconds, 1e-9) / (1 << 20)))
+
+def chunk_options(args):
+    return {'windowSize': args.window_size, 'fingerprintSize': args.fingerprint_size, 'maskSize': args.mask_size,
+            'minSize': args.min_size, 'maxSize': args.max_size, 'normalization': args.normalization,
+            'normalSize': args.normal_size, 'fingerprinterName': args.fingerprinter, 'digestName': args.digest}
+
+def add_chunk_arguments(parser):
+    parser.add_argument("--fingerprinter", choices = sorted(FINGERPRINTERS), default = 'rabin', help = "rolling hash used to find cuts; gear ignores --window-size and --fingerprint-size")
+    parser.add_argument("--digest", choices = sorted(DIGESTS), default = 'sha1', help = "chunk ID digest; xxh128 needs the xxhash package and is verified against stored chunks")
+    parser.add_argument("--window-size", type = int, default = 3, help = "bytes in the rolling fingerprint window")
+    parser.add_argument("--fingerprint-size", type = int, default = 8, help = "degree of the irreducible polynomial")
+    parser.add_argument("--mask-size", type = int, default = 8, help = "fingerprint bits tested for a cut (average chunk about 2^mask-size bytes)")
+    parser.add_argument("--min-size", type = int, default = 0, help = "minimum chunk size; no fingerprints are tested before it")
+    parser.add_argument("--max-size", type = int, default = None, help = "maximum chunk size; a cut is forced there")
+    parser.add_argument("--normalization", type = int, default = 0, help = "FastCDC normalization level: mask bits added before and removed after --normal-size")
+    parser.add_argument("--normal-size", type = int, default = None, help = "chunk size where normalized chunking switches masks (default 2^mask-size)")
+    parser.add_argument("--recipe-version", type = int, choices = (1, 2, RECIPE_VERSION), default = RECIPE_VERSION, help = "1 writes the original 23-byte chunk records, for chunks under 16 MB; 2 leaves out the chunk lengths byte range reads use")
+    parser.add_argument("--compression", choices = sorted(COMPRESSION_METHODS), default = None, help = "compress new chunks in the store (default: as the store was created, else none)")
+    parser.add_argument("--container-size", type = int, default = None, help = "create a new store packing chunks into containers of this many bytes (e.g. 4194304)")
+    parser.add_argument("--fingerprint-index", action = 'store_true', help = "find duplicates through an in-memory Bloom filter and sampled index (saved in COMMONFILE.fpi)")
+    parser.add_argument("--delta", action = 'store_true', help = "store near-duplicate chunks as deltas against similar stored chunks (not in a store of the original layout; features saved in COMMONFILE.sim)")
+    parser.add_argument("--processes", type = int, default = 1, help = "chunk with a pool of this many processes (one file per process for a directory)")
+    add_cache_arguments(parser)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Encode a file, or every file in a directory tree, against a chunk store")
+    parser.add_argument("input")
+    parser.add_argument("commonFile", nargs = '?', default = 'chunks.data')
+    add_chunk_arguments(parser)
+    parser.add_argument("--stats", action = 'store_true', help = "print bytes, chunks, dedup hit rate, seconds per stage and chunk sizes")
+    parser.add_argument("--profile", metavar = 'DIR', default = None, help = "write a cProfile profile of each stage to DIR/STAGE.prof")
+    parser.add_argument("--trace-memory", metavar = 'DIR', default = None, help = "trace allocations and write a tracemalloc snapshot of each stage to DIR/STAGE.tracemalloc")
+    args = parser.parse_args()
+    if args.normalization >= args.mask_size:
+        parser.error("--normalization must be smaller than --mask-size")
+    input = args.input
+    if os.path.isdir(input):
+        encode_tree(input, args.commonFile, processes = args.processes, verbose = True,
+                    recipeVersion = args.recipe_version, compression = args.compression,
+                    containerSize = args.container_size, useFingerprintIndex = args.fingerprint_index,
+                    delta = args.delta, cache = cache_option(args), **chunk_options(args))
     else:
-        if len(sys.argv) < 3:
-            filename = 'chunks.data'
-        else:
-            filename = sys.argv[2]
-        encode(input, input + ".encoded", filename)
+        stats = None
+        if args.stats or args.profile != None or args.trace_memory != None:
+            stats = chunkStats(profile = args.profile != None, traceMemory = args.trace_memory != None)
+        encode(input, input + ".encoded", args.commonFile, processes = args.processes, cache = cache_option(args),
+               recipeVersion = args.recipe_version, compression = args.compression,
+               containerSize = args.container_size, useFingerprintIndex = args.fingerprint_index,
+               delta = args.delta, stats = stats, **chunk_options(args))
+        if stats != None:
+            print(stats.report())
+            if args.profile != None:
+                stats.dump_profiles(args.profile)
+            if args.trace_memory != None:
+                stats.dump_snapshots(args.trace_memory)
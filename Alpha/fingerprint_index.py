@@ -0,0 +1,301 @@
+#
+# fingerprint_index.py - Compact in-memory dedup index in front of a chunk
+#	store: a Bloom filter and sampled, sparse key hooks
+#
+# Copyright (C) 2019 Paul Lu, Owen Randall, <paullu@cs.ualberta.ca>
+#
+# Originally implemented by Owen Randall.
+#	Credits:  Owen Randall, Paul Lu
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# The store's hash index answers every lookup exactly, but each probe of a
+# large index is a random page read.  fingerprintIndex keeps in memory
+#  - a Bloom filter of every key, so a new chunk is known to be new
+#    without probing, and
+#  - one sampled hook per sampleRate keys (a 64-bit key hash and its chunk
+#    ID, 16 bytes), from which a segment of segmentSize neighbouring IDs
+#    is loaded into a small cache.  Chunks written together tend to come
+#    back together, so the duplicates that follow a hook are found in the
+#    cache.
+# Only keys that pass the Bloom filter and miss the cache reach the store's
+# index.  The filter and hooks are saved in chunks.data.fpi.  The filter
+# has a power of two bits, doubled once it is down to bitsPerKey bits per
+# key, so it holds 10 to 20 bits per key by default; with one hook in 64
+# that is 1.5 to 2.75 bytes per chunk.
+import os
+import struct
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+
+FPI_MAGIC = b'RFFP'
+FPI_VERSION = 2
+FPI_HEADER = struct.Struct('<4sIQIQQQ') # magic, version, filter bits, hashes, hooks, chunks covered, store bytes
+MIN_FILTER_BITS = 1 << 16
+
+def key_hashes(key):
+    # Two 64-bit hashes of a key.  Bytes 1 to 17 of the digest field are
+    # digest bytes for every chunk_digest.
+    h = int.from_bytes(key[1:17], 'little')
+    return h & 0xffffffffffffffff, (h >> 64) | 1
+
+class bloomFilter:
+    def __init__(self, bits, hashes = 7, data = None):
+        self.bits = bits # a power of two
+        self.hashes = hashes
+        self.data = bytearray(bits // 8) if data == None else bytearray(data)
+
+    def add(self, h1, h2):
+        mask = self.bits - 1
+        for i in range(self.hashes):
+            bit = (h1 + i * h2) & mask
+            self.data[bit >> 3] |= 1 << (bit & 7)
+
+    def __contains__(self, hashes):
+        h1, h2 = hashes
+        mask = self.bits - 1
+        for i in range(self.hashes):
+            bit = (h1 + i * h2) & mask
+            if not self.data[bit >> 3] & (1 << (bit & 7)):
+                return False
+        return True
+
+class fingerprintIndex:
+    # Wraps a chunkStore or containerStore, like chunk_cache.cachedStore
+    def __init__(self, store, fileName = None, bitsPerKey = 10, sampleRate = 64, segmentSize = 1024,
+                 cacheSegments = 64):
+        self.store = store
+        self.key_size = store.key_size
+        self.fileName = fileName if fileName != None else store.fileName + '.fpi'
+        self.bitsPerKey = bitsPerKey
+        self.sampleRate = sampleRate
+        self.segmentSize = segmentSize
+        self.cacheSegments = cacheSegments
+        self.segments = OrderedDict() # segment number -> its keys
+        self.cached = {} # key -> chunk ID, for the keys of the cached segments
+        self.filtered = 0
+        self.cacheHits = 0
+        self.load()
+
+    def load(self):
+        self.saved = 0 # chunks covered by chunks.data.fpi
+        try:
+            with open(self.fileName, 'rb') as f:
+                data = f.read()
+            magic, version, bits, hashes, hooks, covered, storeBytes = FPI_HEADER.unpack_from(data, 0)
+        except (OSError, struct.error):
+            magic = None
+        if magic != FPI_MAGIC or version != FPI_VERSION or covered > len(self.store) or storeBytes > self.store.data_size:
+            self.rebuild(max(MIN_FILTER_BITS, self.filter_bits(len(self.store))))
+            return
+        start = FPI_HEADER.size
+        self.filter = bloomFilter(bits, hashes, data[start : start + bits // 8])
+        start += bits // 8
+        self.hook_hashes = array('Q', data[start : start + 8 * hooks])
+        start += 8 * hooks
+        self.hook_ids = array('Q', data[start : start + 8 * hooks])
+        self.new_hooks = {}
+        self.covered = covered
+        self.saved = covered
+        # Chunks added to the store without this index
+        self.catch_up()
+
+    def filter_bits(self, count):
+        bits = MIN_FILTER_BITS
+        while bits < count * self.bitsPerKey:
+            bits *= 2
+        return bits
+
+    def rebuild(self, bits):
+        self.filter = bloomFilter(bits)
+        self.hook_hashes = array('Q')
+        self.hook_ids = array('Q')
+        self.new_hooks = {}
+        self.covered = 0
+        for chunkId in range(len(self.store)):
+            self.note(self.store.key_of(chunkId), chunkId)
+
+    def note(self, key, chunkId):
+        # Records a key the store holds
+        h1, h2 = key_hashes(key)
+        self.filter.add(h1, h2)
+        if (h2 >> 1) % self.sampleRate == 0:
+            self.new_hooks[h1] = chunkId
+        self.covered = max(self.covered, chunkId + 1)
+        if self.covered * self.bitsPerKey > self.filter.bits:
+            self.rebuild(self.filter_bits(len(self.store)))
+
+    def catch_up(self):
+        # Notes the chunks added to the store since the last covered one,
+        # by this index or by other writers sharing the store
+        for chunkId in range(self.covered, len(self.store)):
+            self.note(self.store.key_of(chunkId), chunkId)
+
+    def hook(self, h1):
+        # Chunk ID of a sampled key hash, or None
+        chunkId = self.new_hooks.get(h1)
+        if chunkId != None:
+            return chunkId
+        i = bisect_left(self.hook_hashes, h1)
+        if i < len(self.hook_hashes) and self.hook_hashes[i] == h1:
+            return self.hook_ids[i]
+        return None
+
+    def load_segment(self, chunkId):
+        segment = chunkId // self.segmentSize
+        if segment in self.segments:
+            self.segments.move_to_end(segment)
+            return
+        first = segment * self.segmentSize
+        keys = [self.store.key_of(i) for i in range(first, min(first + self.segmentSize, self.covered))]
+        self.segments[segment] = keys
+        for i, key in enumerate(keys):
+            self.cached[key] = first + i
+        while len(self.segments) > self.cacheSegments:
+            oldSegment, oldKeys = self.segments.popitem(last = False)
+            for key in oldKeys:
+                self.cached.pop(key, None)
+
+    def known_new(self, key):
+        # True if the Bloom filter rules key out.  The filter is caught up
+        # with every chunk the store has counted, so the store's add() need
+        # not look such a key up unless other writers append before it
+        # takes the lock, which it checks for.
+        self.catch_up()
+        if key_hashes(key) not in self.filter:
+            self.filtered += 1
+            return True
+        return False
+
+    def find(self, key):
+        # id_of() for a key that passes the filter
+        chunkId = self.cached.get(key)
+        if chunkId != None:
+            self.cacheHits += 1
+            return chunkId
+        chunkId = self.hook(key_hashes(key)[0])
+        if chunkId != None:
+            self.load_segment(chunkId)
+            chunkId = self.cached.get(key)
+            if chunkId != None:
+                self.cacheHits += 1
+                return chunkId
+        return self.store.id_of(key)
+
+    def id_of(self, key):
+        key = bytes(key)
+        if self.known_new(key):
+            return None
+        return self.find(key)
+
+    def __contains__(self, key):
+        return self.id_of(key) != None
+
+    def add(self, key, chunk):
+        key = bytes(key)
+        new = self.known_new(key)
+        if not new and self.find(key) != None:
+            return False
+        added = self.store.add(key, chunk, new)
+        self.added(key, added)
+        return added
+
+    def add_delta(self, key, baseId, depth, delta):
+        key = bytes(key)
+        if key in self:
+            return False
+        added = self.store.add_delta(key, baseId, depth, delta)
+        self.added(key, added)
+        return added
+
+    def added(self, key, added):
+        # After the store's add: its last chunk is key's if it was added,
+        # else another writer may have added it, and others, meanwhile
+        if not added:
+            self.store.update()
+        self.catch_up()
+        if added:
+            self.remember(key, len(self.store) - 1)
+
+    def add_many(self, items):
+        new = OrderedDict()
+        for key, chunk in items:
+            key = bytes(key)
+            if key not in new and (self.known_new(key) or self.find(key) == None):
+                new[key] = chunk
+        first = len(self.store)
+        # Every key was ruled out by the filter or looked up
+        added = self.store.add_many(new.items(), True)
+        self.catch_up()
+        if added == len(new) and len(self.store) - first == added:
+            for i, key in enumerate(new):
+                self.remember(key, first + i)
+        return added
+
+    def remember(self, key, chunkId):
+        # New chunks join the cache, as the rest of their segment will
+        segment = chunkId // self.segmentSize
+        if segment in self.segments:
+            self.segments[segment].append(key)
+            self.cached[key] = chunkId
+
+    def save_hooks(self):
+        # Merges the new hooks into the sorted arrays
+        if not self.new_hooks:
+            return
+        hooks = sorted(list(zip(self.hook_hashes, self.hook_ids)) + list(self.new_hooks.items()))
+        self.hook_hashes = array('Q', [h for h, chunkId in hooks])
+        self.hook_ids = array('Q', [chunkId for h, chunkId in hooks])
+        self.new_hooks = {}
+
+    def save(self):
+        self.save_hooks()
+        # Per process, as writers sharing the store save without its lock
+        tmpFileName = '%s.%d.tmp' % (self.fileName, os.getpid())
+        with open(tmpFileName, 'wb') as f:
+            f.write(FPI_HEADER.pack(FPI_MAGIC, FPI_VERSION, self.filter.bits, self.filter.hashes,
+                                    len(self.hook_hashes), self.covered, self.store.data_size))
+            f.write(self.filter.data)
+            f.write(self.hook_hashes.tobytes())
+            f.write(self.hook_ids.tobytes())
+        os.replace(tmpFileName, self.fileName)
+        self.saved = self.covered
+
+    def stats(self):
+        # probes counts every lookup the store makes, its add()s' included
+        return {'filtered': self.filtered, 'cacheHits': self.cacheHits, 'probes': self.store.lookups,
+                'hooks': len(self.hook_hashes) + len(self.new_hooks), 'filterBytes': len(self.filter.data)}
+
+    def compressed(self):
+        return self.store.compressed()
+
+    def __getitem__(self, key):
+        return self.store[key]
+
+    def __len__(self):
+        return len(self.store)
+
+    def flush(self):
+        # Only the store needs to be durable: a stale chunks.data.fpi costs
+        # a catch_up() when loaded, while saving rewrites all of it.  So it
+        # is saved here only once the chunks covered have doubled.
+        self.store.flush()
+        if self.covered > 2 * self.saved:
+            self.save()
+
+    def close(self):
+        self.store.close()
+        if self.covered != self.saved:
+            self.save()
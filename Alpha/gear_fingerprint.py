@@ -0,0 +1,120 @@
+#
+# gear_fingerprint.py - Gear hash (as used by FastCDC) for content-defined
+#	chunking, an alternative to the Rabin fingerprints
+#
+# Copyright (C) 2019 Paul Lu, Owen Randall, <paullu@cs.ualberta.ca>
+#
+# Originally implemented by Owen Randall.
+#	Credits:  Owen Randall, Paul Lu
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# The Gear hash is h = (h << 1) + table[byte] mod 2^64.  Each byte's
+# contribution shifts out after 64 bytes, so the hash covers an implicit
+# 64-byte window without keeping one.  The low bits only depend on the last
+# few bytes, so the fingerprint reported is the top 32 bits, and the usual
+# fingerprint & mask == cutValue test works on it.
+import random
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+GEAR_WINDOW = 64
+GEAR_MASK = (1 << 64) - 1
+
+gear_tables = {}
+
+def gear_table(seed = 0):
+    if seed not in gear_tables:
+        rng = random.Random(seed)
+        gear_tables[seed] = [rng.getrandbits(64) for i in range(2**8)]
+    return gear_tables[seed]
+
+class gearFingerprinter:
+    __slots__ = ('table', 'hash')
+
+    def __init__(self, table):
+        self.table = table
+        self.flush()
+
+    def update(self, byte):
+        self.hash = ((self.hash << 1) + self.table[byte]) & GEAR_MASK
+        return self.hash >> 32
+
+    def cut_points(self, data, mask, cut_value):
+        # Returns the offsets just past every byte whose fingerprint & mask
+        # equals cut_value
+        table = self.table
+        h = self.hash
+        cuts = []
+        for i, byte in enumerate(data):
+            h = ((h << 1) + table[byte]) & GEAR_MASK
+            if (h >> 32) & mask == cut_value:
+                cuts.append(i + 1)
+        self.hash = h
+        return cuts
+
+    def flush(self):
+        # As if the window held zero bytes, like the Rabin fingerprinters
+        h = 0
+        for i in range(GEAR_WINDOW - 1):
+            h = ((h << 1) + self.table[0]) & GEAR_MASK
+        self.hash = h
+
+class vectorGearFingerprinter:
+    # Batch equivalent of gearFingerprinter.  The hash after byte i is
+    # sum(table[b[i - k]] << k for k < 64), which is built by doubling: six
+    # shift-and-add passes over the block instead of one per window byte.
+    __slots__ = ('table', 'block_size', 'history')
+
+    def __init__(self, table, block_size = 1 << 20):
+        if np is None:
+            raise ImportError("vectorGearFingerprinter requires numpy")
+        self.table = np.array(table, dtype=np.uint64)
+        self.block_size = block_size
+        self.history = np.zeros(GEAR_WINDOW - 1, dtype=np.uint8)
+
+    def fold(self, block):
+        h = self.table.take(block)
+        shift = 1
+        while shift < GEAR_WINDOW:
+            h[shift:] += h[:-shift] << np.uint64(shift)
+            shift *= 2
+        n = len(block) - GEAR_WINDOW + 1
+        self.history = block[n:].copy()
+        return h[GEAR_WINDOW - 1:] >> np.uint64(32)
+
+    def update(self, data):
+        # Returns the fingerprint after each byte of data
+        view = np.frombuffer(data, dtype=np.uint8)
+        return self.fold(np.concatenate((self.history, view)))
+
+    def cut_points(self, data, mask, cut_value, small_mask = None):
+        # Same interface as vectorWindowFingerprinter.cut_points
+        view = np.frombuffer(data, dtype=np.uint8)
+        mask = np.uint64(mask)
+        cuts = [np.zeros(0, dtype=np.int64)]
+        small_cuts = [np.zeros(0, dtype=np.int64)]
+        for start in range(0, len(view), self.block_size):
+            f = self.fold(np.concatenate((self.history, view[start : start + self.block_size])))
+            cuts.append(np.flatnonzero(f & mask == cut_value) + (start + 1))
+            if small_mask != None:
+                small_cuts.append(np.flatnonzero(f & np.uint64(small_mask) == cut_value) + (start + 1))
+        if small_mask == None:
+            return np.concatenate(cuts)
+        return np.concatenate(cuts), np.concatenate(small_cuts)
+
+    def flush(self):
+        self.history = np.zeros(GEAR_WINDOW - 1, dtype=np.uint8)
@@ -0,0 +1,90 @@
+#
+# migrate_store.py - Rewrites a chunk store made with 3-byte lengths in the
+#	version 5 (or container version 6) format
+#
+# Copyright (C) 2019 Paul Lu, Owen Randall, <paullu@cs.ualberta.ca>
+#
+# Originally implemented by Owen Randall.
+#	Credits:  Owen Randall, Paul Lu
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Stores older than version 5 hold chunks under 16 MB, with 23-byte keys.
+# They stay readable, and appendable in their own format, so migrating is
+# only needed to add bigger chunks.  migrate_store() copies every record, in
+# chunk ID order, into a new store of the same kind next to the old one,
+# keeping the stored bytes as they are (a compressed chunk is not
+# recompressed, a delta keeps its base), so the chunk IDs do not change and
+# version 2 recipes still decode.  Version 1 recipes name chunks by 23-byte
+# keys, which stores take in either width.  The new store then replaces the
+# old one and its index, the fingerprint index is rebuilt on next use, and
+# the feature index is kept, as it names chunks by ID.  The old store is
+# locked while it is copied, but no other process should have it open, as
+# a writer holding it would go on appending to the replaced file.
+import os
+import sys
+import argparse
+from chunk_store import chunkStore, chunk_key, COMPRESSORS, KEY_SIZE64, DATA_VERSION
+from chunk_delta import DELTA_METHOD, DELTA_HEADER, DELTA_HEADER64
+from container_store import containerStore, open_store, CONTAINER_VERSION
+
+def migrate_store(fileName):
+    # Returns the number of chunks copied, or None if the store in fileName
+    # already has 8-byte lengths
+    try:
+        store = open_store(fileName, create = False)
+    except OSError:
+        print( "File open/read failed: %s" % (fileName) )
+        sys.exit(-1)
+    if store.key_size == KEY_SIZE64:
+        store.close()
+        return None
+    newFileName = fileName + '.migrating'
+    for name in (newFileName, newFileName + '.idx'):
+        if os.path.exists(name):
+            os.remove(name)
+    compression = COMPRESSORS[store.method][0]
+    if isinstance(store, containerStore):
+        new = containerStore(newFileName, compression = compression, containerSize = store.containerSize)
+    else:
+        new = chunkStore(newFileName, compression = compression)
+    with store.appendLock:
+        with new.appendLock:
+            for chunkId in range(len(store)):
+                key = store.key_of(chunkId)
+                method, stored = store.stored_of(chunkId)
+                if method == DELTA_METHOD:
+                    depth, baseId = DELTA_HEADER.unpack_from(stored, 0)
+                    stored = DELTA_HEADER64.pack(depth, baseId) + bytes(stored[DELTA_HEADER.size:])
+                new.append(chunk_key(key[:20], int.from_bytes(key[20:], 'big')), new.pack_stored(method, bytes(stored)))
+        count = len(new)
+        new.close()
+        if count != len(store):
+            raise ValueError("ERROR %s HAS DUPLICATE KEYS" % fileName)
+        os.replace(newFileName, fileName)
+        os.replace(newFileName + '.idx', store.indexFileName)
+    store.close()
+    if os.path.exists(fileName + '.fpi'):
+        os.remove(fileName + '.fpi')
+    return count
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Rewrite a chunk store in the version %d (container version %d) format, keeping its chunk IDs" % (DATA_VERSION, CONTAINER_VERSION))
+    parser.add_argument("commonFile", nargs = '?', default = 'chunks.data')
+    args = parser.parse_args()
+    count = migrate_store(args.commonFile)
+    if count == None:
+        print("%s already has 8-byte lengths" % (args.commonFile))
+    else:
+        print("Migrated %d chunks in %s" % (count, args.commonFile))
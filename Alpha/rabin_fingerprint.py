@@ -22,11 +22,20 @@
 
 import random
 from collections import deque
+from itertools import chain
+from functools import reduce
+from operator import xor
 import os
 import json
+try:
+    import numpy as np
+except ImportError:
+    np = None
 # import pdb
 
 class fingerprinter:
+    __slots__ = ('window', 'remainder', 'mask', 'irreducible')
+
     def __init__(self, d_size):
         self.window = pow(2, d_size + 1) - 1
         self.remainder = 0
@@ -45,6 +54,8 @@ class fingerprinter:
         self.remainder = 0
 
 class windowFingerprinter:
+    __slots__ = ('remainder', 'irreducible', 'window', 'mask', 'pop_polynomial')
+
     def __init__(self, degree, irreducible):
         self.remainder = 0
         self.irreducible = irreducible
@@ -66,6 +77,9 @@ class windowFingerprinter:
         self.remainder =  0
 
 class byteWindowFingerprinter:
+    __slots__ = ('remainder', 'irreducible', 'leading_window_bit', 'window', 'incoming_table',
+                 'outgoing_table', 'degree')
+
     def __init__(self, degree, irreducible):
         self.remainder = 0
         self.irreducible = irreducible
@@ -121,6 +135,8 @@ def compute_outgoing_table(irreducible, degree):
 
 
 class byteWindowFingerprinter3_1:
+    __slots__ = ('window', 'outgoing_table', 'fingerprint', 'degree', 'mask', 'irreducible')
+
     def __init__(self, irreducible, window_size):
         self.window = deque([0] * window_size)
         self.outgoing_table = compute_outgoing_table3_1(irreducible, window_size)
@@ -143,7 +159,7 @@ class byteWindowFingerprinter3_1:
 
 def compute_outgoing_table3_1(irreducible, window_size):
     table = []
-    for byte in range(255):
+    for byte in range(2**8):
         r = byte
         mask = 1 << (irreducible.bit_length() - 1)
         for i in range(window_size):
@@ -154,6 +170,8 @@ def compute_outgoing_table3_1(irreducible, window_size):
     return table
 
 class byteWindowFingerprinter3_2:
+    __slots__ = ('window', 'fingerprint', 'window_size')
+
     def __init__(self, window_size):
         self.window = deque([0] * window_size)
         self.fingerprint = 0
@@ -170,6 +188,9 @@ class byteWindowFingerprinter3_2:
 
 
 class byteWindowFingerprinter3_3:
+    __slots__ = ('window', 'step_size', 'outgoing_table', 'incoming_table', 'fingerprint', 'degree',
+                 'mask1', 'mask2', 'irreducible')
+
     def __init__(self, irreducible, window_size, step_size):
         self.window = deque([0] * window_size)
         self.step_size = step_size
@@ -217,7 +238,7 @@ def compute_incoming_table3_3(irreducible, step_size):
 
 def compute_outgoing_table3_3(irreducible, window_size):
     table = []
-    for byte in range(255):
+    for byte in range(2**8):
         r = byte
         mask = 1 << (irreducible.bit_length() - 1)
         for i in range(window_size):
@@ -228,78 +249,157 @@ def compute_outgoing_table3_3(irreducible, window_size):
     return table
 
 class byteWindowFingerprinter3_4:
+    # Advances step_size bytes per step with combined tables.  The low degree
+    # bits of each table entry are its contribution to the fingerprint after
+    # the step; above them sit step_size lanes of mask_size bits holding its
+    # contribution to fingerprint & mask after each byte of the step.  One
+    # XOR over the tables of the old fingerprint's bytes, the incoming bytes
+    # and the outgoing bytes gives the new fingerprint and all step_size cut
+    # tests at once.  A reference and benchmark class: in CPython
+    # byteWindowFingerprinter3.cut_points() is the faster of the two, so
+    # chunk_file uses that, and check_fingerprinter3_4() holds this one to it.
+    __slots__ = ('window_size', 'step_size', 'degree', 'rshift', 'mask2', 'cut_value', 'f_mask', 'lane_size',
+                 'tables', 'incoming_table', 'outgoing_table', 'fingerprint_bytes', 'low_bits', 'high_bits',
+                 'cut_lanes', 'fingerprint', 'history')
+
     def __init__(self, irreducible, window_size, step_size, cut_value, mask_size):
-        self.window = deque([0] * window_size)
+        self.window_size = window_size
         self.step_size = step_size
-        self.outgoing_table = compute_outgoing_table3_4(irreducible, window_size)
-        self.incoming_table = compute_incoming_table3_4(irreducible, step_size)
-        self.fingerprint = 0
         self.degree = irreducible.bit_length() - 1
-        self.mask1 = ((2 ** step_size) - 1) << self.degree
-        self.mask2 = (2 ** self.degree) - 1
-        self.irreducible = irreducible
+        self.rshift = self.degree - 8
+        self.mask2 = (2**self.degree) - 1
         self.cut_value = cut_value
         self.f_mask = (1 << mask_size) - 1
+        self.lane_size = max(mask_size, 1)
+        key = (irreducible, window_size, step_size, mask_size)
+        if key not in step_table_cache:
+            step_table_cache[key] = (compute_step_tables3_4(irreducible, window_size, step_size, mask_size),
+                                     compute_incoming_table3(irreducible),
+                                     compute_window_tables3(irreducible, window_size + 1)[window_size])
+        self.tables, self.incoming_table, self.outgoing_table = step_table_cache[key]
+        self.fingerprint_bytes = (self.degree + 7) // 8
+        self.low_bits = sum(1 << (j * self.lane_size) for j in range(step_size))
+        self.high_bits = self.low_bits << (self.lane_size - 1)
+        self.cut_lanes = (cut_value & self.f_mask) * self.low_bits
+        self.fingerprint = 0
+        self.history = bytes(window_size)
 
     def update(self, bytes):
-        fingerprints = []
-        for byte in bytes:
-            self.fingerprint = (self.fingerprint << 1) ^ byte ^ self.outgoing_table[self.window.pop()]
-            fingerprints.append(self.fingerprint & self.mask2)
-        top_n_bits = (self.mask1 & self.fingerprint) >> self.degree
-        incoming = self.incoming_table[top_n_bits]
-        self.fingerprint ^= incoming[-1]
-        self.window.extendleft(bytes)
-        for i in range(self.step_size):
-            print(fingerprints[i] ^ incoming[i])
+        # Returns the indices of the bytes after which a cut occurs
+        return [c - 1 for c in self.cut_points(bytes)]
+
+    def cut_points(self, data):
+        # Returns the offsets just past every byte of data whose fingerprint
+        # & mask equals cut_value, as the per-byte fingerprinters would
+        tables = self.tables
+        w = self.window_size
+        n = self.step_size
+        nbytes = self.fingerprint_bytes
+        degree = self.degree
+        mask2 = self.mask2
+        lane_size = self.lane_size
+        f_mask = self.f_mask
+        cut_value = self.cut_value
+        cut_lanes = self.cut_lanes
+        low_bits = self.low_bits
+        high_bits = self.high_bits
+        getitem = list.__getitem__
+        buf = self.history + bytes(data)
+        f = self.fingerprint
+        cuts = []
+        i = w
+        last = len(buf) - n
+        if cut_value <= f_mask:
+            while i <= last:
+                x = reduce(xor, map(getitem, tables, f.to_bytes(nbytes, 'little') + buf[i : i + n] + buf[i - w : i - w + n]))
+                f = x & mask2
+                lanes = (x >> degree) ^ cut_lanes
+                if (lanes - low_bits) & ~lanes & high_bits:
+                    for j in range(n):
+                        if (lanes >> (j * lane_size)) & f_mask == 0:
+                            cuts.append(i - w + j + 1)
+                i += n
+        else:
+            while i <= last:
+                f = reduce(xor, map(getitem, tables, f.to_bytes(nbytes, 'little') + buf[i : i + n] + buf[i - w : i - w + n])) & mask2
+                i += n
+        while i < len(buf):
+            f = self.incoming_table[f >> self.rshift] ^ ((f << 8) | buf[i]) & mask2 ^ self.outgoing_table[buf[i - w]]
+            if f & f_mask == cut_value:
+                cuts.append(i - w + 1)
+            i += 1
+        self.fingerprint = f
+        self.history = buf[len(buf) - w:]
+        return cuts
 
     def flush(self):
         self.fingerprint = 0
-        self.window = deque([0] * len(self.window))
-
-def compute_incoming_table3_4(irreducible, step_size):
-    table = []
-    m0 = 1 << (step_size - 1)
-    ir0 = irreducible >> (irreducible.bit_length() - step_size)
-    bits0 = 0
-    max = 1 << step_size
-    while bits0 < max:
-        incoming = []
-        bits1 = bits0
-        ir1 = ir0
-        m1 = m0
-        sum = 0
-        counter = 0
-        while counter < step_size:
-            if bits1 & m1 > 0:
-                sum ^= irreducible
-                bits1 ^= ir1
-            incoming.append(sum)
-            sum <<= 1
-            m1 >>= 1
-            ir1 >>= 1
-            counter += 1
-        table.append(incoming)
-        bits0 += 1
-    return table
-
-def compute_outgoing_table3_4(irreducible, window_size):
-    table = []
-    for byte in range(255):
-        r = byte
-        mask = 1 << (irreducible.bit_length() - 1)
-        for i in range(window_size):
-            r <<= 1
-            if r & mask > 0:
-                r ^= irreducible
-        table.append(r)
-    return table
+        self.history = bytes(self.window_size)
+
+def check_fingerprinter3_4(irreducible, window_size, step_size, mask_size, length = 10000, seed = 0):
+    # Compares byteWindowFingerprinter3_4 against byteWindowFingerprinter3 on
+    # random data fed in uneven pieces, the same data for the same seed
+    rng = random.Random(seed) # Without touching the global generator
+    data = bytes(rng.getrandbits(8) for i in range(length))
+    f_mask = (1 << mask_size) - 1
+    reference = byteWindowFingerprinter3(irreducible, window_size)
+    expected = [i + 1 for i, byte in enumerate(data) if reference.update(byte) & f_mask == 1]
+    fingerprinter = byteWindowFingerprinter3_4(irreducible, window_size, step_size, 1, mask_size)
+    cuts = []
+    start = 0
+    for size in (1, step_size + 1, 3 * step_size - 1, length):
+        cuts.extend(start + c for c in fingerprinter.cut_points(data[start : start + size]))
+        start += size
+    return cuts == expected and fingerprinter.fingerprint == reference.fingerprint
+
+def compute_step_tables3_4(irreducible, window_size, step_size, mask_size):
+    # Tables for byteWindowFingerprinter3_4, in the order the step consumes
+    # them: the bytes of the old fingerprint (low byte first), the incoming
+    # bytes, then the bytes leaving the window
+    degree = irreducible.bit_length() - 1
+    f_mask = (1 << mask_size) - 1
+    lane_size = max(mask_size, 1)
+    window_tables = compute_window_tables3(irreducible, window_size + step_size)
+    def pack(full, lanes):
+        packed = full
+        for j, lane in enumerate(lanes):
+            packed |= (lane & f_mask) << (degree + j * lane_size)
+        return packed
+    tables = []
+    for q in range((degree + 7) // 8):
+        # The old fingerprint is carried j bytes further by lane j
+        tables.append([pack(divide_polynomial((v << 8 * q) << 8 * step_size, irreducible),
+                            [divide_polynomial((v << 8 * q) << 8 * (j + 1), irreducible) for j in range(step_size)])
+                       for v in range(2**8)])
+    for t in range(step_size):
+        # Incoming byte t is at position j - t of the window after byte j
+        def window_table(k):
+            return window_tables[k] if 0 <= k < window_size else [0] * (2**8)
+        full = window_table(step_size - 1 - t)
+        lanes = [window_table(j - t) for j in range(step_size)]
+        tables.append([pack(full[v], [lane[v] for lane in lanes]) for v in range(2**8)])
+    for t in range(step_size):
+        # The byte window_size - t positions back leaves the window with
+        # byte t of the step, so it is removed from lanes t onwards
+        def leaving_table(k):
+            return window_tables[k] if t < window_size and k >= window_size else [0] * (2**8)
+        full = leaving_table(window_size - t - 1 + step_size)
+        lanes = [leaving_table(window_size - t - 1 + j + 1) if j >= t else [0] * (2**8) for j in range(step_size)]
+        tables.append([pack(full[v], [lane[v] for lane in lanes]) for v in range(2**8)])
+    return tables
 
 class byteWindowFingerprinter3:
-    def __init__(self, irreducible, window_size):
+    __slots__ = ('window', 'incoming_table', 'outgoing_table', 'fingerprint', 'degree', 'rshift', 'mask1',
+                 'mask2')
+
+    def __init__(self, irreducible, window_size, incoming_table = None, outgoing_table = None):
         self.window = deque([0] * window_size)
-        self.incoming_table = compute_incoming_table3(irreducible)
-        self.outgoing_table = compute_outgoing_table3(irreducible, window_size)
+        if incoming_table == None:
+            incoming_table = compute_incoming_table3(irreducible)
+        if outgoing_table == None:
+            outgoing_table = compute_outgoing_table3(irreducible, window_size)
+        self.incoming_table = incoming_table
+        self.outgoing_table = outgoing_table
         self.fingerprint = 0
         self.degree = irreducible.bit_length() - 1
         self.rshift = self.degree - 8
@@ -314,6 +414,32 @@ class byteWindowFingerprinter3:
         self.window.appendleft(byte)
         return self.fingerprint
 
+    def cut_points(self, data, mask, cut_value):
+        # Returns the offsets just past every byte of data whose fingerprint
+        # & mask equals cut_value, as update() would find them.  Instead of
+        # going through the window, each outgoing byte is read from data
+        # itself, window_size bytes back (from the window only for the first
+        # window_size bytes), and the window is refilled once at the end.
+        window = self.window
+        history = bytes(reversed(window))
+        incoming_table = self.incoming_table
+        outgoing_table = self.outgoing_table
+        rshift = self.rshift
+        mask2 = self.mask2
+        f = self.fingerprint
+        cuts = []
+        i = 0
+        for outgoing, byte in zip(chain(history, data), data):
+            i += 1
+            f = incoming_table[f >> rshift] ^ outgoing_table[outgoing] ^ ((f << 8) | byte) & mask2
+            if f & mask == cut_value:
+                cuts.append(i)
+        self.fingerprint = f
+        tail = (history + bytes(data[-len(window):]))[-len(window):]
+        window.clear()
+        window.extendleft(tail)
+        return cuts
+
     def flush(self):
         self.fingerprint = 0
         self.window = deque([0] * len(self.window))
@@ -333,8 +459,130 @@ def compute_outgoing_table3(irreducible, window_size):
         table[byte] = r
     return table
 
+# In-process caches of polynomials and lookup tables; fingerprint_tables()
+# also keeps its tables on disk in TABLE_CACHE_DIR ('' disables that)
+table_cache = {}
+step_table_cache = {}
+TABLE_CACHE_VERSION = 2 # Bumped when irreducible_polynomial() changes
+TABLE_CACHE_DIR = os.environ.get('RABIN_TABLE_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'rabin_fingerprint'))
+
+def fingerprint_tables(degree, window_size):
+    # Returns (irreducible, incoming_table, window_tables) for
+    # byteWindowFingerprinter3 and vectorWindowFingerprinter, where
+    # window_tables[window_size] is the outgoing table
+    key = (degree, window_size)
+    if key in table_cache:
+        return table_cache[key]
+    tables = None
+    fileName = None
+    if TABLE_CACHE_DIR:
+        fileName = os.path.join(TABLE_CACHE_DIR, "tables-%d-%d-v%d.json" % (degree, window_size, TABLE_CACHE_VERSION))
+        try:
+            with open(fileName) as f:
+                cached = json.load(f)
+            tables = (cached["irreducible"], cached["incoming_table"], cached["window_tables"])
+            if tables[0].bit_length() - 1 != degree or len(tables[2]) != window_size + 1:
+                tables = None
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            tables = None
+    if tables == None:
+        irreducible = irreducible_polynomial(degree)
+        tables = (irreducible, compute_incoming_table3(irreducible), compute_window_tables3(irreducible, window_size + 1))
+        if fileName != None:
+            try:
+                os.makedirs(TABLE_CACHE_DIR, exist_ok = True)
+                tmpFileName = "%s.%d.tmp" % (fileName, os.getpid())
+                with open(tmpFileName, 'w') as f:
+                    json.dump({"irreducible": tables[0], "incoming_table": tables[1], "window_tables": tables[2]}, f)
+                os.replace(tmpFileName, fileName)
+            except OSError:
+                pass
+    table_cache[key] = tables
+    return tables
+
+def compute_window_tables3(irreducible, window_size):
+    # table k maps a byte to (byte * x^(8k)) mod irreducible, i.e. the
+    # contribution of a byte k positions back in the window
+    incoming_table = compute_incoming_table3(irreducible)
+    degree = irreducible.bit_length() - 1
+    rshift = degree - 8
+    mask2 = (2**degree) - 1
+    tables = [list(range(2**8))]
+    for k in range(1, window_size):
+        prev = tables[-1]
+        tables.append([incoming_table[r >> rshift] ^ ((r << 8) & mask2) for r in prev])
+    return tables
+
+class vectorWindowFingerprinter:
+    # Batch equivalent of byteWindowFingerprinter3.  The fingerprint after a
+    # byte is the XOR of the window tables over the last window_size bytes, so
+    # a whole buffer is fingerprinted with window_size NumPy table lookups.
+    __slots__ = ('window_size', 'block_size', 'tables', 'masked_tables', 'history')
+
+    def __init__(self, irreducible, window_size, block_size = 1 << 20, window_tables = None):
+        if np is None:
+            raise ImportError("vectorWindowFingerprinter requires numpy")
+        self.window_size = window_size
+        self.block_size = block_size
+        if window_tables == None:
+            window_tables = compute_window_tables3(irreducible, window_size)
+        self.tables = [np.array(t, dtype=np.uint64) for t in window_tables[:window_size]]
+        self.masked_tables = {}
+        self.history = np.zeros(window_size - 1, dtype=np.uint8)
+
+    def get_masked_tables(self, mask):
+        # Only fingerprint & mask is needed to find cuts, and masking commutes
+        # with XOR, so use the narrowest dtype that holds the mask
+        if mask not in self.masked_tables:
+            for dtype in (np.uint8, np.uint16, np.uint32, np.uint64):
+                if mask <= np.iinfo(dtype).max:
+                    break
+            self.masked_tables[mask] = [(t & np.uint64(mask)).astype(dtype) for t in self.tables]
+        return self.masked_tables[mask]
+
+    def fold(self, block, tables):
+        n = len(block) - self.window_size + 1
+        top = self.window_size - 1
+        f = tables[0].take(block[top:])
+        for k in range(1, self.window_size):
+            f ^= tables[k].take(block[top - k : top - k + n])
+        self.history = block[n:].copy()
+        return f
+
+    def update(self, data):
+        # Returns the fingerprint after each byte of data
+        view = np.frombuffer(data, dtype=np.uint8)
+        return self.fold(np.concatenate((self.history, view)), self.tables)
+
+    def cut_points(self, data, mask, cut_value, small_mask = None):
+        # Returns the offsets just past every byte whose fingerprint & mask
+        # equals cut_value, i.e. the chunk ends found by the per-byte loop.
+        # With small_mask, also returns the offsets matching small_mask, from
+        # the same pass.
+        tables = self.get_masked_tables(mask if small_mask == None else mask | small_mask)
+        view = np.frombuffer(data, dtype=np.uint8)
+        cuts = [np.zeros(0, dtype=np.int64)]
+        small_cuts = [np.zeros(0, dtype=np.int64)]
+        for start in range(0, len(view), self.block_size):
+            block = np.concatenate((self.history, view[start : start + self.block_size]))
+            f = self.fold(block, tables)
+            if small_mask == None:
+                cuts.append(np.flatnonzero(f == cut_value) + (start + 1))
+            else:
+                cuts.append(np.flatnonzero(f & mask == cut_value) + (start + 1))
+                small_cuts.append(np.flatnonzero(f & small_mask == cut_value) + (start + 1))
+        if small_mask == None:
+            return np.concatenate(cuts)
+        return np.concatenate(cuts), np.concatenate(small_cuts)
+
+    def flush(self):
+        self.history = np.zeros(self.window_size - 1, dtype=np.uint8)
+
 
 class byteWindowFingerprinter2:
+    __slots__ = ('remainder', 'step_size', 'irreducible', 'window', 'leading_window_bit', 'incoming_table',
+                 'outgoing_table', 'degree')
+
     def __init__(self, degree, irreducible, step_size):
         self.remainder = 0
         self.step_size = step_size
@@ -400,20 +648,28 @@ def compute_outgoing_table2(irreducible, degree, step_size):
     return table
 
 
-def irreducible_polynomial(d): #Return a random polynomial of degree. Degree must be > 1
-    random.seed(d)
+def irreducible_polynomial(d, seed = None): #Return a random irreducible polynomial of degree d. Degree must be > 1
+    #The same d and seed always give the same polynomial. The first candidate drawn is the polynomial
+    #earlier versions returned, so existing chunk boundaries are kept whenever it was irreducible.
+    rng = random.Random(d if seed == None else seed) #Without touching the global generator
+    while True:
+        p = random_polynomial(d, rng)
+        if is_irreducible(p):
+            return p
+
+def random_polynomial(d, rng): #Return a random polynomial of degree d with an odd number of terms
     p = 1 #Start with leading coefficient of 1 so the polynomial is of degree d
     odd = False #is there an odd number of non-zero coefficients? Must be odd to be irreducible.
                 #Starts False as the constant coefficient is always set to 1 at the end
     for i in range(d - 1):
         p = p << 1
-        if bool(random.getrandbits(1)): #Randomly set coefficients to 1
+        if bool(rng.getrandbits(1)): #Randomly set coefficients to 1
             p = p | 1
             odd = not odd
     p = p << 1
     p = p | 1 #Add the trailing coefficient of one. Must have this for irreducible polynomials
     if not odd: #Make sure there's an odd number of non-zero coefficients
-        index = random.randint(1, d - 1) #Get a random non-leading and non-trailing coefficient
+        index = rng.randint(1, d - 1) #Get a random non-leading and non-trailing coefficient
         mask = 1 << index
         if p & mask == 0: #Swap the coefficient value to make an odd number
             p = p | mask #The bit is 0, set to 1
@@ -421,6 +677,58 @@ def irreducible_polynomial(d): #Return a random polynomial of degree. Degree mus
             p = p ^ mask #The bit is 1, set to 0
     return p
 
+def is_irreducible(p): #Rabin's test over GF(2)
+    #p of degree n is irreducible iff x^(2^n) = x mod p and gcd(x^(2^(n/q)) - x, p) = 1
+    #for every prime q dividing n
+    n = p.bit_length() - 1
+    if n < 1:
+        return False
+    x = mod_polynomial(2, p)
+    powers = [x] #powers[k] is x^(2^k) mod p, by repeated squaring
+    for k in range(n):
+        powers.append(mod_polynomial(square_polynomial(powers[-1]), p))
+    if powers[n] != x: #Most reducible polynomials fail here, before any gcd
+        return False
+    for q in prime_factors(n):
+        if gcd_polynomial(powers[n // q] ^ x, p) != 1:
+            return False
+    return True
+
+def mod_polynomial(p1, p2): #Return p1 mod p2, like divide_polynomial but one step per set leading bit
+    n = p2.bit_length()
+    while p1.bit_length() >= n:
+        p1 ^= p2 << (p1.bit_length() - n)
+    return p1
+
+def square_polynomial(p): #Squaring over GF(2) spreads the coefficients out: (sum a_i x^i)^2 = sum a_i x^2i
+    r = 0
+    shift = 0
+    while p > 0:
+        r |= spread_table[p & 255] << shift
+        p >>= 8
+        shift += 16
+    return r
+
+def gcd_polynomial(p1, p2):
+    while p2 > 0:
+        p1, p2 = p2, mod_polynomial(p1, p2)
+    return p1
+
+def prime_factors(n):
+    factors = []
+    q = 2
+    while q * q <= n:
+        if n % q == 0:
+            factors.append(q)
+            while n % q == 0:
+                n //= q
+        q += 1
+    if n > 1:
+        factors.append(n)
+    return factors
+
+spread_table = [sum(((b >> i) & 1) << (2 * i) for i in range(8)) for b in range(2**8)]
+
 
 def divide_polynomial(p1, p2): #return p1 - p2. Assuming p1 >= p2
     mask = 1
@@ -481,3 +789,8 @@ if __name__ == "__main__":
         #     print("B", b)
         print(f)
         # print(f, chr(fingerprinter.window[0]), chr(fingerprinter.window[1]))
+
+    for degree, window_size, mask_size in ((8, 3, 8), (16, 1, 4), (32, 16, 6), (64, 48, 10)):
+        for step_size in (4, 8):
+            print("byteWindowFingerprinter3_4", degree, window_size, step_size, mask_size,
+                  check_fingerprinter3_4(irreducible_polynomial(degree), window_size, step_size, mask_size))
@@ -0,0 +1,204 @@
+#
+# recipe.py - Version 2 .encoded recipes: chunk IDs as delta varints with
+#	run-length encoding
+#
+# Copyright (C) 2019 Paul Lu, Owen Randall, <paullu@cs.ualberta.ca>
+#
+# Originally implemented by Owen Randall.
+#	Credits:  Owen Randall, Paul Lu
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# A version 1 recipe is the bare sequence of 23-byte chunk keys.  A version
+# 2 recipe is
+#   header | chunking parameters (JSON) | tokens
+# where the tokens name chunks by their integer ID in the chunk store, so a
+# recipe only decodes against the store it was encoded with.  Each token is
+# the varint zigzag(delta) << 2 | kind, delta being the chunk ID minus one
+# more than the previous chunk ID.  kind 0 is a single chunk; kind 1 (a run
+# of consecutive IDs, as new chunks get) and kind 2 (one chunk repeated)
+# are followed by a varint count - 2.  A version 3 recipe also follows each
+# token with the varint lengths of its chunks: one per chunk of a kind 0 or
+# 1 token, one for the repeated chunk of kind 2.  The offsets of the chunks
+# in the file then come from the recipe alone, so a byte range is found
+# without reading a key from the store for every chunk, for a byte or two
+# per chunk.
+import json
+import struct
+from array import array
+from itertools import accumulate
+
+RECIPE_MAGIC = b'RFRC'
+RECIPE_VERSION = 3
+RECIPE_HEADER = struct.Struct('<4sHIQQ') # magic, version, parameter bytes, file size, chunks
+RECIPE_SINGLE = 0
+RECIPE_STEP = 1
+RECIPE_REPEAT = 2
+
+def put_varint(out, value):
+    while value >= 0x80:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+def get_varint(data, pos):
+    # Returns (value, position after it)
+    value = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return value, pos
+        shift += 7
+
+def encode_ids(ids, lengths = None):
+    out = bytearray()
+    prev = -1
+    i = 0
+    n = len(ids)
+    while i < n:
+        chunkId = ids[i]
+        delta = chunkId - prev - 1
+        zigzag = delta * 2 if delta >= 0 else -delta * 2 - 1
+        j = i + 1
+        if j < n and ids[j] == chunkId + 1:
+            while j < n and ids[j] == ids[j - 1] + 1:
+                j += 1
+            kind = RECIPE_STEP
+        elif j < n and ids[j] == chunkId:
+            while j < n and ids[j] == chunkId:
+                j += 1
+            kind = RECIPE_REPEAT
+        else:
+            kind = RECIPE_SINGLE
+        put_varint(out, zigzag << 2 | kind)
+        if kind != RECIPE_SINGLE:
+            put_varint(out, j - i - 2)
+        if lengths != None:
+            for length in lengths[i : j if kind == RECIPE_STEP else i + 1]:
+                put_varint(out, length)
+        prev = ids[j - 1]
+        i = j
+    return bytes(out)
+
+def decode_runs(blocks, count, withLengths = False):
+    # Single pass over the token bytes, which come as an iterable of blocks.
+    # Yields (first chunk ID, chunks, step, lengths) for each token, step
+    # being 0 for one chunk repeated and otherwise 1, and lengths a list of
+    # the token's chunk lengths in a version 3 recipe, else None.
+    prev = -1
+    value = 0
+    shift = 0
+    kind = None
+    total = 0
+    unread = 0 # lengths still to come after the current token
+    for block in blocks:
+        for byte in block:
+            value |= (byte & 0x7f) << shift
+            if byte & 0x80:
+                shift += 7
+                continue
+            shift = 0
+            n = 0
+            if unread > 0:
+                lengths.append(value)
+                unread -= 1
+                if unread == 0:
+                    yield chunkId, runSize, step, lengths
+                    kind = None
+            elif kind == None:
+                kind = value & 3
+                delta = value >> 2
+                delta = delta >> 1 if delta & 1 == 0 else -(delta >> 1) - 1
+                chunkId = prev + 1 + delta
+                if kind == RECIPE_SINGLE:
+                    n = 1
+            else:
+                n = value + 2
+            value = 0
+            if n == 0:
+                continue
+            step = 0 if kind == RECIPE_REPEAT else 1
+            prev = chunkId + (n - 1) * step
+            total += n
+            if withLengths:
+                runSize = n
+                lengths = []
+                unread = n if step else 1
+            else:
+                yield chunkId, n, step, None
+                kind = None
+    if kind != None or shift != 0 or total != count:
+        raise ValueError("ERROR TRUNCATED RECIPE")
+
+def decode_ids(data, count, lengths = None):
+    # Returns an array of chunk IDs, and appends their lengths to the array
+    # lengths for a version 3 recipe
+    ids = array('Q')
+    for chunkId, n, step, runLengths in decode_runs((data,), count, lengths != None):
+        if step:
+            ids.extend(range(chunkId, chunkId + n))
+        else:
+            ids.extend(array('Q', [chunkId]) * n)
+        if lengths != None:
+            lengths.extend(runLengths if step else array('Q', runLengths) * n)
+    return ids
+
+def recipe_chunks(fileObject, count, withLengths, blockSize = 1 << 16):
+    # Yields (chunk ID, length) for each chunk of a recipe whose tokens
+    # follow in fileObject, reading blockSize bytes at a time, so memory use
+    # does not depend on the number of chunks.  The lengths are None
+    # without withLengths.
+    blocks = iter(lambda: fileObject.read(blockSize), b'')
+    for chunkId, n, step, lengths in decode_runs(blocks, count, withLengths):
+        for i in range(n):
+            yield chunkId + i * step, lengths[i * step] if lengths != None else None
+
+def write_recipe(fileObject, ids, fileSize, parameters, lengths = None):
+    # A version 3 recipe if the chunk lengths are given, else version 2
+    params = json.dumps(parameters, sort_keys = True).encode()
+    version = 2 if lengths == None else RECIPE_VERSION
+    fileObject.write(RECIPE_HEADER.pack(RECIPE_MAGIC, version, len(params), fileSize, len(ids)))
+    fileObject.write(params)
+    fileObject.write(encode_ids(ids, lengths))
+
+def is_recipe(data):
+    # True if data starts like a version 2 or 3 recipe
+    return len(data) >= RECIPE_HEADER.size and bytes(data[:4]) == RECIPE_MAGIC
+
+def read_header(head):
+    # (version, parameter bytes, file size, chunks) of a version 2 or 3
+    # recipe starting with head
+    magic, version, paramSize, fileSize, count = RECIPE_HEADER.unpack_from(head, 0)
+    if magic != RECIPE_MAGIC or version not in (2, RECIPE_VERSION):
+        raise ValueError("ERROR UNKNOWN RECIPE FORMAT")
+    return version, paramSize, fileSize, count
+
+def read_recipe(data):
+    # Returns (parameters, file size, array of chunk IDs, offsets) of a
+    # version 2 or 3 recipe, offsets being None for version 2 and otherwise
+    # an array of the offset of each chunk in the file, then the file size
+    version, paramSize, fileSize, count = read_header(data)
+    start = RECIPE_HEADER.size + paramSize
+    parameters = json.loads(bytes(data[RECIPE_HEADER.size : start]).decode())
+    if version != RECIPE_VERSION:
+        return parameters, fileSize, decode_ids(memoryview(data)[start:], count), None
+    lengths = array('Q')
+    ids = decode_ids(memoryview(data)[start:], count, lengths)
+    offsets = array('Q', accumulate(lengths, initial = 0))
+    if offsets[-1] != fileSize:
+        raise ValueError("ERROR RECIPE CHUNKS ADD UP TO %d BYTES, NOT %d" % (offsets[-1], fileSize))
+    return parameters, fileSize, ids, offsets
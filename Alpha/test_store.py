@@ -0,0 +1,308 @@
+#
+# test_store.py - Tests of store migration, torn tail recovery, corruption
+#	and byte range restores, and of byteWindowFingerprinter3_4; run by
+#	make check
+#
+# Copyright (C) 2019 Paul Lu, Owen Randall, <paullu@cs.ualberta.ca>
+#
+# Originally implemented by Owen Randall.
+#	Credits:  Owen Randall, Paul Lu
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Each test works in its own temporary directory.  Stores in the older
+# formats are written byte by byte, as this tree no longer creates them.
+import io
+import os
+import random
+import shutil
+import struct
+import hashlib
+import tempfile
+import unittest
+import contextlib
+from chunk_store import chunkStore, chunk_key, KEY_SIZE, KEY_SIZE64, DATA_MAGIC
+from container_store import open_store, CONTAINER_DATA_HEADER, CONTAINER_MAGIC, CONTAINER_HEADER3, CONTAINER_ENTRY3
+from migrate_store import migrate_store
+from fingerprint_index import fingerprintIndex
+from recipe import write_recipe
+from encode import encode, encode_tree
+from chunk_cache import make_cache
+from decode import decode_to_file, decode_range, encodedReader
+from rabin_fingerprint import check_fingerprinter3_4, irreducible_polynomial
+
+def make_chunks(count, seed):
+    rng = random.Random(seed)
+    return [bytes(rng.getrandbits(8) for i in range(rng.randrange(100, 2000))) for j in range(count)]
+
+def key_of(chunk, keySize = KEY_SIZE64):
+    return chunk_key(hashlib.sha1(chunk).digest(), len(chunk), keySize)
+
+def read_file(fileName):
+    with open(fileName, 'rb') as f:
+        return f.read()
+
+def flip_byte(fileName, offset):
+    with open(fileName, 'r+b') as f:
+        f.seek(offset)
+        byte = f.read(1)[0]
+        f.seek(offset)
+        f.write(bytes([byte ^ 1]))
+
+class storeTest(unittest.TestCase):
+    def setUp(self):
+        self.oldDir = os.getcwd()
+        self.dir = tempfile.mkdtemp()
+        os.chdir(self.dir)
+
+    def tearDown(self):
+        os.chdir(self.oldDir)
+        shutil.rmtree(self.dir)
+
+    def write_store(self, chunks, containerSize = None):
+        store = open_store('chunks.data', compression = 'zlib', containerSize = containerSize)
+        for chunk in chunks:
+            store.add(key_of(chunk), chunk)
+        store.close()
+        return os.path.getsize('chunks.data')
+
+    def check_store(self, chunks, **options):
+        store = open_store('chunks.data', create = False, **options)
+        self.assertEqual(len(store), len(chunks))
+        for chunkId, chunk in enumerate(chunks):
+            self.assertEqual(bytes(store[chunkId]), chunk)
+            self.assertEqual(bytes(store[key_of(chunk)]), chunk)
+        store.close()
+
+class migrationTest(storeTest):
+    def write_recipes(self, chunks):
+        with open('f.encoded1', 'wb') as f:
+            f.write(b''.join(key_of(chunk, KEY_SIZE) for chunk in chunks))
+        with open('f.encoded2', 'wb') as f:
+            write_recipe(f, list(range(len(chunks))), sum(map(len, chunks)), {})
+
+    def check_migrated(self, chunks):
+        self.assertEqual(migrate_store('chunks.data'), len(chunks))
+        with open_store('chunks.data', readOnly = True) as store:
+            self.assertEqual(store.key_size, KEY_SIZE64)
+        self.check_store(chunks)
+        for version in (1, 2):
+            decode_to_file('f.encoded%d' % version, 'f.decoded', 'chunks.data')
+            self.assertEqual(read_file('f.decoded'), b''.join(chunks))
+        self.assertEqual(migrate_store('chunks.data'), None)
+
+    def test_legacy(self):
+        # The original headerless layout: 23-byte key | chunk
+        chunks = make_chunks(50, 1)
+        with open('chunks.data', 'wb') as f:
+            for chunk in chunks:
+                f.write(key_of(chunk, KEY_SIZE) + chunk)
+        self.write_recipes(chunks)
+        self.check_migrated(chunks)
+        # A chunk too big for 3-byte lengths now fits
+        big = bytes(1 << 24)
+        store = chunkStore('chunks.data')
+        self.assertTrue(store.add(key_of(big), big))
+        store.close()
+        with chunkStore('chunks.data', readOnly = True) as store:
+            self.assertEqual(len(bytes(store[len(chunks)])), 1 << 24)
+
+    def test_container3(self):
+        # Version 3 containers of records method | 3-byte length | stored bytes
+        chunks = make_chunks(50, 2)
+        with open('chunks.data', 'wb') as f:
+            f.write(CONTAINER_DATA_HEADER.pack(DATA_MAGIC, 3, 0, 20000))
+            for start in range(0, len(chunks), 20):
+                data = b''
+                entries = b''
+                for chunk in chunks[start : start + 20]:
+                    data += b'\0' + len(chunk).to_bytes(3, 'big')
+                    entries += CONTAINER_ENTRY3.pack(key_of(chunk, KEY_SIZE), len(data))
+                    data += chunk
+                f.write(CONTAINER_HEADER3.pack(CONTAINER_MAGIC, len(chunks[start : start + 20]), len(data)))
+                f.write(data + entries)
+        self.write_recipes(chunks)
+        self.check_store(chunks)
+        self.check_migrated(chunks)
+
+class recoveryTest(storeTest):
+    def check_torn_tail(self, containerSize):
+        chunks = make_chunks(60, 3)
+        size = self.write_store(chunks[:40], containerSize)
+        # A writer that died mid-append, its bytes never indexed
+        with open('chunks.data', 'ab') as f:
+            f.write(key_of(chunks[40]) + b'\0\0\0\1' + chunks[40][:300])
+        before = read_file('chunks.data')
+        self.check_store(chunks[:40], readOnly = True)
+        self.assertEqual(read_file('chunks.data'), before)
+        with contextlib.redirect_stdout(io.StringIO()):
+            store = open_store('chunks.data')
+        self.assertEqual(os.path.getsize('chunks.data'), size)
+        for chunk in chunks[40:]:
+            store.add(key_of(chunk), chunk)
+        store.close()
+        self.check_store(chunks)
+
+    def test_torn_tail(self):
+        self.check_torn_tail(None)
+
+    def test_torn_container(self):
+        self.check_torn_tail(8192)
+
+    def check_corruption(self, containerSize):
+        # A bit flip below the fsynced bytes raises rather than truncating,
+        # even when the index is rebuilt
+        chunks = make_chunks(40, 4)
+        size = self.write_store(chunks, containerSize)
+        flip_byte('chunks.data', size // 3)
+        os.remove('chunks.data.idx')
+        for readOnly in (True, False):
+            with self.assertRaises(ValueError):
+                open_store('chunks.data', readOnly = readOnly)
+            self.assertEqual(os.path.getsize('chunks.data'), size)
+
+    def test_corruption(self):
+        self.check_corruption(None)
+
+    def test_corrupt_container(self):
+        self.check_corruption(8192)
+
+    def test_corrupt_read(self):
+        # With the index intact the bad chunk fails its CRC when read
+        chunks = make_chunks(40, 5)
+        for containerSize in (None, 8192):
+            for name in ('chunks.data', 'chunks.data.idx'):
+                if os.path.exists(name):
+                    os.remove(name)
+            size = self.write_store(chunks, containerSize)
+            flip_byte('chunks.data', size // 3)
+            store = open_store('chunks.data', readOnly = True)
+            with self.assertRaises(ValueError):
+                for chunkId in range(len(chunks)):
+                    store[chunkId]
+            store.close()
+
+class indexTest(storeTest):
+    def test_filtered_adds(self):
+        # Chunks the Bloom filter rules out are added without a lookup
+        chunks = make_chunks(200, 9)
+        for containerSize in (None, 8192):
+            for name in ('chunks.data', 'chunks.data.idx', 'chunks.data.fpi'):
+                if os.path.exists(name):
+                    os.remove(name)
+            index = fingerprintIndex(open_store('chunks.data', containerSize = containerSize))
+            for chunk in chunks[:100]:
+                self.assertTrue(index.add(key_of(chunk), chunk))
+            self.assertEqual(index.add_many((key_of(chunk), chunk) for chunk in chunks[100:]), 100)
+            stats = index.stats()
+            self.assertEqual(stats['probes'], len(chunks) - stats['filtered'])
+            self.assertEqual(index.add_many((key_of(chunk), chunk) for chunk in chunks), 0)
+            index.close()
+            self.check_store(chunks)
+
+    def test_saves(self):
+        # A flush after every chunk saves chunks.data.fpi only as it doubles
+        chunks = make_chunks(200, 10)
+        index = fingerprintIndex(open_store('chunks.data'))
+        saves = []
+        save = index.save
+        def counted_save():
+            saves.append(index.covered)
+            save()
+        index.save = counted_save
+        for chunk in chunks:
+            index.add(key_of(chunk), chunk)
+            index.flush()
+        index.close()
+        self.assertEqual(saves, [1, 3, 7, 15, 31, 63, 127, 200])
+        index = fingerprintIndex(open_store('chunks.data'))
+        self.assertEqual(index.saved, len(chunks))
+        index.close()
+
+class rangeTest(storeTest):
+    def setUp(self):
+        storeTest.setUp(self)
+        self.data = b''.join(make_chunks(200, 6))
+        with open('f.bin', 'wb') as f:
+            f.write(self.data)
+
+    def encode(self, **options):
+        with contextlib.redirect_stdout(io.StringIO()):
+            encode('f.bin', 'f.encoded', 'chunks.data', maskSize = 9, **options)
+
+    def check_ranges(self):
+        rng = random.Random(7)
+        for i in range(100):
+            start = rng.randrange(len(self.data) + 10)
+            length = rng.choice([0, 1, 300, 5000, 100000, -1])
+            expected = self.data[start:] if length < 0 else self.data[start : start + length]
+            self.assertEqual(decode_range('f.encoded', 'chunks.data', start, length), expected)
+
+    def test_decode_range(self):
+        for version in (3, 2, 1):
+            self.encode(recipeVersion = version)
+            self.check_ranges()
+
+    def test_decode_range_containers(self):
+        self.encode(compression = 'zlib', containerSize = 16384)
+        self.check_ranges()
+        with encodedReader('f.encoded', 'chunks.data') as reader:
+            reader.seek(-10, os.SEEK_END)
+            self.assertEqual(reader.read(), self.data[-10:])
+
+    def test_size_mismatch(self):
+        # A recipe whose chunks do not add up to its file size is refused
+        self.encode(recipeVersion = 2)
+        data = bytearray(read_file('f.encoded'))
+        struct.pack_into('<Q', data, 10, len(self.data) + 1)
+        with open('f.encoded', 'wb') as f:
+            f.write(data)
+        with self.assertRaises(ValueError):
+            decode_to_file('f.encoded', 'f.decoded', 'chunks.data')
+        with self.assertRaises(ValueError):
+            encodedReader('f.encoded', 'chunks.data')
+
+class treeTest(storeTest):
+    def test_cached_tree(self):
+        # Files sharing chunks, encoded through a cache in batches
+        chunks = make_chunks(120, 8)
+        os.mkdir('tree')
+        files = {}
+        for i in range(4):
+            files[os.path.join('tree', 'f%d' % i)] = b''.join(chunks[i * 20 : i * 20 + 60])
+        for fileName, data in files.items():
+            with open(fileName, 'wb') as f:
+                f.write(data)
+        # The second pass finds every chunk already stored
+        for policy in ('lru', '2q'):
+            output = io.StringIO()
+            with contextlib.redirect_stdout(output):
+                encode_tree('tree', 'chunks.data', batchBytes = 30000, cache = make_cache(policy, 1 << 20), maskSize = 9)
+            self.assertEqual(' 0 new chunks' in output.getvalue(), policy == '2q')
+            for fileName, data in files.items():
+                decode_to_file(fileName + '.encoded', fileName + '.decoded', 'chunks.data')
+                self.assertEqual(read_file(fileName + '.decoded'), data)
+                os.remove(fileName + '.encoded')
+                os.remove(fileName + '.decoded')
+
+class fingerprinterTest(unittest.TestCase):
+    def test_fingerprinter3_4(self):
+        # The multi-byte step finds the cuts of byteWindowFingerprinter3
+        for degree, windowSize, maskSize in ((8, 3, 8), (16, 1, 4), (32, 16, 6), (64, 48, 10)):
+            for stepSize in (4, 8):
+                self.assertTrue(check_fingerprinter3_4(irreducible_polynomial(degree), windowSize, stepSize, maskSize),
+                                (degree, windowSize, stepSize, maskSize))
+
+if __name__ == "__main__":
+    unittest.main()